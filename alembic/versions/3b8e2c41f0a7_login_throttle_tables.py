@@ -0,0 +1,40 @@
+"""login throttle tables for the shared postgres backend
+
+Revision ID: 3b8e2c41f0a7
+Revises: d770662d7b90
+Create Date: 2026-10-19 11:03:27.551902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8e2c41f0a7'
+down_revision = 'd770662d7b90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Only used with LOGIN_THROTTLE_BACKEND=postgres. Times are unix seconds.
+    op.create_table(
+        'login_failures',
+        sa.Column('key', sa.Text, nullable=False),
+        sa.Column('failed_at', sa.Float, nullable=False),
+        sa.Index('ix_login_failures_key_failed_at', 'key', 'failed_at'),
+        prefixes=['UNLOGGED'],
+    )
+
+    op.create_table(
+        'login_lockouts',
+        sa.Column('key', sa.Text, primary_key=True, nullable=False),
+        sa.Column('locked_until', sa.Float, nullable=False),
+        sa.Column('lockouts', sa.Integer, nullable=False, server_default='1'),
+        prefixes=['UNLOGGED'],
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('login_lockouts')
+    op.drop_table('login_failures')
@@ -0,0 +1,29 @@
+"""index predictions by user for prediction history
+
+Revision ID: d770662d7b90
+Revises: fa294fa6b510
+Create Date: 2026-10-19 09:12:41.204118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd770662d7b90'
+down_revision = 'fa294fa6b510'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Serves `GET /users/{id}/predictions` keyset pagination, newest first.
+    op.create_index(
+        'ix_predictions_user_id_created_at',
+        'predictions',
+        ['user_id', sa.text('created_at DESC'), sa.text('prediction_id DESC')],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_predictions_user_id_created_at', table_name='predictions')
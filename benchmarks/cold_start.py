@@ -0,0 +1,122 @@
+"""
+Cold start of the API, with and without the serverless profile.
+
+Each run is a fresh `python -X importtime` process that imports
+`src.api.server` and sends one request straight through the ASGI app, the way
+a serverless instance handles its first request. It reports the import time,
+the time to the first response and which modules took longest to import:
+
+    python -m benchmarks.cold_start --runs 5 --path /fighters/1
+
+The first request to `/fighters/1` connects to the database in `.env`. Use
+`--path /` to leave the database out.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+async def first_request(app, path: str) -> int:
+    path, _, query_string = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": query_string.encode(),
+        "headers": [(b"host", b"localhost")],
+        "client": ("127.0.0.1", 0),
+        "server": ("localhost", 80),
+    }
+    status = None
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+def child(path: str):
+    started = time.perf_counter()
+    from src.api.server import app
+    imported = time.perf_counter()
+    status = asyncio.run(first_request(app, path))
+    responded = time.perf_counter()
+    print(json.dumps({
+        "import_ms": (imported - started) * 1000,
+        "first_response_ms": (responded - started) * 1000,
+        "status": status,
+    }))
+
+
+def import_times(stderr: str) -> dict:
+    """
+    Parses `-X importtime` output into module -> (self us, cumulative us).
+    """
+    times = {}
+    for line in stderr.splitlines():
+        # import time:       123 |        456 |   package.module
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        times[module.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def run(serverless: bool, path: str) -> tuple:
+    env = dict(os.environ, SERVERLESS="true" if serverless else "false")
+    process = subprocess.run([sys.executable, "-X", "importtime", "-m", "benchmarks.cold_start", "--child", path],
+                             env=env, capture_output=True, text=True, check=True)
+    return json.loads(process.stdout.strip().splitlines()[-1]), import_times(process.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per profile")
+    parser.add_argument("--path", default="/fighters/1", help="path of the first request")
+    parser.add_argument("--top", type=int, default=10, help="slowest modules to list")
+    parser.add_argument("--child", metavar="PATH", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    print("%-12s %10s %18s %8s" % ("profile", "import ms", "first response ms", "status"))
+    modules = {}
+    for serverless in (False, True):
+        profile = "serverless" if serverless else "default"
+        results = []
+        for _ in range(args.runs):
+            result, times = run(serverless, args.path)
+            results.append(result)
+        modules[profile] = times
+        print("%-12s %10.1f %18.1f %8s" % (
+            profile,
+            statistics.median(result["import_ms"] for result in results),
+            statistics.median(result["first_response_ms"] for result in results),
+            results[-1]["status"]))
+
+    for profile, times in modules.items():
+        print("\nslowest imports, %s profile (self ms, cumulative ms):" % profile)
+        for module, (self_us, cumulative_us) in sorted(times.items(), key=lambda item: -item[1][0])[:args.top]:
+            print("  %8.1f %8.1f  %s" % (self_us / 1000, cumulative_us / 1000, module))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Compares the default response path (jsonable_encoder + JSONResponse) with
+FastJSONResponse on pages shaped like `/fighters/`, `/events/` and `/users`.
+
+    python -m benchmarks.json_encoding --rows 250
+"""
+import argparse
+import json
+import timeit
+from collections import namedtuple
+from datetime import date
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from src.api import responses
+from src.api.responses import FastJSONResponse
+
+FighterRow = namedtuple("FighterRow", "fighter_id name height reach stance wins draws losses")
+FightRow = namedtuple("FightRow", "fight_id fighter1 fighter2 result event_name event_id date venue_name")
+UserRow = namedtuple("UserRow", "user_id username")
+
+
+def fighters_page(rows: int) -> list:
+    result = [FighterRow(i, "Fighter Number %d " % i, 70 + i % 10, 72 + i % 8, "Orthodox",
+                         i % 20, i % 2, i % 7) for i in range(rows)]
+    return [
+        {
+            "fighter_id": row.fighter_id,
+            "name": row.name.strip(),
+            "height": row.height,
+            "reach": row.reach,
+            "stance": row.stance,
+            "W/D/L": str(row.wins) + "/" + str(row.draws) + "/" + str(row.losses),
+        }
+        for row in result
+    ]
+
+
+def fights_page(rows: int) -> list:
+    result = [FightRow(i, "Fighter %d" % i, "Fighter %d" % (i + 1), "Win - Fighter %d - (KO/TKO)" % i,
+                       "UFC %d" % (i // 12), i // 12, date(2020, 1, 1 + i % 28), "T-Mobile Arena")
+              for i in range(rows)]
+    return [
+        {
+            "fight_id": row.fight_id,
+            "fighter1": row.fighter1,
+            "fighter2": row.fighter2,
+            "result": row.result,
+            "event_name": row.event_name,
+            "event_id": row.event_id,
+            "event_date": row.date,
+            "venue": row.venue_name,
+        }
+        for row in result
+    ]
+
+
+def users_page(rows: int) -> list:
+    return [{"user_id": row.user_id, "username": row.username}
+            for row in (UserRow(i, "user%d" % i) for i in range(rows))]
+
+
+def default_path(content) -> bytes:
+    # What FastAPI does with a returned list: encode, then render with the stdlib.
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def fast_path(content) -> bytes:
+    return FastJSONResponse(content).body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=250)
+    parser.add_argument("--number", type=int, default=200, help="encodings per timing run")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print("encoder: " + ("orjson" if responses.orjson is not None else "json (orjson not installed)"))
+    for name, build in (("fighters", fighters_page), ("fights", fights_page), ("users", users_page)):
+        content = build(args.rows)
+        assert json.loads(fast_path(content)) == json.loads(default_path(content)), "paths disagree on " + name
+        timings = {}
+        for label, path in (("default", default_path), ("fast", fast_path)):
+            best = min(timeit.repeat(lambda: path(content), number=args.number, repeat=args.repeat))
+            timings[label] = best / args.number * 1e6
+        print("%-9s %4d rows  default %8.1f us  fast %8.1f us  speedup %.1fx" % (
+            name, args.rows, timings["default"], timings["fast"], timings["default"] / timings["fast"]))
+
+
+if __name__ == "__main__":
+    main()
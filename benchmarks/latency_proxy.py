@@ -0,0 +1,117 @@
+"""
+A TCP proxy that adds latency, standing in for a database across a network.
+
+Every chunk is delivered half of `--latency-ms` after it arrives, in each
+direction, so a request and its response take one full round trip of extra
+time. The proxy also counts round trips: a client turn is data from the client
+after the server last answered, which is what a client that waits for each
+reply pays the latency for.
+
+    python -m benchmarks.latency_proxy --port 6432 --latency-ms 5
+
+then point POSTGRES_SERVER and POSTGRES_PORT at 127.0.0.1:6432. The target
+defaults to the database in `.env`.
+"""
+import argparse
+import asyncio
+import threading
+import time
+
+from src import config
+
+
+class LatencyProxy:
+    def __init__(self, target_host: str, target_port: int, latency_ms: float, port: int = 0):
+        self.target_host = target_host
+        self.target_port = target_port
+        self.delay = latency_ms / 2000
+        self.port = port
+        self.connections = 0
+        self.round_trips = 0
+        self._started = threading.Event()
+
+    async def _pipe(self, reader, writer, on_data):
+        queue = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                deliver_at, data = await queue.get()
+                if data is None:
+                    break
+                await asyncio.sleep(max(deliver_at - time.monotonic(), 0))
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        delivering = asyncio.ensure_future(deliver())
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                on_data()
+                queue.put_nowait((time.monotonic() + self.delay, data))
+        except ConnectionError:
+            pass
+        finally:
+            queue.put_nowait((0, None))
+            try:
+                await delivering
+            except ConnectionError:
+                pass
+
+    async def _handle(self, client_reader, client_writer):
+        self.connections += 1
+        server_reader, server_writer = await asyncio.open_connection(self.target_host, self.target_port)
+        answered = True
+
+        def from_client():
+            nonlocal answered
+            if answered:
+                self.round_trips += 1
+                answered = False
+
+        def from_server():
+            nonlocal answered
+            answered = True
+
+        await asyncio.gather(self._pipe(client_reader, server_writer, from_client),
+                             self._pipe(server_reader, client_writer, from_server))
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle, "127.0.0.1", self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        self._started.set()
+        async with server:
+            await server.serve_forever()
+
+    def start(self) -> int:
+        """
+        Starts the proxy on a background thread and returns the port it listens on.
+        """
+        threading.Thread(target=lambda: asyncio.run(self._serve()), name="latency-proxy", daemon=True).start()
+        self._started.wait()
+        return self.port
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=6432)
+    parser.add_argument("--latency-ms", type=float, default=5, help="added round-trip latency")
+    parser.add_argument("--target-host", default=config.get_str("POSTGRES_SERVER"))
+    parser.add_argument("--target-port", type=int, default=config.get_int("POSTGRES_PORT", 5432))
+    args = parser.parse_args()
+
+    proxy = LatencyProxy(args.target_host, args.target_port, args.latency_ms, args.port)
+    print("proxying 127.0.0.1:%d to %s:%d with %.1f ms round trips" % (
+        proxy.start(), args.target_host, args.target_port, args.latency_ms))
+    try:
+        while True:
+            time.sleep(10)
+            print("%d connections, %d round trips" % (proxy.connections, proxy.round_trips))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+End-to-end HTTP load test.
+
+Starts the API under uvicorn (or targets `--url`), then drives it with a mix of
+reads and writes against the database in `.env`, and reports throughput,
+p50/p95/p99 latency and error rate per route.
+
+The default mix is mostly `GET /fighters/{id}`, `GET /fighters/` and
+`GET /predictions/count`, with `POST /predictions/add/` in bursts the way
+predictions pile up before an event's deadline:
+
+    python -m benchmarks.load_test --duration 60 --concurrency 32 --workers 4
+
+Predictions are made by throwaway users created at startup, on fights of events
+more than a day away, so make sure the database has some.
+
+A request log can be replayed instead of the synthetic mix. Each line is a JSON
+object with `method` and `path`, and optionally `body`, `headers`, a `route`
+to report it under, and `t`, its offset in seconds from the start of the log.
+With `t`, requests are sent on the original schedule (scaled by `--speed`),
+otherwise as fast as `--concurrency` allows:
+
+    python -m benchmarks.load_test --replay fight_night.jsonl --speed 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+import sqlalchemy
+
+from src import database as db
+
+DEFAULT_MIX = {
+    "get_fighter": 40,
+    "list_fighters": 25,
+    "prediction_count": 25,
+    "add_prediction": 10,
+}
+
+
+class RouteResults:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.statuses = {}
+
+    def record(self, status, seconds: float):
+        self.latencies.append(seconds * 1000)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status is None or status >= 400:
+            self.errors += 1
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] if ordered else 0.0
+
+
+class Traffic:
+    """
+    The synthetic request mix. `next_request` returns (route, method, path, json, headers).
+    """
+    def __init__(self, mix: dict, burst_every: float, burst_seconds: float, burst_factor: float):
+        self.mix = mix
+        self.burst_every = burst_every
+        self.burst_seconds = burst_seconds
+        self.burst_factor = burst_factor
+        self.started = time.monotonic()
+        self.fighter_ids = []
+        self.fight_ids = []
+        self.open_fights = []  # (fight_id, fighter1_id) of fights still open for predictions
+        self.tokens = []
+        self._pending = []  # (token, fight_id, fighter_id) not predicted yet
+
+    def load_ids(self):
+        with db.engine.connect() as conn:
+            self.fighter_ids = list(conn.execute(sqlalchemy.text(
+                "SELECT fighter_id FROM fighters ORDER BY random() LIMIT 1000")).scalars())
+            self.fight_ids = list(conn.execute(sqlalchemy.text(
+                "SELECT fight_id FROM fights ORDER BY random() LIMIT 1000")).scalars())
+            self.open_fights = [tuple(row) for row in conn.execute(sqlalchemy.text(
+                """
+                SELECT fight_id, fighter1_id
+                FROM fights
+                    INNER JOIN events ON fights.event_id = events.event_id
+                WHERE event_date > now() + interval '2 days'
+                LIMIT 200
+                """))]
+        if not self.fighter_ids or not self.fight_ids:
+            raise SystemExit("the database has no fighters or fights to request")
+
+    async def create_users(self, client: httpx.AsyncClient, count: int):
+        run = uuid.uuid4().hex[:8]
+        for i in range(count):
+            credentials = {"username": "loadtest-%s-%d" % (run, i), "password": "loadtest"}
+            await client.post("/users", json=credentials)
+            response = await client.post("/users/login", json=credentials)
+            if response.status_code == 200:
+                self.tokens.append(response.json()["token"])
+        # Every user predicts every open fight at most once, in random order.
+        self._pending = [(token, fight_id, fighter_id)
+                         for token in self.tokens for fight_id, fighter_id in self.open_fights]
+        random.shuffle(self._pending)
+
+    def _weights(self):
+        weights = dict(self.mix)
+        if self.burst_every and (time.monotonic() - self.started) % self.burst_every < self.burst_seconds:
+            weights["add_prediction"] = weights.get("add_prediction", 0) * self.burst_factor
+        if not self._pending:
+            weights.pop("add_prediction", None)
+        return weights
+
+    def next_request(self):
+        weights = self._weights()
+        kind = random.choices(list(weights), list(weights.values()))[0]
+        if kind == "get_fighter":
+            return "GET /fighters/{id}", "GET", "/fighters/%d" % random.choice(self.fighter_ids), None, {}
+        if kind == "list_fighters":
+            sort = random.choice(("name", "height", "reach"))
+            order = random.choice(("ascending", "descending"))
+            path = "/fighters/?sort=%s&order=%s&limit=50&offset=%d" % (sort, order, random.randrange(0, 500, 50))
+            return "GET /fighters/", "GET", path, None, {}
+        if kind == "prediction_count":
+            return ("GET /predictions/count", "GET",
+                    "/predictions/count?fight_id=%d" % random.choice(self.fight_ids), None, {})
+        token, fight_id, fighter_id = self._pending.pop()
+        return ("POST /predictions/add/", "POST", "/predictions/add/",
+                {"prediction": {"fight_id": fight_id, "fighter_id": fighter_id}},
+                {"Authorization": "Bearer " + token})
+
+
+_ids = re.compile(r"/\d+(?=/|$|\?)")
+
+
+def replay_route(entry: dict) -> str:
+    if "route" in entry:
+        return entry["route"]
+    return entry["method"].upper() + " " + _ids.sub("/{id}", entry["path"].split("?")[0])
+
+
+async def send(client: httpx.AsyncClient, results: dict, route: str, method: str, path: str, body, headers):
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, path, json=body, headers=headers)
+        status = response.status_code
+    except httpx.HTTPError:
+        status = None
+    results.setdefault(route, RouteResults()).record(status, time.perf_counter() - started)
+
+
+async def run_mix(client, results, traffic: Traffic, duration: float, concurrency: int):
+    deadline = time.monotonic() + duration
+
+    async def worker():
+        while time.monotonic() < deadline:
+            await send(client, results, *traffic.next_request())
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def run_replay(client, results, path: str, speed: float, concurrency: int):
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    limit = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+
+    async def replay(entry):
+        if "t" in entry:
+            await asyncio.sleep(max(entry["t"] / speed - (time.monotonic() - started), 0))
+        async with limit:
+            await send(client, results, replay_route(entry), entry["method"].upper(), entry["path"],
+                       entry.get("body"), entry.get("headers", {}))
+
+    if all("t" in entry for entry in entries):
+        await asyncio.gather(*(replay(entry) for entry in entries))
+    else:
+        queue = asyncio.Queue()
+        for entry in entries:
+            queue.put_nowait(entry)
+
+        async def worker():
+            while not queue.empty():
+                await replay(queue.get_nowait())
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+def report(results: dict, elapsed: float):
+    total = sum(len(route.latencies) for route in results.values())
+    errors = sum(route.errors for route in results.values())
+    print("%d requests in %.1f s, %.1f req/s, %.2f%% errors" % (
+        total, elapsed, total / elapsed if elapsed else 0, 100 * errors / total if total else 0))
+    print("%-28s %8s %9s %8s %8s %8s %8s" % ("route", "requests", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms"))
+    for name, route in sorted(results.items()):
+        print("%-28s %8d %9.1f %7.2f%% %8.1f %8.1f %8.1f" % (
+            name, len(route.latencies), len(route.latencies) / elapsed, 100 * route.errors / len(route.latencies),
+            percentile(route.latencies, 0.50), percentile(route.latencies, 0.95), percentile(route.latencies, 0.99)))
+        failing = {status: count for status, count in route.statuses.items() if status is None or status >= 400}
+        if failing:
+            print("    errors by status: " + ", ".join("%s: %d" % item for item in sorted(failing.items(), key=str)))
+
+
+def start_server(port: int, workers: int):
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.api.server:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        env=dict(os.environ),
+    )
+    url = "http://127.0.0.1:%d" % port
+    for _ in range(100):
+        try:
+            httpx.get(url + "/", timeout=1)
+            return server, url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit("uvicorn did not start on port %d" % port)
+
+
+async def main_async(args, url: str):
+    results = {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=args.timeout) as client:
+        if args.replay:
+            started = time.monotonic()
+            await run_replay(client, results, args.replay, args.speed, args.concurrency)
+        else:
+            mix = dict(DEFAULT_MIX)
+            for item in args.mix or []:
+                name, _, weight = item.partition("=")
+                if name not in DEFAULT_MIX:
+                    raise SystemExit("unknown route in --mix: " + name)
+                mix[name] = float(weight)
+            traffic = Traffic(mix, args.burst_every, args.burst_seconds, args.burst_factor)
+            traffic.load_ids()
+            if mix.get("add_prediction"):
+                await traffic.create_users(client, args.users)
+            started = time.monotonic()
+            traffic.started = started
+            await run_mix(client, results, traffic, args.duration, args.concurrency)
+        report(results, time.monotonic() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="target a running server instead of starting uvicorn")
+    parser.add_argument("--port", type=int, default=3100)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers to start")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run the synthetic mix")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--mix", action="append", metavar="ROUTE=WEIGHT",
+                        help="override a weight of the default mix: " + ", ".join(DEFAULT_MIX))
+    parser.add_argument("--burst-every", type=float, default=20, help="seconds between prediction bursts, 0 for none")
+    parser.add_argument("--burst-seconds", type=float, default=5, help="length of each prediction burst")
+    parser.add_argument("--burst-factor", type=float, default=6, help="add_prediction weight multiplier in a burst")
+    parser.add_argument("--users", type=int, default=50, help="throwaway users making predictions")
+    parser.add_argument("--replay", help="replay a JSONL request log instead of the synthetic mix")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up for timestamped logs")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server, url = start_server(args.port, args.workers)
+    try:
+        asyncio.run(main_async(args, url))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
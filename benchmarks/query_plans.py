@@ -0,0 +1,207 @@
+"""
+Query-plan regression benchmarks for the endpoints' SQL.
+
+Runs the exact statements used by `get_fighter`, `list_fighters` (every sort
+with each filter), `get_fights_by_event`, `get_prediction` and `get_fight`
+against the database in `.env`, records latency percentiles and the
+`EXPLAIN (ANALYZE, BUFFERS)` plan of each, and compares them with a JSON
+baseline. A case is flagged when its plan gains a sequential scan on a table
+or its p95 latency grows beyond the tolerance.
+
+Load the seeded synthetic dataset first (this drops and recreates every table):
+
+    python -m benchmarks.query_plans --load-data --seed 365
+
+Then record a baseline, and compare later runs against it:
+
+    python -m benchmarks.query_plans --update-baseline
+    python -m benchmarks.query_plans
+
+Exits with status 1 when a regression is flagged.
+"""
+import argparse
+import fnmatch
+import json
+import os
+import subprocess
+import sys
+import time
+
+from src import database as db
+from src import lookups
+from src.api import events, fighters, fights, predictions
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baselines", "query_plans.json")
+
+# Ids spread over the synthetic dataset (80,000 fighters, 200,000 fights).
+FIGHTER_IDS = (1, 40000, 80000)
+FIGHT_IDS = (1, 100000, 200000)
+
+LIST_FILTERS = {
+    "none": {},
+    "stance": {"stance": "south"},
+    "name": {"name": "john"},
+    "event": {"event": "ufc 2"},
+    "weight_class": {"weight_class": "heavyweight"},
+    "height": {"height_min": 70, "height_max": 75},
+}
+
+
+def list_fighters_params(tables, **filters) -> dict:
+    # The endpoint's defaults, with the same wildcard wrapping and stances and
+    # weight classes turned into ids through the lookup tables.
+    params = {
+        "name": "", "stance": "", "event": "", "weight_class": "",
+        "height_min": 0, "height_max": 999, "reach_min": 0, "reach_max": 999,
+        "wins_min": 0, "wins_max": 9999, "losses_min": 0, "losses_max": 9999,
+        "draws_min": 0, "draws_max": 9999, "limit": 50, "offset": 0,
+    }
+    params.update(filters)
+    for key in ("name", "stance", "event", "weight_class"):
+        params[key] = "%" + params[key] + "%"
+    params["stance_ids"] = tables.stances.ids_matching(params.pop("stance"))
+    params["weight_class_ids"] = tables.weight_classes.ids_matching(params.pop("weight_class"))
+    return params
+
+
+def cases(tables):
+    """
+    Returns (name, statement, list of parameter sets) for every benchmarked query.
+    """
+    yield "get_fighter", fighters.FIGHTER_INFO, [{"id": id} for id in FIGHTER_IDS]
+    for sort in ("name", "height", "reach"):
+        for order in ("ASC", "DESC"):
+            for filter_name, filters in LIST_FILTERS.items():
+                yield ("list_fighters[%s %s, %s]" % (sort, order, filter_name),
+                       fighters.list_fighters_query(sort + " " + order),
+                       [list_fighters_params(tables, **filters)])
+    for event_name in ("", "ufc 1"):
+        yield ("get_fights_by_event[%r]" % event_name, events.FIGHTS_BY_EVENT,
+               [{"name": "%" + event_name + "%", "limit": 50, "offset": 0}])
+    yield "get_prediction.counts", predictions.PREDICTION_COUNTS, [{"fight_id": id} for id in FIGHT_IDS]
+    yield "get_prediction.names", predictions.FIGHT_NAMES, [{"fight_id": id} for id in FIGHT_IDS]
+    for fight_id in FIGHT_IDS:
+        yield "get_fight[%d]" % fight_id, fights.fight_query(fight_id), [{}]
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def run_case(conn, statement, param_sets: list, runs: int) -> dict:
+    for params in param_sets:
+        conn.execute(statement, params).fetchall()  # warm up
+
+    samples = []
+    for i in range(runs):
+        params = param_sets[i % len(param_sets)]
+        started = time.perf_counter()
+        conn.execute(statement, params).fetchall()
+        samples.append((time.perf_counter() - started) * 1000)
+
+    compiled = statement.params(param_sets[0]).compile(dialect=conn.dialect)
+    explain = conn.exec_driver_sql(
+        "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + str(compiled), compiled.params
+    ).scalar()
+    if isinstance(explain, str):
+        explain = json.loads(explain)
+    plan = explain[0]
+
+    nodes = list(plan_nodes(plan["Plan"]))
+    return {
+        "p50_ms": percentile(samples, 0.50),
+        "p95_ms": percentile(samples, 0.95),
+        "p99_ms": percentile(samples, 0.99),
+        "planning_ms": plan.get("Planning Time"),
+        "execution_ms": plan.get("Execution Time"),
+        "shared_hit_blocks": plan["Plan"].get("Shared Hit Blocks"),
+        "shared_read_blocks": plan["Plan"].get("Shared Read Blocks"),
+        "seq_scans": sorted({node["Relation Name"] for node in nodes
+                             if node["Node Type"] == "Seq Scan" and "Relation Name" in node}),
+        "plan": plan,
+    }
+
+
+def regressions(name: str, result: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> list:
+    flags = []
+    for table in result["seq_scans"]:
+        if table not in baseline["seq_scans"]:
+            flags.append("%s: plan now uses a sequential scan on %s" % (name, table))
+    if (result["p95_ms"] > baseline["p95_ms"] * (1 + tolerance)
+            and result["p95_ms"] - baseline["p95_ms"] > min_delta_ms):
+        flags.append("%s: p95 %.2f ms, baseline %.2f ms" % (name, result["p95_ms"], baseline["p95_ms"]))
+    return flags
+
+
+def load_data(seed: int):
+    env = dict(os.environ, FAKE_DATA_SEED=str(seed))
+    subprocess.run([sys.executable, "-m", "src.post_fake_data"], env=env, check=True)
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--load-data", action="store_true",
+                        help="recreate the tables and load the synthetic dataset first")
+    parser.add_argument("--seed", type=int, default=365, help="seed for --load-data")
+    parser.add_argument("--runs", type=int, default=20, help="timed runs per query")
+    parser.add_argument("--only", default="*", help="only run cases matching this glob")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative p95 growth")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="p95 growth below this is never flagged, to ignore noise on fast queries")
+    args = parser.parse_args()
+
+    if args.load_data:
+        load_data(args.seed)
+
+    results = {}
+    with db.engine.connect() as conn:
+        for name, statement, param_sets in cases(lookups.load(conn)):
+            if not fnmatch.fnmatch(name, args.only):
+                continue
+            result = run_case(conn, statement, param_sets, args.runs)
+            results[name] = result
+            print("%-45s p50 %8.2f  p95 %8.2f  p99 %8.2f ms  seq scans: %s" % (
+                name, result["p50_ms"], result["p95_ms"], result["p99_ms"], ", ".join(result["seq_scans"]) or "-"))
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("baseline written to " + args.baseline)
+        return
+
+    if not os.path.exists(args.baseline):
+        print("no baseline at %s, run with --update-baseline first" % args.baseline)
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    flags = []
+    for name, result in results.items():
+        if name in baseline:
+            flags += regressions(name, result, baseline[name], args.tolerance, args.min_delta_ms)
+    for flag in flags:
+        print("REGRESSION " + flag)
+    if flags:
+        sys.exit(1)
+    print("no regressions against " + args.baseline)
+
+
+if __name__ == "__main__":
+    main()
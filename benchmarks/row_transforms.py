@@ -0,0 +1,245 @@
+"""
+Micro-benchmarks of the code turning rows into responses.
+
+Runs the row transformations of `get_fighter`, `list_fighters`,
+`get_fights_by_event`, `get_fight` and `get_prediction` on synthetic rows, with
+no database, and reports the time and allocations per row:
+
+    python -m benchmarks.row_transforms --rows 1000
+
+`us/row` is the best of `--repeat` timed runs. `blocks/row` is the number of
+memory blocks still allocated per row once a run is done, i.e. what the
+response keeps alive, and `peak B/row` the peak traced memory per row.
+
+As with `benchmarks.query_plans`, `--update-baseline` records the results and
+later runs are compared with them. A case is flagged when its time per row grows
+beyond the tolerance or it keeps more blocks per row alive than before. Exits
+with status 1 when a regression is flagged.
+"""
+import argparse
+import datetime
+import fnmatch
+import gc
+import json
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+from sqlalchemy.engine.result import result_tuple
+
+from src import lookups
+from src.api import events, fighters, fights, predictions
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baselines", "row_transforms.json")
+
+# Stands in for the lookup tables loaded from the database.
+TABLES = lookups.Lookups(
+    stances={1: "Orthodox", 2: "Southpaw", 3: "Switch"},
+    weight_classes={1: "Flyweight", 4: "Lightweight", 8: "Heavyweight"},
+    victory_methods={1: "SUB", 2: "KO/TKO", 3: "S-Dec", 5: "U-Dec"},
+)
+METHODS = (1, 2, 3, 5, None)
+
+# Rows have the columns the endpoints' queries return, and are SQLAlchemy rows
+# so attribute access costs the same as in the endpoints.
+FighterInfoRow = result_tuple("fight_id event_name op_id opname result method_of_vic".split())
+FighterListRow = result_tuple("fighter_id name height reach stance_id wins draws losses".split())
+EventFightRow = result_tuple(
+    "fight_id fighter1 f1_id fighter2 f2_id method_of_vic result event_name event_id date venue_name".split())
+FightRow = result_tuple(
+    "fight_id event_name event_date fighter_id fighter1_id full_name weight_class result method_of_vic "
+    "round_num round_time kd strikes td sub".split())
+PredictionCountRow = result_tuple("fighter_id fighter1_id fighter2_id ct".split())
+FightNameRow = result_tuple("fighter_id fighter1_id fighter2_id name result method_of_vic".split())
+
+
+def name(rng) -> str:
+    return rng.choice(("Jon", "Amanda", "Israel", "Valentina", "Khabib")) + " " + \
+        rng.choice(("Jones", "Nunes", "Adesanya", "Shevchenko", "Nurmagomedov")) + " "
+
+
+def outcome(rng, fighter1_id: int, fighter2_id: int):
+    """
+    Returns (result, method) of a win by either fighter, a draw or an overturned fight.
+    """
+    method = rng.choice(METHODS)
+    if method is None:
+        return None, None
+    return rng.choice((fighter1_id, fighter1_id, fighter2_id, fighter2_id, None)), method
+
+
+def fighter_info_rows(rng, count: int) -> list:
+    rows = []
+    for i in range(count):
+        op_id = rng.randrange(2, 80000)
+        result, method = outcome(rng, 1, op_id)
+        rows.append(FighterInfoRow([i + 1, "UFC %d" % rng.randrange(300), op_id, name(rng), result, method]))
+    return rows
+
+
+def fighter_list_rows(rng, count: int) -> list:
+    return [
+        FighterListRow([i + 1, name(rng), rng.randrange(60, 80), rng.randrange(60, 84),
+                        rng.choice((1, 2, 3, None)),
+                        rng.randrange(30), rng.randrange(3), rng.randrange(20)])
+        for i in range(count)
+    ]
+
+
+def event_fight_rows(rng, count: int) -> list:
+    rows = []
+    for i in range(count):
+        f1_id, f2_id = rng.sample(range(1, 80000), 2)
+        result, method = outcome(rng, f1_id, f2_id)
+        rows.append(EventFightRow([i + 1, name(rng).strip(), f1_id, name(rng).strip(), f2_id, method, result,
+                                   "UFC %d" % rng.randrange(300), rng.randrange(1, 300),
+                                   datetime.date(2020, 1, 1) + datetime.timedelta(days=rng.randrange(1000)),
+                                   "T-Mobile Arena"]))
+    return rows
+
+
+def fight_row_pairs(rng, count: int) -> list:
+    pairs = []
+    for i in range(count):
+        f1_id, f2_id = rng.sample(range(1, 80000), 2)
+        result, method = outcome(rng, f1_id, f2_id)
+        event_name = "UFC %d" % rng.randrange(300)
+        round_num = rng.randrange(1, 6)
+        pairs.append([
+            FightRow([i + 1, event_name, datetime.datetime(2023, 4, 8), fighter_id, f1_id, name(rng).strip(),
+                      4, result, method, round_num, "4:59",
+                      rng.randrange(3), rng.randrange(200), rng.randrange(10), rng.randrange(5)])
+            for fighter_id in (f1_id, f2_id)
+        ])
+    return pairs
+
+
+def prediction_count_pairs(rng, count: int) -> list:
+    return [
+        [PredictionCountRow([fighter_id, 1, 2, rng.randrange(1000)]) for fighter_id in (1, 2)]
+        for _ in range(count)
+    ]
+
+
+def fight_name_pairs(rng, count: int) -> list:
+    pairs = []
+    for _ in range(count):
+        result, method = outcome(rng, 1, 2)
+        pairs.append([FightNameRow([fighter_id, 1, 2, name(rng).strip(), result, method and 1])
+                      for fighter_id in (1, 2)])
+    return pairs
+
+
+def cases(rng, count: int):
+    """
+    Returns (name, transform, rows, rows per item) for every benchmarked transformation.
+    `transform` turns the whole list of rows into a list of results.
+    """
+    yield ("get_fighter.recent_fight",
+           lambda rows: [fighters.recent_fight(row, 1, TABLES) for row in rows], fighter_info_rows(rng, count), 1)
+    yield ("list_fighters.fighter_summary",
+           lambda rows: [fighters.fighter_summary(row, TABLES) for row in rows], fighter_list_rows(rng, count), 1)
+    yield ("get_fights_by_event.event_fight",
+           lambda rows: [events.event_fight(row, TABLES) for row in rows], event_fight_rows(rng, count), 1)
+    yield ("get_fight.fight_details",
+           lambda pairs: [fights.fight_details(pair, TABLES) for pair in pairs], fight_row_pairs(rng, count // 2), 2)
+    yield ("get_prediction.tally_predictions",
+           lambda pairs: [predictions.tally_predictions(pair) for pair in pairs],
+           prediction_count_pairs(rng, count // 2), 2)
+    yield ("get_prediction.fight_outcome",
+           lambda pairs: [predictions.fight_outcome(pair) for pair in pairs], fight_name_pairs(rng, count // 2), 2)
+
+
+def measure(transform, items: list, rows_per_item: int, repeat: int) -> dict:
+    rows = len(items) * rows_per_item
+    transform(items)  # warm up
+    best = min(timeit.repeat(lambda: transform(items), number=1, repeat=repeat))
+
+    gc.collect()
+    gc.disable()
+    try:
+        blocks = sys.getallocatedblocks()
+        output = transform(items)
+        kept_blocks = sys.getallocatedblocks() - blocks
+        del output
+
+        tracemalloc.start()
+        output = transform(items)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del output
+    finally:
+        gc.enable()
+
+    return {
+        "us_per_row": best * 1e6 / rows,
+        "blocks_per_row": kept_blocks / rows,
+        "peak_bytes_per_row": peak / rows,
+    }
+
+
+def regressions(name: str, result: dict, baseline: dict, tolerance: float) -> list:
+    flags = []
+    if result["us_per_row"] > baseline["us_per_row"] * (1 + tolerance):
+        flags.append("%s: %.3f us/row, baseline %.3f us/row" % (name, result["us_per_row"], baseline["us_per_row"]))
+    # Allocations are deterministic, so any real growth is a change in the code.
+    if result["blocks_per_row"] > baseline["blocks_per_row"] + 0.5:
+        flags.append("%s: %.1f blocks/row, baseline %.1f blocks/row"
+                     % (name, result["blocks_per_row"], baseline["blocks_per_row"]))
+    return flags
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000, help="synthetic rows per case")
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per case")
+    parser.add_argument("--seed", type=int, default=365)
+    parser.add_argument("--only", default="*", help="only run cases matching this glob")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative growth of us/row")
+    args = parser.parse_args()
+
+    results = {}
+    print("%-36s %10s %11s %12s" % ("case", "us/row", "blocks/row", "peak B/row"))
+    for name, transform, items, rows_per_item in cases(random.Random(args.seed), args.rows):
+        if not fnmatch.fnmatch(name, args.only):
+            continue
+        result = measure(transform, items, rows_per_item, args.repeat)
+        results[name] = result
+        print("%-36s %10.3f %11.1f %12.1f" % (
+            name, result["us_per_row"], result["blocks_per_row"], result["peak_bytes_per_row"]))
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("baseline written to " + args.baseline)
+        return
+
+    if not os.path.exists(args.baseline):
+        print("no baseline at %s, run with --update-baseline first" % args.baseline)
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    flags = []
+    for name, result in results.items():
+        if name in baseline:
+            flags += regressions(name, result, baseline[name], args.tolerance)
+    for flag in flags:
+        print("REGRESSION " + flag)
+    if flags:
+        sys.exit(1)
+    print("no regressions against " + args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Latency of the write endpoints against a database across a slow network.
+
+Starts `benchmarks.latency_proxy` in front of the database in `.env`, points
+the API at it, and times `add_user`, `update_username`, `add_prediction` and
+`post_fight`. For each it reports latency percentiles, the database round trips
+counted by the proxy and the SQL statements run, per request:
+
+    python -m benchmarks.write_latency --latency-ms 5 --requests 50
+
+Every round trip costs `--latency-ms`, so round trips per request is the number
+to watch. Run it on two commits to compare them.
+
+It creates throwaway `writebench-*` users and inserts fights into the first
+event, so only point it at a scratch database. `add_prediction` needs a fight
+of an event more than two days away and is skipped without one.
+"""
+import argparse
+import os
+import time
+import uuid
+
+from src import config
+from benchmarks.latency_proxy import LatencyProxy
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def statements(response) -> int:
+    # Server-Timing: db;dur=1.234;desc="3 queries"
+    return int(response.headers["server-timing"].rsplit('desc="', 1)[1].split()[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=5, help="added database round-trip latency")
+    parser.add_argument("--requests", type=int, default=50, help="timed requests per endpoint")
+    args = parser.parse_args()
+
+    proxy = LatencyProxy(config.get_str("POSTGRES_SERVER"), config.get_int("POSTGRES_PORT", 5432), args.latency_ms)
+    port = proxy.start()
+    # Read when the engines are created, so before the API is imported.
+    os.environ["POSTGRES_SERVER"] = "127.0.0.1"
+    os.environ["POSTGRES_PORT"] = str(port)
+
+    import sqlalchemy
+    from fastapi.testclient import TestClient
+    from src import database as db
+    from src.api.server import app
+
+    with db.engine.connect() as conn:
+        event_id = conn.execute(sqlalchemy.text("SELECT MIN(event_id) FROM events")).scalar()
+        fighter1_id, fighter2_id = conn.execute(sqlalchemy.text(
+            "SELECT fighter_id FROM fighters ORDER BY fighter_id LIMIT 2")).scalars()
+        open_fight = conn.execute(sqlalchemy.text(
+            """
+            SELECT fight_id, fighter1_id
+            FROM fights
+                INNER JOIN events ON fights.event_id = events.event_id
+            WHERE event_date > now() + interval '2 days'
+            LIMIT 1
+            """)).first()
+
+    run = uuid.uuid4().hex[:8]
+    count = args.requests + 1  # the first request of each endpoint warms up
+
+    with TestClient(app) as client:
+        def new_user(i: int, suffix: str = ""):
+            credentials = {"username": "writebench-%s-%s%d" % (run, suffix, i), "password": "writebench"}
+            client.post("/users", json=credentials)
+            token = client.post("/users/login", json=credentials).json()["token"]
+            return {"Authorization": "Bearer " + token}
+
+        renamed = new_user(0, "rename-")
+        predictors = [new_user(i, "predict-") for i in range(count)] if open_fight else []
+
+        cases = {
+            "add_user": lambda i: (
+                "POST", "/users", {"username": "writebench-%s-%d" % (run, i), "password": "writebench"}, {}),
+            "update_username": lambda i: (
+                "PUT", "/users/update/name",
+                {"new_username": "writebench-%s-renamed-%d" % (run, i)},
+                renamed),
+            "post_fight": lambda i: (
+                "POST", "/fights",
+                {"fight": {"event_id": event_id, "fighter1_id": fighter1_id, "fighter2_id": fighter2_id,
+                           "round_num": 3, "round_time": "5:00", "result": fighter1_id,
+                           "method_of_vic": 5, "weight_class": 4},
+                 "stats1": {"kd": 1, "strikes": 50, "td": 2, "sub": 0, "fighter_id": fighter1_id},
+                 "stats2": {"kd": 0, "strikes": 40, "td": 1, "sub": 1, "fighter_id": fighter2_id}},
+                {}),
+        }
+        if open_fight:
+            cases["add_prediction"] = lambda i: (
+                "POST", "/predictions/add/",
+                {"prediction": {"fight_id": open_fight.fight_id, "fighter_id": open_fight.fighter1_id}},
+                predictors[i])
+        else:
+            print("no fight of an event more than two days away, skipping add_prediction")
+
+        print("%-16s %8s %8s %8s %8s %12s %12s" % (
+            "endpoint", "requests", "p50 ms", "p95 ms", "errors", "round trips", "statements"))
+        for name, request in cases.items():
+            latencies = []
+            round_trips = 0
+            statement_count = 0
+            errors = 0
+            for i in range(count):
+                method, path, body, headers = request(i)
+                before = proxy.round_trips
+                started = time.perf_counter()
+                response = client.request(method, path, json=body, headers=headers)
+                elapsed = time.perf_counter() - started
+                if i == 0:
+                    continue
+                latencies.append(elapsed * 1000)
+                round_trips += proxy.round_trips - before
+                statement_count += statements(response)
+                errors += response.status_code >= 400
+            print("%-16s %8d %8.1f %8.1f %8d %12.1f %12.1f" % (
+                name, len(latencies), percentile(latencies, 0.50), percentile(latencies, 0.95), errors,
+                round_trips / len(latencies), statement_count / len(latencies)))
+
+
+if __name__ == "__main__":
+    main()
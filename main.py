@@ -1,10 +1,155 @@
+"""
+Starts the API server.
+
+    python main.py          production: pre-forked workers, one per CPU core
+    python main.py --dev    one process that reloads when the code changes
+
+In production gunicorn imports the app once before forking the workers
+(`preload_app`), so they share its memory copy-on-write, and each worker runs it
+under uvicorn, on uvloop and httptools when they are installed. On SIGTERM the
+workers stop accepting connections and finish the requests in flight, for up
+to `GRACEFUL_TIMEOUT` seconds. Before that, for `SHUTDOWN_DELAY_SECONDS`, they
+keep serving but fail `/readyz`, so load balancers stop sending them traffic
+before they stop accepting connections. Without gunicorn (it does not run on Windows)
+uvicorn starts the workers itself, and each of them imports the app.
+
+With more than one worker `SESSION_SECRET` has to be set, otherwise a session
+token only works on the worker that issued it. Revoked session tokens are only
+known to the worker that revoked them, until they expire after
+`SESSION_TTL_SECONDS`.
+"""
+import argparse
+import asyncio
+import importlib.util
+import os
+import sys
+
 import uvicorn
 
-if __name__ == "__main__":
+from src import config
+
+HOST = config.get_str("HOST", "0.0.0.0")
+PORT = config.get_int("PORT", 3000)
+# 0 runs one worker per CPU core.
+WORKERS = config.get_int("WEB_CONCURRENCY", 0)
+GRACEFUL_TIMEOUT = config.get_int("GRACEFUL_TIMEOUT", 30)
+KEEPALIVE_SECONDS = config.get_int("KEEPALIVE_SECONDS", 5)
+SHUTDOWN_DELAY_SECONDS = config.get_float("SHUTDOWN_DELAY_SECONDS", 5)
+
+APP = "src.api.server:app"
+
+
+def installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def cpu_count() -> int:
+    # The cores this process may run on, which a container can limit.
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class Server(uvicorn.Server):
+    """
+    Fails `/readyz` as soon as it is told to stop, and stops after
+    `SHUTDOWN_DELAY_SECONDS`. A second signal stops it straight away.
+    """
+    def handle_exit(self, sig, frame):
+        from src.api import health
+        if health.start_draining() and SHUTDOWN_DELAY_SECONDS > 0:
+            asyncio.get_event_loop().call_later(SHUTDOWN_DELAY_SECONDS, super().handle_exit, sig, frame)
+        else:
+            super().handle_exit(sig, frame)
+
+
+def post_fork(server, worker):
+    # The app was imported before the fork, so the worker drops what it must
+    # not share with the parent.
+    from src import database as db
+    from src import response_cache
+    db.after_fork()
+    response_cache.after_fork()
+
+
+def run_gunicorn(host: str, port: int, workers: int):
+    from gunicorn.app.base import BaseApplication
+    from gunicorn.arbiter import Arbiter
+    from uvicorn.workers import UvicornWorker
+
+    class Worker(UvicornWorker):
+        # UvicornWorker._serve, with the Server above.
+        async def _serve(self):
+            self.config.app = self.wsgi
+            server = Server(config=self.config)
+            self._install_sigquit_handler()
+            await server.serve(sockets=self.sockets)
+            if not server.started:
+                sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", "%s:%d" % (host, port))
+            self.cfg.set("workers", workers)
+            # Picks uvloop and httptools when they are installed.
+            self.cfg.set("worker_class", Worker)
+            self.cfg.set("preload_app", True)
+            self.cfg.set("graceful_timeout", GRACEFUL_TIMEOUT)
+            self.cfg.set("keepalive", KEEPALIVE_SECONDS)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            from src.api.server import app
+            return app
+
+    Application().run()
+
+
+def run_uvicorn(host: str, port: int, workers: int):
+    from uvicorn.supervisors import Multiprocess
+
     config = uvicorn.Config(
-        "src.api.server:app", port=3000, log_level="info", reload=True, env_file=".env"
+        APP,
+        host=host,
+        port=port,
+        workers=workers,
+        loop="uvloop" if installed("uvloop") else "asyncio",
+        http="httptools" if installed("httptools") else "h11",
+        timeout_keep_alive=KEEPALIVE_SECONDS,
+        log_level="info",
     )
-    server = uvicorn.Server(config)
+    # What uvicorn.run does, with the Server above.
+    server = Server(config=config)
+    if workers > 1:
+        Multiprocess(config, target=server.run, sockets=[config.bind_socket()]).run()
+    else:
+        server.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dev", action="store_true", help="one worker on localhost that reloads on changes")
+    parser.add_argument("--host", default=None, help="defaults to HOST, or localhost with --dev")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="defaults to one per CPU core")
+    args = parser.parse_args()
 
-    server.run()
+    if args.dev:
+        uvicorn.run(APP, host=args.host or "127.0.0.1", port=args.port, log_level="info", reload=True,
+                    env_file=".env")
+        return
 
+    host = args.host or HOST
+    workers = args.workers or cpu_count()
+    if workers > 1 and not config.get_str("SESSION_SECRET"):
+        parser.error("SESSION_SECRET must be set to run more than one worker, or use --workers 1")
+    if installed("gunicorn"):
+        print("starting %d gunicorn workers on %s:%d" % (workers, host, args.port))
+        run_gunicorn(host, args.port, workers)
+    else:
+        print("gunicorn is not installed, starting %d uvicorn workers on %s:%d" % (workers, host, args.port))
+        run_uvicorn(host, args.port, workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import asyncio
+import inspect
+import time
+from urllib.parse import parse_qsl, urlencode
+
+from starlette.routing import Match
+
+from src import database as db
+from src import response_cache
+
+
+class ResponseCacheMiddleware:
+    """
+    Serves GET requests for routes marked with `response_cache.cached` from the
+    response cache. The key is the path plus the sorted query string, so
+    `?limit=5&offset=0` and `?offset=0&limit=5` share an entry.
+
+    Concurrent misses for the same key are collapsed: the first request runs the
+    endpoint and the others wait for its response instead of all hitting the
+    database. Only 200 responses are stored, and not those read from the replica
+    shortly after one of their tags was purged. Requests sending
+    `X-Read-Your-Writes` or `Cache-Control: no-cache` skip the lookup.
+    """
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+        self._inflight = {}  # key -> future resolving to the leader's Entry, or None
+        self._int_params = {}  # endpoint -> names of its parameters declared as int
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+
+        tags = self._route_tags(scope)
+        if tags is None:
+            await self.app(scope, receive, send)
+            return
+
+        query = sorted(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))
+        key = scope["path"] + "?" + urlencode(query)
+
+        if not self._bypass(scope):
+            entry = await response_cache._call(response_cache.backend.get, key)
+            if entry is not None:
+                response_cache.count("hits")
+                await self._replay(entry, send, b"HIT")
+                return
+
+            leader = self._inflight.get(key)
+            if leader is not None:
+                entry = await asyncio.shield(leader)
+                if entry is not None:
+                    response_cache.count("hits")
+                    response_cache.count("collapsed")
+                    await self._replay(entry, send, b"HIT")
+                    return
+        response_cache.count("misses")
+
+        future = None
+        if key not in self._inflight:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[key] = future
+        entry = None
+        try:
+            entry = await self._run(scope, receive, send, key, tags)
+        finally:
+            if future is not None:
+                del self._inflight[key]
+                future.set_result(entry)
+
+    def _route_tags(self, scope):
+        """
+        Returns the formatted tags of the cached route `scope` is for, or None if
+        the route is not cached.
+        """
+        for route in self.routes:
+            match, child_scope = route.matches(scope)
+            if match != Match.FULL:
+                continue
+            # A hit never reaches the router, so set the endpoint and path
+            # parameters it would have, which the outer middlewares need to find
+            # the route template.
+            scope.update(child_scope)
+            endpoint = getattr(route, "endpoint", None)
+            tags = getattr(endpoint, "cache_tags", None)
+            if tags is None:
+                return None
+            params = dict(parse_qsl(scope["query_string"].decode("latin-1")))
+            params.update(child_scope.get("path_params", {}))
+            try:
+                # Formatted from the values the endpoint sees, so "/fighters/05"
+                # is tagged "fighter:5" like the writes that purge it.
+                for name in self._int_params_of(endpoint) & params.keys():
+                    params[name] = int(params[name])
+                return {tag.format(**params) for tag in tags}
+            except (KeyError, ValueError):
+                # A parameter a tag depends on is missing or invalid, let the
+                # endpoint reject it.
+                return None
+        return None
+
+    def _int_params_of(self, endpoint) -> set:
+        names = self._int_params.get(endpoint)
+        if names is None:
+            names = {name for name, parameter in inspect.signature(endpoint).parameters.items()
+                     if parameter.annotation is int}
+            self._int_params[endpoint] = names
+        return names
+
+    @staticmethod
+    def _reads_replica(scope) -> bool:
+        # Like ReadRoutingMiddleware. A request that fell back to the primary is
+        # counted too, which only costs a store.
+        if db.read_engine is None:
+            return False
+        return not any(name == b"x-read-your-writes" and value.lower() in (b"1", b"true", b"yes")
+                       for name, value in scope["headers"])
+
+    @staticmethod
+    def _bypass(scope) -> bool:
+        for name, value in scope["headers"]:
+            if name == b"x-read-your-writes" and value.lower() in (b"1", b"true", b"yes"):
+                return True
+            if name == b"cache-control" and b"no-cache" in value.lower():
+                return True
+        return False
+
+    async def _run(self, scope, receive, send, key, tags):
+        generation = await response_cache._call(response_cache.backend.generation)
+        request_tags = set(tags)
+        token = response_cache._request_tags.set(request_tags)
+        status = None
+        headers = []
+        body = []
+
+        async def capture(message):
+            nonlocal status, headers
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                message = dict(message, headers=headers + [[b"x-cache", b"MISS"]])
+            elif message["type"] == "http.response.body":
+                body.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            response_cache._request_tags.reset(token)
+
+        if status != 200 or generation != await response_cache._call(response_cache.backend.generation):
+            return None
+        # The replica may not have caught up with a write that purged these tags.
+        if self._reads_replica(scope) and await response_cache._call(
+                response_cache.backend.purged_since, request_tags, time.time() - response_cache.REPLICA_LAG_SECONDS):
+            return None
+        entry = response_cache.Entry(status, headers, b"".join(body), request_tags,
+                                     time.time() + response_cache.TTL_SECONDS)
+        await response_cache._call(response_cache.backend.put, key, entry)
+        response_cache.count("stores")
+        return entry
+
+    @staticmethod
+    async def _replay(entry, send, state: bytes):
+        await send({
+            "type": "http.response.start",
+            "status": entry.status,
+            "headers": entry.headers + [[b"x-cache", state]],
+        })
+        await send({"type": "http.response.body", "body": entry.body})
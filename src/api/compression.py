@@ -0,0 +1,241 @@
+"""
+Negotiated response compression.
+
+Responses of at least `COMPRESSION_MIN_SIZE` bytes with a text or JSON body are
+compressed with the best encoding both sides support: zstd (needs the
+`zstandard` package), brotli (needs `brotli`), then gzip. Streamed responses
+are compressed chunk by chunk and flushed after every chunk, so clients still
+receive data as it is produced.
+
+Per route and encoding, the bytes in and out and the CPU time spent compressing
+are reported at `/metrics/compression`.
+"""
+import threading
+import time
+import zlib
+
+from src import config
+from src.api.route_templates import RouteTemplates
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENABLED = config.get_bool("COMPRESSION_ENABLED", True)
+MIN_SIZE = config.get_int("COMPRESSION_MIN_SIZE", 500)
+GZIP_LEVEL = config.get_int("COMPRESSION_GZIP_LEVEL", 6)
+BROTLI_QUALITY = config.get_int("COMPRESSION_BROTLI_QUALITY", 4)
+ZSTD_LEVEL = config.get_int("COMPRESSION_ZSTD_LEVEL", 3)
+
+COMPRESSIBLE_TYPES = (b"application/json", b"text/", b"application/javascript")
+
+
+class GzipCompressor:
+    def __init__(self):
+        self._obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._obj.flush()
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self._obj = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.process(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush()
+
+    def finish(self) -> bytes:
+        return self._obj.finish()
+
+
+class ZstdCompressor:
+    def __init__(self):
+        self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._obj.flush()
+
+
+# In order of preference.
+COMPRESSORS = {}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = ZstdCompressor
+if brotli is not None:
+    COMPRESSORS["br"] = BrotliCompressor
+COMPRESSORS["gzip"] = GzipCompressor
+
+
+class RouteStats:
+    def __init__(self):
+        self.responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+
+_stats_lock = threading.Lock()
+_stats = {}  # (route, encoding) -> RouteStats
+
+
+def _record(route: str, encoding: str, bytes_in: int, bytes_out: int, cpu_seconds: float):
+    with _stats_lock:
+        route_stats = _stats.setdefault((route, encoding), RouteStats())
+        route_stats.responses += 1
+        route_stats.bytes_in += bytes_in
+        route_stats.bytes_out += bytes_out
+        route_stats.cpu_seconds += cpu_seconds
+
+
+def stats() -> dict:
+    json = {"enabled": ENABLED, "encodings": list(COMPRESSORS), "routes": {}}
+    with _stats_lock:
+        for (route, encoding), route_stats in sorted(_stats.items()):
+            json["routes"].setdefault(route, {})[encoding] = {
+                "responses": route_stats.responses,
+                "bytes_in": route_stats.bytes_in,
+                "bytes_out": route_stats.bytes_out,
+                "ratio": route_stats.bytes_in / route_stats.bytes_out if route_stats.bytes_out else 0.0,
+                "cpu_ms_total": route_stats.cpu_seconds * 1000,
+                "cpu_us_per_kb": (route_stats.cpu_seconds * 1e6 / (route_stats.bytes_in / 1024)
+                                  if route_stats.bytes_in else 0.0),
+            }
+    return json
+
+
+def negotiate(accept_encoding: str):
+    """
+    Returns the preferred encoding the client accepts, or None.
+    """
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in COMPRESSORS:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > 0:
+            return encoding
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(self, app, routes):
+        self.app = app
+        self.route_template = RouteTemplates(routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = None
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                encoding = negotiate(value.decode("latin-1"))
+                break
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        compressor = None
+        passthrough = False
+        bytes_in = 0
+        bytes_out = 0
+        cpu_seconds = 0.0
+
+        async def compress(message):
+            nonlocal start, compressor, passthrough, bytes_in, bytes_out, cpu_seconds
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows whether to compress.
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if compressor is None:
+                if not self._compressible(start, body, more_body):
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = COMPRESSORS[encoding]()
+                headers = [(name, value) for name, value in start.get("headers", [])
+                           if name != b"content-length"]
+                headers.append((b"content-encoding", encoding.encode()))
+                headers.append((b"vary", b"Accept-Encoding"))
+
+                if not more_body:
+                    started = time.thread_time()
+                    compressed = compressor.compress(body) + compressor.finish()
+                    cpu_seconds += time.thread_time() - started
+                    headers.append((b"content-length", str(len(compressed)).encode()))
+                    await send(dict(start, headers=headers))
+                    await send({"type": "http.response.body", "body": compressed})
+                    _record(self.route_template(scope), encoding,
+                            len(body), len(compressed), cpu_seconds)
+                    return
+                await send(dict(start, headers=headers))
+
+            started = time.thread_time()
+            chunk = compressor.compress(body)
+            chunk += compressor.flush() if more_body else compressor.finish()
+            cpu_seconds += time.thread_time() - started
+            bytes_in += len(body)
+            bytes_out += len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+            if not more_body:
+                _record(self.route_template(scope), encoding, bytes_in, bytes_out, cpu_seconds)
+
+        await self.app(scope, receive, compress)
+
+    @staticmethod
+    def _compressible(start, body: bytes, more_body: bool) -> bool:
+        if start["status"] < 200 or start["status"] in (204, 304):
+            return False
+        content_type = b""
+        for name, value in start.get("headers", []):
+            if name == b"content-encoding":
+                return False
+            if name == b"content-type":
+                content_type = value.lower()
+        if not content_type.startswith(COMPRESSIBLE_TYPES):
+            return False
+        # A streamed response's size is unknown up front, so it is always compressed.
+        return more_body or len(body) >= MIN_SIZE
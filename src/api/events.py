@@ -7,6 +7,10 @@ from enum import Enum
 from pydantic import BaseModel, Field
 
 from src import database as db
+from src import lookups
+from src import response_cache
+from src.api.fights import fight_decision
+from src.api.responses import FastJSONResponse
 
 
 class EventJson(BaseModel):
@@ -19,8 +23,19 @@ class EventJson(BaseModel):
 router = APIRouter()
 
 
+EVENT_INFO = sqlalchemy.text(
+    """
+    SELECT event_name, event_date, venue_name, attendance
+    FROM events
+        INNER JOIN venue ON events.venue_id = venue.venue_id
+    WHERE event_id = (:id)
+    """
+)
+
+
 @router.get("/events/{event_id}", tags=["events"])
-def get_event(event_id: int):
+@response_cache.cached("event:{event_id}")
+async def get_event(event_id: int):
     """
     This endpoint returns event information given an `event_id`.
     For each event it returns:
@@ -30,20 +45,9 @@ def get_event(event_id: int):
     * `venue`: The name of the place where the event was held.
     * `attendance`: The number of people recorded to have attended the event.
     """
-    stmt = (
-        sqlalchemy.text(
-        """
-        SELECT event_name, event_date, venue_name, attendance
-        FROM events
-            INNER JOIN venue ON events.venue_id = venue.venue_id
-        WHERE event_id = (:id)
-        """
-        )
-    )
-
-    with db.engine.connect() as conn:
+    async with db.connect() as conn:
         json = []
-        result = conn.execute(stmt, {"id": event_id})
+        result = await conn.execute(EVENT_INFO, {"id": event_id})
         for row in result:
             json.append(
                 {
@@ -59,8 +63,52 @@ def get_event(event_id: int):
     return json
 
 
+FIGHTS_BY_EVENT = sqlalchemy.text("""
+    SELECT
+        fight_id,
+        CONCAT(f1.first_name, ' ', f1.last_name) AS fighter1,
+        f1.fighter_id AS f1_id,
+        CONCAT(f2.first_name, ' ', f2.last_name) AS fighter2,
+        f2.fighter_id AS f2_id,
+        method_of_vic,
+        result,
+        event_name,
+        fights.event_id,
+        DATE(event_date) as date,
+        venue_name
+    FROM fights
+        INNER JOIN fighters AS f1 ON f1.fighter_id = fights.fighter1_id
+        INNER JOIN fighters AS f2 ON f2.fighter_id = fights.fighter2_id
+        INNER JOIN events ON events.event_id = fights.event_id
+        INNER JOIN venue ON venue.venue_id = events.venue_id
+    WHERE event_name ILIKE :name
+    ORDER BY DATE(event_date) DESC, fight_id
+    LIMIT (:limit)
+    OFFSET (:offset)
+    """
+)
+
+
+def event_fight(row, tables: lookups.Lookups) -> dict:
+    """
+    Builds one fight of the `get_fights_by_event` response from a row of `FIGHTS_BY_EVENT`.
+    """
+    return {
+        "fight_id": row.fight_id,
+        "fighter1": row.fighter1,
+        "fighter2": row.fighter2,
+        "result": fight_decision(row.result, tables.victory_methods.name(row.method_of_vic),
+                                 row.f1_id, row.fighter1, row.fighter2),
+        "event_name": row.event_name,
+        "event_id": row.event_id,
+        "event_date": row.date,
+        "venue": row.venue_name,
+    }
+
+
 @router.get("/events/", tags=["events", "fights"])
-def get_fights_by_event(event_name: str = "", limit: int = 50, offset: int = 0):
+@response_cache.cached("fights")
+async def get_fights_by_event(event_name: str = "", limit: int = 50, offset: int = 0):
     """
     This endpoint returns all the fights whose corresponding event name is similar to
     the given string.
@@ -78,66 +126,24 @@ def get_fights_by_event(event_name: str = "", limit: int = 50, offset: int = 0):
     The endpoint returns the fights by descending `event_date` and by ascending the internal
     id of the fight.
     """
-    fights = sqlalchemy.text("""
-        SELECT
-            fight_id,
-            CONCAT(f1.first_name, ' ', f1.last_name) AS fighter1,
-            f1.fighter_id AS f1_id,
-            CONCAT(f2.first_name, ' ', f2.last_name) AS fighter2,
-            f2.fighter_id AS f2_id,
-            method, 
-            result,
-            event_name,
-            fights.event_id,
-            DATE(event_date) as date,
-            venue_name
-        FROM fights
-            INNER JOIN fighters AS f1 ON f1.fighter_id = fights.fighter1_id
-            INNER JOIN fighters AS f2 ON f2.fighter_id = fights.fighter2_id
-            INNER JOIN events ON events.event_id = fights.event_id
-            INNER JOIN venue ON venue.venue_id = events.venue_id
-            LEFT JOIN victory_methods ON fights.method_of_vic = victory_methods.id
-        WHERE event_name ILIKE :name
-        ORDER BY DATE(event_date) DESC, fight_id
-        LIMIT (:limit)
-        OFFSET (:offset)
-        """
-    ).bindparams(
+    fights = FIGHTS_BY_EVENT.bindparams(
         sqlalchemy.bindparam('name', '%' + event_name + '%'),
         sqlalchemy.bindparam('limit', limit),
         sqlalchemy.bindparam('offset', offset)
     )
 
-    with db.engine.connect() as conn:
-        result = conn.execute(fights)
+    tables = await lookups.get()
+    async with db.connect() as conn:
+        result = await conn.execute(fights)
         rows = result.fetchall()
         json = []
         for row in rows:
             if not row.event_name:
                 # No fights, no point.
                 break
-            if row.result == row.f1_id:
-                decision = "Win - " + row.fighter1 + " - (" + row.method + ")"
-            elif row.result == row.f2_id:
-                decision = "Win - " + row.fighter2 + " - (" + row.method + ")"
-            elif row.result is None and row.method is not None:
-                decision = "Draw - (" + row.method + ")"
-            elif row.result is None and row.method is None:
-                decision = "Unknown"
-            json.append(
-                {
-                    "fight_id": row.fight_id,
-                    "fighter1": row.fighter1,
-                    "fighter2": row.fighter2,
-                    "result": decision,
-                    "event_name": row.event_name,
-                    "event_id": row.event_id,
-                    "event_date": row.date,
-                    "venue": row.venue_name,
-                }
-            )
+            json.append(event_fight(row, tables))
 
-    return json
+    return FastJSONResponse(json)
 
 
 def is_valid_date_format(date_string):
@@ -153,7 +159,7 @@ def is_valid_date_format(date_string):
 
 # Add get parameters
 @router.post("/events/", tags=["events"])
-def add_event(event: EventJson):
+async def add_event(event: EventJson):
     """
     This endpoint takes an event datatype and adds new data into the database.
     The event is represented by its `event_name`, `event_date`,
@@ -174,8 +180,8 @@ def add_event(event: EventJson):
     elif not is_valid_date_format(event.event_date):
         raise HTTPException(status_code=400, detail="improper event_date given")
 
-    with db.engine.begin() as conn:
-        result = conn.execute(
+    async with db.begin() as conn:
+        result = await conn.execute(
             sqlalchemy.select(
                 db.venue.c.venue_id,
             ).where(db.venue.c.venue_id == event.venue_id)
@@ -183,11 +189,11 @@ def add_event(event: EventJson):
         if result.fetchone is None:
             raise HTTPException(status_code=404, detail="given venue_id doesn't exist")
 
-        result = conn.execute(
+        result = await conn.execute(
             sqlalchemy.insert(db.events)
             .values(
                 event_name=event.event_name,
-                event_date=event.event_date,
+                event_date=datetime.strptime(event.event_date, "%Y-%m-%d"),
                 venue_id=event.venue_id,
                 attendance=event.attendance,
             )
@@ -2,6 +2,11 @@ from fastapi import APIRouter, HTTPException
 from enum import Enum
 from fastapi.params import Query
 from src import database as db
+from src import lookups
+from src import prepared_statements
+from src import query_budget
+from src import response_cache
+from src.api.responses import FastJSONResponse
 from typing import Optional
 from pydantic import BaseModel, Field
 import sqlalchemy
@@ -18,8 +23,84 @@ class FighterJson(BaseModel):
 router = APIRouter()
 
 
+FIGHTER_INFO = sqlalchemy.text(
+    """
+    WITH recent_fights AS (
+        SELECT fight_id, fighter1_id, fighter2_id, weight_class, result, event_date, event_name, method_of_vic
+        FROM fights
+            INNER JOIN events ON fights.event_id = events.event_id
+        ORDER BY DATE(events.event_date) DESC
+    ), fighter_info AS (
+        SELECT
+            fighter_id,
+            CONCAT(first_name, ' ', last_name) AS name,
+            height,
+            reach,
+            stance_id,
+            fight_id,
+            fighter1_id,
+            fighter2_id,
+            weight_class,
+            event_name,
+            method_of_vic,
+            result
+        FROM fighters
+            LEFT JOIN recent_fights ON fighter_id = fighter1_id OR fighter_id = fighter2_id
+        WHERE fighter_id = (:id)
+    ), opponent_info AS (
+        SELECT
+            CONCAT(fighters.first_name, ' ', fighters.last_name) AS opname,
+            fighters.fighter_id AS op_id,
+            fight_id AS fight_id2
+        FROM fighters
+            INNER JOIN fighter_info
+                ON fighter_info.fighter_id != fighters.fighter_id
+                    AND (fighter_info.fighter1_id = fighters.fighter_id OR fighter_info.fighter2_id = fighters.fighter_id)
+    )
+    SELECT
+        *,
+        (SELECT COUNT(*) FROM fighter_info WHERE result = fighter_id) AS wins,
+        (SELECT COUNT(*) FROM fighter_info WHERE fight_id IS NOT NULL AND result IS NULL AND method_of_vic IS NOT NULL) AS draws,
+        (SELECT COUNT(*) FROM fighter_info WHERE result != fighter_id AND result IS NOT NULL AND method_of_vic IS NOT NULL) AS losses
+    FROM fighter_info
+        LEFT JOIN opponent_info
+            ON fight_id = fight_id2
+    LIMIT 5;
+    """
+)
+PREPARED_FIGHTER_INFO = prepared_statements.PreparedQuery("fighter_info", FIGHTER_INFO)
+
+
+def fighter_decision(result, method, fighter_id, opponent_id) -> str:
+    """
+    Describes the outcome of a fight from one fighter's side, e.g. "Win - (KO/TKO)".
+    """
+    if result == opponent_id:
+        return "Loss - (" + method + ")"
+    elif result == fighter_id:
+        return "Win - (" + method + ")"
+    elif result is None and method is not None:
+        return "Draw - (" + method + ")"
+    return "Unknown"
+
+
+def recent_fight(row, fighter_id: int, tables: lookups.Lookups) -> dict:
+    """
+    Builds one of the `recent_fights` of `get_fighter` from a row of `FIGHTER_INFO`.
+    """
+    method = tables.victory_methods.name(row.method_of_vic)
+    return {
+        "fight_id": row.fight_id,
+        "event": row.event_name,
+        "opponent_id": row.op_id,
+        "opponent_name": row.opname.strip(),
+        "result": fighter_decision(row.result, method, fighter_id, row.op_id),
+    }
+
+
 @router.get("/fighters/{id}", tags=["fighters"])
-def get_fighter(id: int):
+@response_cache.cached("fighter:{id}")
+async def get_fighter(id: int):
     """
     This endpoint returns a fighter by their internal id.
     For each fighter it returns:
@@ -42,59 +123,9 @@ def get_fighter(id: int):
     * `opponent_name`: The name of the opponent.
     * `result`: The result of the match, if known, along with the method of victory.
     """
-    fighter_info = sqlalchemy.text(
-        """
-        WITH recent_fights AS (
-            SELECT fight_id, fighter1_id, fighter2_id, class AS weight, result, event_date, event_name, method
-            FROM fights
-                INNER JOIN events ON fights.event_id = events.event_id
-                INNER JOIN weight_classes ON weight_class = weight_classes.id
-                LEFT JOIN victory_methods ON fights.method_of_vic = victory_methods.id
-            ORDER BY DATE(events.event_date) DESC
-        ), fighter_info AS (
-            SELECT
-                fighter_id,
-                CONCAT(first_name, ' ', last_name) AS name,
-                height,
-                reach,
-                stances.stance,
-                fight_id,
-                fighter1_id,
-                fighter2_id,
-                weight,
-                event_name,
-                method,
-                result
-            FROM fighters
-                LEFT JOIN stances ON
-                    fighters.stance_id = stances.id
-                LEFT JOIN recent_fights ON fighter_id = fighter1_id OR fighter_id = fighter2_id
-            WHERE fighter_id = (:id)
-        ), opponent_info AS (
-            SELECT
-                CONCAT(fighters.first_name, ' ', fighters.last_name) AS opname,
-                fighters.fighter_id AS op_id,
-                fight_id AS fight_id2
-            FROM fighters
-                INNER JOIN fighter_info
-                    ON fighter_info.fighter_id != fighters.fighter_id
-                        AND (fighter_info.fighter1_id = fighters.fighter_id OR fighter_info.fighter2_id = fighters.fighter_id)
-        )
-        SELECT
-            *,
-            (SELECT COUNT(*) FROM fighter_info WHERE result = fighter_id) AS wins,
-            (SELECT COUNT(*) FROM fighter_info WHERE fight_id IS NOT NULL AND result IS NULL AND method IS NOT NULL) AS draws,
-            (SELECT COUNT(*) FROM fighter_info WHERE result != fighter_id AND result IS NOT NULL AND method IS NOT NULL) AS losses
-        FROM fighter_info
-            LEFT JOIN opponent_info
-                ON fight_id = fight_id2
-        LIMIT 5;
-        """
-    )
-
-    with db.engine.connect() as conn:
-        result = conn.execute(fighter_info, [{"id": id}])
-        rows = result.fetchall()
+    tables = await lookups.get()
+    async with db.connect() as conn:
+        rows = await PREPARED_FIGHTER_INFO.execute(conn, {"id": id})
         if not rows:
             raise HTTPException(status_code=404, detail="fighter not found")
         
@@ -103,23 +134,8 @@ def get_fighter(id: int):
             if not row.fight_id:
                 # No fights, no point.
                 break
-            if row.result == row.op_id:
-                decision = "Loss - (" + row.method + ")"
-            elif row.result == id:
-                decision = "Win - (" + row.method + ")"
-            elif row.result is None and row.method is not None:
-                decision = "Draw - (" + row.method + ")"
-            elif row.result is None and row.method is None:
-                decision = "Unknown"
-            recent_matches.append(
-                {
-                    "fight_id": row.fight_id,
-                    "event": row.event_name,
-                    "opponent_id": row.op_id,
-                    "opponent_name": row.opname.strip(),
-                    "result": decision,
-                }
-            )
+            response_cache.add_tags("fighter:" + str(row.op_id))
+            recent_matches.append(recent_fight(row, id, tables))
 
         fighter_row = rows[0]
         fighter = {
@@ -127,8 +143,8 @@ def get_fighter(id: int):
             "name": fighter_row.name.strip(),
             "height": fighter_row.height,
             "reach": fighter_row.reach,
-            "stance": fighter_row.stance,
-            "weight": fighter_row.weight,
+            "stance": tables.stances.name(fighter_row.stance_id),
+            "weight": tables.weight_classes.name(fighter_row.weight_class),
             "wins": fighter_row.wins,
             "losses": fighter_row.losses,
             "draws": fighter_row.draws,
@@ -147,8 +163,76 @@ class fighter_order_options(str, Enum):
     ascending = "ascending"
     descending = "descending"
 
+def list_fighters_query(order_by: str):
+    """
+    Returns the `list_fighters` query, sorted by `order_by` such as "name ASC".
+    """
+    return sqlalchemy.text(
+        """
+        WITH windowed AS (
+            SELECT DISTINCT
+                fighter_id,
+                CONCAT(first_name, ' ', last_name) AS name,
+                height,
+                reach,
+                stance_id,
+                COUNT(*) FILTER(WHERE fighter_id = result) OVER (PARTITION BY fighter_id) AS wins,
+                COUNT(*) FILTER(WHERE result IS NULL AND method_of_vic IS NOT NULL) OVER (PARTITION BY fighter_id) AS draws,
+                COUNT(*) FILTER(WHERE result != fighter_id AND RESULT IS NOT NULL AND method_of_vic IS NOT NULL)
+                    OVER (PARTITION BY fighter_id) AS losses
+            FROM fighters
+                LEFT JOIN fights ON fighters.fighter_id = fights.fighter1_id
+                    OR fighters.fighter_id = fights.fighter2_id
+                LEFT JOIN events ON events.event_id = fights.event_id
+            WHERE CONCAT(first_name, ' ', last_name) ILIKE :name
+                AND event_name ILIKE :event
+                AND stance_id = ANY(:stance_ids)
+                AND weight_class = ANY(:weight_class_ids)
+                AND height BETWEEN (:height_min) AND (:height_max)
+                AND reach BETWEEN (:reach_min) AND (:reach_max)
+        )
+        SELECT DISTINCT fighter_id, name, height, reach, stance_id, wins, draws, losses
+        FROM windowed
+        WHERE wins BETWEEN (:wins_min) AND (:wins_max)
+            AND draws BETWEEN (:draws_min) AND (:draws_max)
+            AND losses BETWEEN (:losses_min) AND (:losses_max)
+        ORDER BY 
+        """
+        + order_by
+        + """
+        LIMIT (:limit)
+        OFFSET (:offset);
+        """
+    )
+
+
+# Every sort and order of `list_fighters`, prepared under a name of their own.
+PREPARED_LIST_FIGHTERS = {
+    sort + " " + order: prepared_statements.PreparedQuery(
+        "list_fighters_%s_%s" % (sort, order.lower()), list_fighters_query(sort + " " + order))
+    for sort in ("name", "height", "reach")
+    for order in ("ASC", "DESC")
+}
+
+
+def fighter_summary(row, tables: lookups.Lookups) -> dict:
+    """
+    Builds one fighter of the `list_fighters` response from a row of `list_fighters_query`.
+    """
+    return {
+        "fighter_id": row.fighter_id,
+        "name": row.name.strip(),
+        "height": row.height,
+        "reach": row.reach,
+        "stance": tables.stances.name(row.stance_id),
+        "W/D/L": str(row.wins) + "/" + str(row.draws) + "/" + str(row.losses)
+    }
+
+
 @router.get("/fighters/", tags=["fighters"])
-def list_fighters(
+@response_cache.cached("fighters")
+@query_budget.limit(timeout_ms=2000, max_statements=1)
+async def list_fighters(
     stance: str = "",
     name: str = "",
     height_min: int = Query(0, ge=0, le=999),
@@ -203,6 +287,8 @@ def list_fighters(
     
     The `limit` and `offset` query parameters are used for pagination. `limit` will limit the amount
     of results to return and offset species the number of results to skip before returning the result.
+
+    Searches that take longer than 2 seconds are cancelled with a 504.
     """
     if sort is fighter_sort_options.name:
         order_by = 'name'
@@ -231,89 +317,43 @@ def list_fighters(
     if draws_min > draws_max:
         raise HTTPException(status_code=403, detail="draws_min greater than draws_max")
 
-    fighters = sqlalchemy.text(
-        """
-        WITH windowed AS (
-            SELECT DISTINCT
-                fighter_id,
-                CONCAT(first_name, ' ', last_name) AS name,
-                height,
-                reach,
-                stances.stance AS stance,
-                class AS weight_class,
-                COUNT(*) FILTER(WHERE fighter_id = result) OVER (PARTITION BY fighter_id) AS wins,
-                COUNT(*) FILTER(WHERE result IS NULL AND method_of_vic IS NOT NULL) OVER (PARTITION BY fighter_id) AS draws,
-                COUNT(*) FILTER(WHERE result != fighter_id AND RESULT IS NOT NULL AND method_of_vic IS NOT NULL)
-                    OVER (PARTITION BY fighter_id) AS losses
-            FROM fighters
-                LEFT JOIN stances ON fighters.stance_id = stances.id
-                LEFT JOIN fights ON fighters.fighter_id = fights.fighter1_id
-                    OR fighters.fighter_id = fights.fighter2_id
-                LEFT JOIN events ON events.event_id = fights.event_id
-                LEFT JOIN weight_classes ON fights.weight_class = weight_classes.id
-            WHERE CONCAT(first_name, ' ', last_name) ILIKE :name
-                AND event_name ILIKE :event
-                AND stance ILIKE :stance
-                AND class ILIKE :weight_class
-                AND height BETWEEN (:height_min) AND (:height_max)
-                AND reach BETWEEN (:reach_min) AND (:reach_max)
-        )
-        SELECT DISTINCT fighter_id, name, height, reach, stance, wins, draws, losses
-        FROM windowed
-        WHERE wins BETWEEN (:wins_min) AND (:wins_max)
-            AND draws BETWEEN (:draws_min) AND (:draws_max)
-            AND losses BETWEEN (:losses_min) AND (:losses_max)
-        ORDER BY 
-        """
-        + order_by
-        + """
-        LIMIT (:limit)
-        OFFSET (:offset);
-        """
-    ).bindparams(
-        sqlalchemy.bindparam('name', '%' + name + '%'),
-        sqlalchemy.bindparam('stance', '%' + stance + '%'),
-        sqlalchemy.bindparam('event', '%' + event + '%'),
-        sqlalchemy.bindparam('weight_class', '%' + weight_class + '%'),
-        sqlalchemy.bindparam('height_min', height_min),
-        sqlalchemy.bindparam('height_max', height_max),
-        sqlalchemy.bindparam('reach_min', reach_min),
-        sqlalchemy.bindparam('reach_max', reach_max),
-        sqlalchemy.bindparam('wins_min', wins_min),
-        sqlalchemy.bindparam('wins_max', wins_max),
-        sqlalchemy.bindparam('draws_min', draws_min),
-        sqlalchemy.bindparam('draws_max', draws_max),
-        sqlalchemy.bindparam('losses_min', losses_min),
-        sqlalchemy.bindparam('losses_max', losses_max),
-        sqlalchemy.bindparam('limit', limit),
-        sqlalchemy.bindparam('offset', offset),
-    )
-    with db.engine.connect() as conn:
-        result = conn.execute(fighters)
+    # Stances and weight classes are matched against the lookup tables here, so
+    # the query filters on their ids and needs no joins.
+    tables = await lookups.get()
+    params = {
+        'name': '%' + name + '%',
+        'stance_ids': tables.stances.ids_matching('%' + stance + '%'),
+        'event': '%' + event + '%',
+        'weight_class_ids': tables.weight_classes.ids_matching('%' + weight_class + '%'),
+        'height_min': height_min,
+        'height_max': height_max,
+        'reach_min': reach_min,
+        'reach_max': reach_max,
+        'wins_min': wins_min,
+        'wins_max': wins_max,
+        'draws_min': draws_min,
+        'draws_max': draws_max,
+        'losses_min': losses_min,
+        'losses_max': losses_max,
+        'limit': limit,
+        'offset': offset,
+    }
+    async with db.connect() as conn:
+        rows = await PREPARED_LIST_FIGHTERS[order_by].execute(conn, params)
         json = []
-        for row in result:
-            wdl = str(row.wins) + "/" + str(row.draws) + "/" + str(row.losses)
-            json.append(
-                {
-                    "fighter_id": row.fighter_id,
-                    "name": row.name.strip(),
-                    "height": row.height,
-                    "reach": row.reach,
-                    "stance": row.stance,
-                    "W/D/L": wdl
-                }
-            )
+        for row in rows:
+            json.append(fighter_summary(row, tables))
 
-    return json
+    return FastJSONResponse(json)
 
 
 @router.post("/fighters/", tags=["fighters"])
-def add_fighter(fighter: FighterJson):
+async def add_fighter(fighter: FighterJson):
     """
     This endpoint takes a fighter datatype and adds new data into the database.
     The fighter is represented by their first and last name, their height in inches,
     their reach in inches, and their stance represented by its stance_id
-    (1 = Orthodox, 2 = Southpaw, 3 = Switch).
+    (see `/lookups`, e.g. 1 = Orthodox, 2 = Southpaw, 3 = Switch).
 
     This endpoint ensures that the `stance_id` is either null or a correct enumeration, that
     the `height` and `reach` is within the bounds of 0 to 999. Besides from stance, no other
@@ -325,9 +365,10 @@ def add_fighter(fighter: FighterJson):
 
     The endpoint returns the id of the resulting fighter that was created.
     """
+    tables = await lookups.get()
     if fighter.stance_id is None:
         stance = None
-    elif fighter.stance_id not in [1, 2, 3]:
+    elif fighter.stance_id not in tables.stances:
         raise HTTPException(status_code=400, detail="improper stance given")
     else:
         stance = fighter.stance_id
@@ -354,15 +395,15 @@ def add_fighter(fighter: FighterJson):
         """
     )
 
-    with db.engine.begin() as conn:
-        check = conn.execute(check_duplicate, [{"first_name": fighter.first_name,
-                                                "last_name": fighter.last_name,
-                                                "height": fighter.height,
-                                                "reach": fighter.reach,
-                                                "stance": stance}])
+    async with db.begin() as conn:
+        check = await conn.execute(check_duplicate, [{"first_name": fighter.first_name,
+                                                      "last_name": fighter.last_name,
+                                                      "height": fighter.height,
+                                                      "reach": fighter.reach,
+                                                      "stance": stance}])
         if check.first() is not None:
             raise HTTPException(status_code=409, detail="duplicate data given")
-        result = conn.execute(
+        result = await conn.execute(
             sqlalchemy.insert(db.fighters)
             .values(first_name=fighter.first_name,
                     last_name=fighter.last_name,
@@ -371,11 +412,12 @@ def add_fighter(fighter: FighterJson):
                     stance_id=stance)
         )
 
+    await response_cache.purge("fighters")
     return {"fighter_id": result.inserted_primary_key[0]}
 
 
 @router.put("/fighters/{fighter_id}", tags=["fighters"])
-def update_fighter(fighter_id: int, fighter: FighterJson):
+async def update_fighter(fighter_id: int, fighter: FighterJson):
     """
     This endpoint takes a `fighter_id` and a fighter model to update the data
     of the `fighter_id` in the database.
@@ -383,8 +425,7 @@ def update_fighter(fighter_id: int, fighter: FighterJson):
     Partial updates are possible by simply not providing values to update.
 
     No data value should be given as null. Additionally,`stance_id` is 
-    enforced to still be between 1-3, representing Orthodox, Southpaw,
-    or Switch respectively.
+    enforced to still be one of the stances in `/lookups`.
 
     Upon success, this endpoint returns the newly modified model.
     """
@@ -398,11 +439,12 @@ def update_fighter(fighter_id: int, fighter: FighterJson):
         )
         .where(db.fighters.c.fighter_id == fighter_id)
     )
-    if fighter.stance_id is not None and (fighter.stance_id < 1 or fighter.stance_id > 3):
-        raise HTTPException(status_code=400, detail='stance_id must be between 1 and 3 or left as null')
+    tables = await lookups.get()
+    if fighter.stance_id is not None and fighter.stance_id not in tables.stances:
+        raise HTTPException(status_code=400, detail='stance_id must be a known stance or left as null')
 
-    with db.engine.connect() as conn:
-        result = conn.execute(stored_fighter_data)
+    async with db.connect() as conn:
+        result = await conn.execute(stored_fighter_data)
         results = result.fetchall()
         if results is None:
             raise HTTPException(status_code=404, detail='fighter does not exist')
@@ -410,12 +452,13 @@ def update_fighter(fighter_id: int, fighter: FighterJson):
             stored_fighter_model = FighterJson(**row._mapping)
             update_data = fighter.dict(exclude_unset=True)
             updated_fighter = stored_fighter_model.copy(update=update_data)
-            result = conn.execute(
+            result = await conn.execute(
                 sqlalchemy.update(db.fighters)
                 .where(db.fighters.c.fighter_id == fighter_id)
                 .values(updated_fighter.dict())
             )
-            conn.commit()
+            await conn.commit()
             break
 
+    await response_cache.purge("fighter:" + str(fighter_id), "fighters", "fights")
     return updated_fighter
\ No newline at end of file
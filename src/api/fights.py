@@ -1,5 +1,7 @@
 from fastapi import APIRouter, HTTPException
 from src import database as db
+from src import lookups
+from src import response_cache
 import sqlalchemy
 from typing import Optional
 from sqlalchemy import and_, or_
@@ -24,8 +26,8 @@ class FightJson(BaseModel):
     round_num: int = Field(default=1, ge=1, le=5, alias='round_num')
     round_time: str = Field(default="0:00", alias='round_time')
     result: Optional[int] = Field(default=None, alias='result')
-    method_of_vic: Optional[int] = Field(default=None, ge=1, le=7, alias='method_of_vic')
-    weight_class: int = Field(default=0, ge=1, le=14, alias='weight_class')
+    method_of_vic: Optional[int] = Field(default=None, alias='method_of_vic')
+    weight_class: int = Field(default=0, alias='weight_class')
 
 
 class FighterStatsJson(BaseModel):
@@ -39,28 +41,11 @@ class FighterStatsJson(BaseModel):
 router = APIRouter()
 
 
-@router.get("/fights/{fight_id}", tags = ["fights"])
-def get_fight(fight_id: int):
+def fight_query(fight_id: int):
     """
-    Takes in a `fight_id` and returns data associated with that internal id.
-    For each fight it returns:
-
-    * `event_name`: The name of the event the fight took place at.
-    * `event_date`: The date of the event the fight took place at.
-    * `fighter1`: The name of the first fighter.
-    * `fighter2`: The name of the second fighter.
-    * `weight_class`: The weight class of the fight.
-    * `result`: The result and decision of the match.
-    * `round`: The round the match ended on.
-    * `round_time`: The time the round ended, given in "M:S".
-    * `kd`: Given in X-X format, the left representing the knockdowns by fighter1, the right by fighter2.
-    * `strikes`: Given in X-X format, the left representing the strikes landed by fighter1, the right by fighter2.
-    * `td`: Given in X-X format, the left representing the takedowns by fighter1, the right by fighter2.
-    * `sub`: Given in X-X format, the left representing the submission attempts by fighter1, the right by fighter2.
-
-    Should the `fight_id` fail to be found, will raise an error.
+    Returns the `get_fight` query, one row per fighter in the fight.
     """
-    fight = (
+    return (
         sqlalchemy.select(
             db.fights.c.fight_id,
             db.events.c.event_name,
@@ -68,9 +53,9 @@ def get_fight(fight_id: int):
             db.fighters.c.fighter_id,
             db.fights.c.fighter1_id,
             sqlalchemy.label('full_name', db.fighters.c.first_name + ' ' + db.fighters.c.last_name),
-            sqlalchemy.column('class'),
+            db.fights.c.weight_class,
             db.fights.c.result,
-            db.victory_methods.c.method,
+            db.fights.c.method_of_vic,
             db.fights.c.round_num,
             db.fights.c.round_time,
             db.fighter_stats.c.kd,
@@ -83,13 +68,6 @@ def get_fight(fight_id: int):
             db.fighters,
             or_(db.fights.c.fighter1_id == db.fighters.c.fighter_id,
                 db.fights.c.fighter2_id == db.fighters.c.fighter_id)
-        ).join(
-            db.victory_methods,
-            db.fights.c.method_of_vic == db.victory_methods.c.id,
-            isouter=True
-        ).join(
-            db.weight_classes,
-            db.fights.c.weight_class == db.weight_classes.c.id
         ).join(
             db.fighter_stats,
             and_(
@@ -104,48 +82,126 @@ def get_fight(fight_id: int):
         )
     )
 
-    with db.engine.connect() as conn:
-        result = conn.execute(fight).fetchall()
+
+def fight_decision(result, method, fighter1_id, fighter1, fighter2) -> str:
+    """
+    Describes the outcome of a fight, e.g. "Win - Jon Jones - (KO/TKO)".
+    """
+    if result == fighter1_id:
+        return "Win - " + fighter1 + " - (" + method + ")"
+    elif result is not None:
+        return "Win - " + fighter2 + " - (" + method + ")"
+    elif method is not None:
+        return "Draw - (" + method + ")"
+    return "Unknown"
+
+
+def fight_details(rows, tables: lookups.Lookups) -> dict:
+    """
+    Builds the `get_fight` response from the rows of `fight_query`.
+    """
+    for row in rows:
+        if row.fighter_id == row.fighter1_id:
+            fighter1 = row.full_name
+            stats1 = [row.kd, row.strikes, row.td, row.sub]
+        else:
+            fighter2 = row.full_name
+            stats2 = [row.kd, row.strikes, row.td, row.sub]
+
+    row = rows[0]
+    return {
+        'event_name': row.event_name,
+        'event_date': row.event_date,
+        'fighter1': fighter1,
+        'fighter2': fighter2,
+        'weight_class': tables.weight_classes.name(row.weight_class),
+        'result': fight_decision(row.result, tables.victory_methods.name(row.method_of_vic),
+                                 row.fighter1_id, fighter1, fighter2),
+        'round': row.round_num,
+        'round_time': row.round_time,
+        'kd': str(stats1[0]) + '-' + str(stats2[0]),
+        'strikes': str(stats1[1]) + '-' + str(stats2[1]),
+        'td': str(stats1[2]) + '-' + str(stats2[2]),
+        'sub': str(stats1[3]) + '-' + str(stats2[3]),
+    }
+
+
+@router.get("/fights/{fight_id}", tags = ["fights"])
+@response_cache.cached("fight:{fight_id}")
+async def get_fight(fight_id: int):
+    """
+    Takes in a `fight_id` and returns data associated with that internal id.
+    For each fight it returns:
+
+    * `event_name`: The name of the event the fight took place at.
+    * `event_date`: The date of the event the fight took place at.
+    * `fighter1`: The name of the first fighter.
+    * `fighter2`: The name of the second fighter.
+    * `weight_class`: The weight class of the fight.
+    * `result`: The result and decision of the match.
+    * `round`: The round the match ended on.
+    * `round_time`: The time the round ended, given in "M:S".
+    * `kd`: Given in X-X format, the left representing the knockdowns by fighter1, the right by fighter2.
+    * `strikes`: Given in X-X format, the left representing the strikes landed by fighter1, the right by fighter2.
+    * `td`: Given in X-X format, the left representing the takedowns by fighter1, the right by fighter2.
+    * `sub`: Given in X-X format, the left representing the submission attempts by fighter1, the right by fighter2.
+
+    Should the `fight_id` fail to be found, will raise an error.
+    """
+    tables = await lookups.get()
+    async with db.connect() as conn:
+        result = (await conn.execute(fight_query(fight_id))).fetchall()
         if not result:
             raise HTTPException(status_code=404, detail='fight not found')
 
         for row in result:
-            if row.fighter_id == row.fighter1_id:
-                fighter1 = row.full_name
-                stats1 = [row.kd, row.strikes, row.td, row.sub]
-            else:
-                fighter2 = row.full_name
-                stats2 = [row.kd, row.strikes, row.td, row.sub]
-
-        row = result[0]
-        if row.result == row.fighter1_id:
-            decision = "Win - " + fighter1 + " - (" + row.method + ")"
-        elif row.result is not None:
-            decision = "Win - " + fighter2 + " - (" + row.method + ")"
-        elif row.result is None and row.method is not None:
-            decision = "Draw - (" + row.method + ")"
-        elif row.result is None and row.method is None:
-            decision = "Unknown"
-        
-        json = {
-            'event_name': row.event_name,
-            'event_date': row.event_date,
-            'fighter1': fighter1,
-            'fighter2': fighter2,
-            'weight_class': row.__getattribute__('class'),
-            'result': decision,
-            'round': row.round_num,
-            'round_time': row.round_time,
-            'kd': str(stats1[0]) + '-' + str(stats2[0]),
-            'strikes': str(stats1[1]) + '-' + str(stats2[1]),
-            'td': str(stats1[2]) + '-' + str(stats2[2]),
-            'sub': str(stats1[3]) + '-' + str(stats2[3]),
-        }
+            response_cache.add_tags("fighter:" + str(row.fighter_id))
+        json = fight_details(result, tables)
 
     return json
 
+# Checks that the event and both fighters exist, then inserts both fighters'
+# stats and the fight, all in one round trip. Nothing is inserted when a check
+# fails.
+ADD_FIGHT = sqlalchemy.text(
+    """
+    WITH event AS (
+        SELECT event_id FROM events WHERE event_id = (:event_id)
+    ), found AS (
+        SELECT COUNT(*) AS fighters FROM fighters WHERE fighter_id IN (:fighter1_id, :fighter2_id)
+    ), valid AS (
+        SELECT 1 FROM event, found WHERE found.fighters = 2
+    ), stats1 AS (
+        INSERT INTO fighter_stats (kd, strikes, td, sub, fighter_id)
+        SELECT CAST(:kd1 AS integer), CAST(:strikes1 AS integer), CAST(:td1 AS integer),
+            CAST(:sub1 AS integer), CAST(:fighter1_id AS integer)
+        FROM valid
+        RETURNING stats_id
+    ), stats2 AS (
+        INSERT INTO fighter_stats (kd, strikes, td, sub, fighter_id)
+        SELECT CAST(:kd2 AS integer), CAST(:strikes2 AS integer), CAST(:td2 AS integer),
+            CAST(:sub2 AS integer), CAST(:fighter2_id AS integer)
+        FROM valid
+        RETURNING stats_id
+    ), fight AS (
+        INSERT INTO fights (event_id, fighter1_id, fighter2_id, round_num, round_time, result,
+                            method_of_vic, weight_class, stats1_id, stats2_id)
+        SELECT CAST(:event_id AS integer), CAST(:fighter1_id AS integer), CAST(:fighter2_id AS integer),
+            CAST(:round_num AS integer), CAST(:round_time AS text), CAST(:result AS integer),
+            CAST(:method_of_vic AS integer), CAST(:weight_class AS integer), stats1.stats_id, stats2.stats_id
+        FROM stats1, stats2
+        RETURNING fight_id
+    )
+    SELECT
+        EXISTS (SELECT 1 FROM event) AS event_found,
+        (SELECT fighters FROM found) AS fighters_found,
+        (SELECT fight_id FROM fight) AS fight_id
+    """
+)
+
+
 @router.post("/fights", tags = ["fights"])
-def post_fight(fight: FightJson, stats1: FighterStatsJson, stats2: FighterStatsJson):
+async def post_fight(fight: FightJson, stats1: FighterStatsJson, stats2: FighterStatsJson):
     """
     This endpoint takes in a `fight` model and two related `fighter_stats` model.
     It first adds the two `fighter_stats` data and then adds the `fight` data. The
@@ -164,32 +220,9 @@ def post_fight(fight: FightJson, stats1: FighterStatsJson, stats2: FighterStatsJ
     `result` should be either null or one of the `fighter_id`s given. A null `result` and 
     non-null `method_of_vic` indicates a draw, both being null would indicate an unknown result
     (usually an overturned one).
-    Consequently, `method_of_vic` is either null or an enumeration between 1-7 representing:
-
-    * `1`: 'SUB'
-    * `2`: 'KO/TKO'
-    * `3`: 'S-Dec'
-    * `4`: 'M-Dec'
-    * `5`: 'U-Dec'
-    * `6`: 'CNC'
-    * `7`: 'DQ'
-
-    Similarly, it ensures that `weight_class` is an enumeration between 1-14 representing:
-
-    * `1`: 'Flyweight'
-    * `2`: 'Bantamweight'
-    * `3`: 'Featherweight'
-    * `4`: 'Lightweight'
-    * `5`: 'Welterweigt'
-    * `6`: 'Middleweigt'
-    * `7`: 'Light Heavyweight'
-    * `8`: 'Heavyweight'
-    * `9`: 'Women's Strawweight'
-    * `10`: 'Women's Flyweight'
-    * `11`: 'Women's Bantamweight'
-    * `12`: 'Women's Featherweight'
-    * `13`: 'Catch Weight'
-    * `14`: 'Open Weight'
+    Consequently, `method_of_vic` is either null or the id of one of the `victory_methods`
+    listed by `/lookups`, such as `2` for 'KO/TKO'. Similarly, it ensures that `weight_class`
+    is the id of one of the `weight_classes` listed there, such as `4` for 'Lightweight'.
 
     The two `fighter_stats` models takes in keys in the format:
 
@@ -222,51 +255,32 @@ def post_fight(fight: FightJson, stats1: FighterStatsJson, stats2: FighterStatsJ
     if fight.result != None:
         if fight.result != fight.fighter1_id and fight.result != fight.fighter2_id:
             raise HTTPException(status_code=400, detail='result must be null or either the id of one of the fighters')
+
+    tables = await lookups.get()
+    if fight.method_of_vic is not None and fight.method_of_vic not in tables.victory_methods:
+        raise HTTPException(status_code=400, detail='method_of_vic must be null or a known victory method')
+    if fight.weight_class not in tables.weight_classes:
+        raise HTTPException(status_code=400, detail='weight_class must be a known weight class')
     
-    with db.engine.begin() as conn:
-        check = conn.execute(
-            sqlalchemy.select(db.events.c.event_id).
-            where(db.events.c.event_id == fight.event_id)
-        ).fetchall()
-        if not check:
+    params = {
+        'event_id': fight.event_id,
+        'fighter1_id': fight.fighter1_id,
+        'fighter2_id': fight.fighter2_id,
+        'round_num': fight.round_num,
+        'round_time': fight.round_time,
+        'result': fight.result,
+        'method_of_vic': fight.method_of_vic,
+        'weight_class': fight.weight_class,
+        'kd1': stats1.kd, 'strikes1': stats1.strikes, 'td1': stats1.td, 'sub1': stats1.sub,
+        'kd2': stats2.kd, 'strikes2': stats2.strikes, 'td2': stats2.td, 'sub2': stats2.sub,
+    }
+    async with db.begin() as conn:
+        row = (await conn.execute(ADD_FIGHT, [params])).one()
+        if not row.event_found:
             raise HTTPException(status_code=404, detail='event not found')
-
-        check = conn.execute(
-            sqlalchemy.select(db.fighters.c.fighter_id).
-            where((db.fighters.c.fighter_id == stats2.fighter_id)
-                  | (db.fighters.c.fighter_id == stats1.fighter_id))
-        ).fetchall()
-        if len(check) != 2:
+        if row.fighters_found != 2:
             raise HTTPException(status_code=404, detail='a given fighter_id was not found')
-        
-        result = conn.execute(
-            sqlalchemy.insert(db.fighter_stats).
-            values(kd=stats1.kd, strikes=stats1.strikes, td=stats1.td,
-                   sub=stats1.sub, fighter_id=stats1.fighter_id)
-        )
-        stats1_id = result.inserted_primary_key[0]
-
-        result = conn.execute(
-            sqlalchemy.insert(db.fighter_stats).
-            values(kd=stats2.kd, strikes=stats2.strikes, td=stats2.td,
-                   sub=stats2.sub, fighter_id=stats2.fighter_id)
-        )
-        stats2_id = result.inserted_primary_key[0]
-
-        result = conn.execute(
-            sqlalchemy.insert(db.fights).
-            values(
-                event_id = fight.event_id,
-                fighter1_id = fight.fighter1_id,
-                fighter2_id = fight.fighter2_id,
-                round_num = fight.round_num,
-                round_time = fight.round_time,
-                result = fight.result,
-                method_of_vic = fight.method_of_vic,
-                weight_class = fight.weight_class,
-                stats1_id = stats1_id,
-                stats2_id = stats2_id,
-            )
-        )
 
-    return {'fight_id': result.inserted_primary_key[0]}
+    await response_cache.purge("fighter:" + str(fight.fighter1_id), "fighter:" + str(fight.fighter2_id),
+                               "event:" + str(fight.event_id), "fighters", "fights")
+    return {'fight_id': row.fight_id}
@@ -0,0 +1,125 @@
+"""
+Liveness and readiness probes for load balancers and orchestrators.
+
+`/healthz` answers as long as the worker's event loop does, without any IO.
+`/readyz` times a `SELECT 1` through the primary's pool and looks at how many of
+the pools' connections are checked out. It answers 503, so traffic is routed to
+other workers, while the probe is slower than `READY_MAX_DB_LATENCY_MS`, fails
+or times out, while a pool has more than `READY_MAX_POOL_SATURATION` of its
+connections checked out, and once the worker has been told to stop (`main.py`
+calls `start_draining` on SIGTERM).
+"""
+import asyncio
+import time
+
+import sqlalchemy
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from sqlalchemy.pool import QueuePool
+
+from src import config
+from src import database as db
+from src import pool_metrics
+from src import query_budget
+
+MAX_DB_LATENCY_MS = config.get_float("READY_MAX_DB_LATENCY_MS", 250)
+MAX_POOL_SATURATION = config.get_float("READY_MAX_POOL_SATURATION", 0.9)
+# A probe stuck waiting for a connection gives up after this long.
+PROBE_TIMEOUT_SECONDS = config.get_float("READY_PROBE_TIMEOUT_SECONDS", 2)
+
+router = APIRouter()
+
+_shutting_down = False
+
+
+def start_draining() -> bool:
+    """
+    Makes `/readyz` answer 503 from now on. Returns False if it already did.
+    """
+    global _shutting_down
+    started, _shutting_down = not _shutting_down, True
+    return started
+
+
+def pool_saturation() -> dict:
+    """
+    Returns, for each pool with a size limit, its checked out connections,
+    capacity (size plus overflow) and the fraction of it in use.
+    """
+    pools = {}
+    for name, pool_stats in pool_metrics.stats.items():
+        pool = pool_stats.pool
+        if not isinstance(pool, QueuePool) or pool._max_overflow < 0:
+            continue
+        capacity = pool.size() + pool._max_overflow
+        pools[name] = {
+            "checked_out": pool.checkedout(),
+            "capacity": capacity,
+            "saturation": pool.checkedout() / capacity if capacity else 1.0,
+        }
+    return pools
+
+
+async def _select_one():
+    # Readiness is about the primary, whatever reads are routed to.
+    token = db.route_reads_to_replica(False)
+    try:
+        async with db.connect() as conn:
+            await conn.execute(sqlalchemy.text("SELECT 1"))
+    finally:
+        db.reset_read_routing(token)
+
+
+@router.get("/healthz", tags=["health"])
+async def get_health():
+    """
+    This endpoint tells whether the worker is alive. It does not touch the database.
+    """
+    return {"status": "ok"}
+
+
+@router.get("/readyz", tags=["health"])
+@query_budget.limit(timeout_ms=int(PROBE_TIMEOUT_SECONDS * 1000))
+async def get_readiness():
+    """
+    This endpoint tells whether the worker should be sent traffic, answering
+    200 when it should and 503 when it should not.
+
+    Returns a dictionary with keys:
+    * `ready`: Whether the worker is ready.
+    * `reasons`: Why it is not ready, empty when it is.
+    * `database_ms`: How long a `SELECT 1` on the primary took, or null if it failed.
+    * `pools`: For each pool with a size limit:
+        * `checked_out`: Connections in use.
+        * `capacity`: The most connections the pool opens.
+        * `saturation`: `checked_out` divided by `capacity`.
+    """
+    reasons = []
+    if _shutting_down:
+        reasons.append("shutting down")
+
+    # Before the probe takes a connection of its own.
+    pools = pool_saturation()
+    for name, pool in pools.items():
+        if pool["saturation"] > MAX_POOL_SATURATION:
+            reasons.append("%s pool %.0f%% checked out" % (name, pool["saturation"] * 100))
+
+    database_ms = None
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(_select_one(), PROBE_TIMEOUT_SECONDS)
+        database_ms = (time.perf_counter() - started) * 1000
+    except asyncio.TimeoutError:
+        reasons.append("database probe timed out after %gs" % PROBE_TIMEOUT_SECONDS)
+    except (sqlalchemy.exc.SQLAlchemyError, OSError) as e:
+        reasons.append("database probe failed: %s" % type(e).__name__)
+    if database_ms is not None and database_ms > MAX_DB_LATENCY_MS:
+        reasons.append("database took %.1f ms" % database_ms)
+
+    json = {
+        "ready": not reasons,
+        "reasons": reasons,
+        "database_ms": database_ms,
+        "pools": pools,
+    }
+    return JSONResponse(json, status_code=503 if reasons else 200)
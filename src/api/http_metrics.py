@@ -0,0 +1,196 @@
+"""
+Per-route request metrics in the Prometheus text format, served at `/metrics`.
+
+Requests are counted per method, route template and status, with a latency
+histogram per method and route template and an in-flight gauge per method.
+Recording a request is a few dictionary updates on the event loop thread, no
+locks or IO.
+
+Every worker process keeps its own numbers. With `METRICS_MULTIPROC_DIR` set,
+each worker also writes them to a file in that directory every
+`METRICS_FLUSH_SECONDS`, and `/metrics` adds up the files of every worker, so
+any worker can answer a scrape for the whole deployment. Counters of workers
+that exited are kept, their in-flight gauges are not.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+
+from src import config
+from src.api.route_templates import RouteTemplates
+
+ENABLED = config.get_bool("HTTP_METRICS_ENABLED", True)
+MULTIPROC_DIR = config.get_str("METRICS_MULTIPROC_DIR")
+FLUSH_SECONDS = config.get_float("METRICS_FLUSH_SECONDS", 5)
+
+# Upper bounds, in seconds, of the latency histogram buckets. The last bucket is +Inf.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Only ever mutated on the event loop thread. Readers copy them first.
+_requests = {}  # (method, route, status) -> count
+_durations = {}  # (method, route) -> [bucket counts..., +Inf count, sum]
+_in_flight = {}  # method -> requests currently being handled
+
+_flusher = None
+
+
+def observe(method: str, route: str, status: int, seconds: float):
+    key = (method, route, status)
+    _requests[key] = _requests.get(key, 0) + 1
+    histogram = _durations.get((method, route))
+    if histogram is None:
+        histogram = _durations[(method, route)] = [0] * (len(BUCKETS) + 2)
+    histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+    histogram[-1] += seconds
+
+
+def snapshot() -> dict:
+    return {
+        "pid": os.getpid(),
+        "requests": [[*key, count] for key, count in dict(_requests).items()],
+        "durations": [[*key, list(histogram)] for key, histogram in dict(_durations).items()],
+        "in_flight": dict(_in_flight),
+    }
+
+
+def _path(pid: int) -> str:
+    return os.path.join(MULTIPROC_DIR, "http-metrics-%d.json" % pid)
+
+
+def flush():
+    """
+    Writes this worker's metrics to the shared directory.
+    """
+    path = _path(os.getpid())
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+def _start_flusher():
+    global _flusher
+    if _flusher is None:
+        os.makedirs(MULTIPROC_DIR, exist_ok=True)
+        _flusher = threading.Thread(target=_flush_periodically, name="http-metrics-flush", daemon=True)
+        _flusher.start()
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _snapshots() -> list:
+    snapshots = [snapshot()]
+    if not MULTIPROC_DIR or not os.path.isdir(MULTIPROC_DIR):
+        return snapshots
+    for name in os.listdir(MULTIPROC_DIR):
+        if not name.startswith("http-metrics-") or not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(MULTIPROC_DIR, name)) as f:
+                other = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if other["pid"] == os.getpid():
+            continue
+        if not _alive(other["pid"]):
+            other["in_flight"] = {}
+        snapshots.append(other)
+    return snapshots
+
+
+def _labels(**labels) -> str:
+    return ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+
+
+def render() -> str:
+    """
+    Returns the metrics of every worker in the Prometheus text exposition format.
+    """
+    requests = {}
+    durations = {}
+    in_flight = {}
+    for other in _snapshots():
+        for method, route, status, count in other["requests"]:
+            requests[(method, route, status)] = requests.get((method, route, status), 0) + count
+        for method, route, histogram in other["durations"]:
+            total = durations.setdefault((method, route), [0] * (len(BUCKETS) + 2))
+            for i, value in enumerate(histogram):
+                total[i] += value
+        for method, count in other["in_flight"].items():
+            in_flight[method] = in_flight.get(method, 0) + count
+
+    lines = [
+        "# HELP http_requests_total Requests handled, by method, route template and status.",
+        "# TYPE http_requests_total counter",
+    ]
+    for (method, route, status), count in sorted(requests.items()):
+        lines.append("http_requests_total{%s} %d" % (_labels(method=method, route=route, status=status), count))
+
+    lines.append("# HELP http_request_duration_seconds Time to handle a request, by method and route template.")
+    lines.append("# TYPE http_request_duration_seconds histogram")
+    for (method, route), histogram in sorted(durations.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), histogram):
+            cumulative += count
+            lines.append("http_request_duration_seconds_bucket{%s} %d"
+                         % (_labels(method=method, route=route, le=bound), cumulative))
+        labels = _labels(method=method, route=route)
+        lines.append("http_request_duration_seconds_sum{%s} %r" % (labels, histogram[-1]))
+        lines.append("http_request_duration_seconds_count{%s} %d" % (labels, cumulative))
+
+    lines.append("# HELP http_requests_in_flight Requests currently being handled, by method.")
+    lines.append("# TYPE http_requests_in_flight gauge")
+    for method, count in sorted(in_flight.items()):
+        lines.append("http_requests_in_flight{%s} %d" % (_labels(method=method), count))
+    return "\n".join(lines) + "\n"
+
+
+class HttpMetricsMiddleware:
+    def __init__(self, app, routes):
+        self.app = app
+        self.route_template = RouteTemplates(routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if MULTIPROC_DIR and _flusher is None:
+            _start_flusher()
+
+        method = scope["method"]
+        status = 500
+
+        async def record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        _in_flight[method] = _in_flight.get(method, 0) + 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, record_status)
+        finally:
+            observe(method, self.route_template(scope), status, time.perf_counter() - started)
+            _in_flight[method] -= 1
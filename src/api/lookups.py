@@ -0,0 +1,50 @@
+import hmac
+from typing import Optional
+
+import sqlalchemy
+from fastapi import APIRouter, HTTPException, Header
+
+from src import config
+from src import lookups
+
+
+router = APIRouter()
+
+
+@router.on_event("startup")
+async def load_lookups():
+    # Without a database at startup the tables are loaded on first use instead.
+    try:
+        await lookups.refresh()
+    except (sqlalchemy.exc.DBAPIError, OSError):
+        pass
+
+
+@router.get("/lookups", tags=["lookups"])
+async def get_lookups():
+    """
+    This endpoint returns the enumerations the API decodes ids with, each as a
+    dictionary from id to name:
+    * `stances`: The `stance_id`s of fighters.
+    * `weight_classes`: The `weight_class`es of fights.
+    * `victory_methods`: The `method_of_vic`s of fights.
+    """
+    return (await lookups.get()).to_json()
+
+
+@router.post("/lookups/refresh", tags=["lookups"])
+async def refresh_lookups(x_admin_token: Optional[str] = Header(default=None)):
+    """
+    This admin endpoint reloads the enumerations from the database, for after
+    they have been changed by hand. Cached responses keep the old names until
+    they expire.
+
+    Requires the `X-Admin-Token` header to match the server's `ADMIN_TOKEN`.
+
+    Returns the reloaded enumerations, like `/lookups`.
+    """
+    admin_token = config.get_str("ADMIN_TOKEN")
+    if not admin_token or not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), admin_token.encode()):
+        raise HTTPException(status_code=403, detail='admin token required')
+
+    return (await lookups.refresh()).to_json()
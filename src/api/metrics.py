@@ -0,0 +1,190 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from src import database as db
+from src import login_throttle
+from src import pool_metrics
+from src import prediction_buffer
+from src import prepared_statements
+from src import query_budget
+from src import response_cache
+from src import sql_metrics
+from src.api import compression
+from src.api import http_metrics
+from src.api import serverless
+
+
+router = APIRouter()
+
+
+@router.get("/metrics", tags=["metrics"], response_class=PlainTextResponse)
+def get_http_metrics():
+    """
+    This endpoint returns request metrics in the Prometheus text format:
+    * `http_requests_total`: Requests handled, by `method`, `route` template and `status`.
+    * `http_request_duration_seconds`: Latency histogram, by `method` and `route` template.
+    * `http_requests_in_flight`: Requests currently being handled, by `method`.
+
+    With `METRICS_MULTIPROC_DIR` set, the numbers cover every worker.
+    """
+    return http_metrics.render()
+
+
+@router.get("/metrics/predictions", tags=["metrics"])
+def get_prediction_buffer_metrics():
+    """
+    This endpoint reports on the buffered prediction ingestion queue.
+
+    Returns a dictionary with keys:
+    * `enabled`: Whether buffered ingestion is turned on. No other keys are given if it is off.
+    * `queue_depth`: The number of predictions waiting to be flushed.
+    * `batches`: The number of batches flushed so far.
+    * `rows_accepted`: The number of predictions inserted.
+    * `rows_duplicate`: The number of predictions dropped because the user already predicted the fight.
+    * `rows_failed`: The number of predictions in batches that failed to insert.
+    * `rows_per_second`: Average ingestion throughput since the buffer started.
+    * `flush_latency_ms_last`, `flush_latency_ms_avg`, `flush_latency_ms_max`: Time spent in the batch insert.
+    """
+    return prediction_buffer.stats()
+
+
+@router.get("/metrics/login-throttle", tags=["metrics"])
+def get_login_throttle_metrics():
+    """
+    This endpoint reports on failed-login throttling.
+
+    Returns a dictionary with keys:
+    * `backend`: Either "memory" (per process) or "postgres" (shared by all workers).
+    * `checks`: The number of password checks that went through the throttle.
+    * `rejected`: The number of attempts rejected because of a lockout.
+    * `failures`: The number of failed password checks.
+    * `lockouts`: The number of times a username or client got locked out.
+    * `tracked_keys`: The number of usernames and clients currently being tracked.
+    """
+    return login_throttle.stats()
+
+
+@router.get("/metrics/pool", tags=["metrics"])
+async def get_pool_metrics():
+    """
+    This endpoint reports on the database connection pools, keyed by engine
+    ("sync" and, when enabled, "async", plus "read_sync" and "read_async" for
+    the read replica).
+
+    For each pool it returns:
+    * `pool`: The pool implementation in use.
+    * `size`: The configured number of pooled connections.
+    * `checked_out`: Connections currently in use.
+    * `checked_in`: Idle connections in the pool.
+    * `overflow`: Connections opened beyond `size`.
+    * `timeout`: Seconds a checkout waits before timing out.
+    * `checkouts`, `checkins`, `connects`, `invalidations`: Event counts since startup.
+    * `checkout_timeouts`: Checkouts that gave up waiting for a connection.
+    * `wait_seconds_sum`, `wait_seconds_count`: Total time spent waiting for checkouts.
+    * `wait_seconds_buckets`: Cumulative histogram of checkout wait times, keyed by upper bound in seconds.
+
+    `size`, `checked_out`, `checked_in`, `overflow` and `timeout` are left out when pooling is disabled.
+
+    With a read replica configured, `replica_fallbacks` counts the reads that went
+    to the primary because the replica could not be reached.
+    """
+    json = pool_metrics.snapshot()
+    if db.read_engine is not None:
+        json["replica_fallbacks"] = db.replica_fallbacks
+    return json
+
+
+@router.get("/metrics/cache", tags=["metrics"])
+async def get_response_cache_metrics():
+    """
+    This endpoint reports on the response cache.
+
+    Returns a dictionary with keys:
+    * `enabled`: Whether the response cache is turned on. No other keys are given if it is off.
+    * `backend`: Either "memory" (per process) or "sqlite" (shared by all workers).
+    * `hits`: Responses served from the cache.
+    * `misses`: Responses that had to run the endpoint.
+    * `collapsed`: Hits that waited on an identical request already running the endpoint.
+    * `hit_ratio`: `hits` out of all lookups.
+    * `stores`: Responses added to the cache.
+    * `purges`: Invalidations made by write endpoints.
+    * `purged_entries`: Cached responses dropped by those invalidations.
+    * `entries`: Responses currently cached.
+    * `evictions`: Responses dropped to stay within the size limit.
+    """
+    return await response_cache._call(response_cache.stats)
+
+
+@router.get("/metrics/compression", tags=["metrics"])
+async def get_compression_metrics():
+    """
+    This endpoint reports on response compression.
+
+    Returns a dictionary with keys:
+    * `enabled`: Whether responses are compressed.
+    * `encodings`: The available encodings, most preferred first.
+    * `routes`: For each route template, keyed by encoding:
+        * `responses`: The number of compressed responses.
+        * `bytes_in`, `bytes_out`: Total size before and after compression.
+        * `ratio`: `bytes_in` divided by `bytes_out`.
+        * `cpu_ms_total`: CPU time spent compressing.
+        * `cpu_us_per_kb`: CPU time per uncompressed kilobyte.
+    """
+    return compression.stats()
+
+
+@router.get("/metrics/sql", tags=["metrics"])
+async def get_sql_metrics():
+    """
+    This endpoint reports on the SQL statements run by each route.
+
+    Returns a dictionary with keys:
+    * `slow_query_ms`: Statements taking at least this long are logged as slow queries.
+    * `slow_queries`: The number of slow queries logged.
+    * `routes`: For each route template:
+        * `requests`: The number of requests handled.
+        * `statements`, `statements_per_request`, `statements_max`: Statements run.
+        * `db_ms_total`, `db_ms_per_request`: Time spent executing them.
+    """
+    return sql_metrics.stats()
+
+
+@router.get("/metrics/query-budget", tags=["metrics"])
+async def get_query_budget_metrics():
+    """
+    This endpoint reports on statement timeouts and statement budgets.
+
+    Returns a dictionary with keys:
+    * `statement_timeout_ms`: The default statement timeout of a route. 0 means none.
+    * `max_statements`: The default number of statements a request may run. 0 means no limit.
+    * `routes`: For each route template with violations:
+        * `statement_timeout`: Requests answered with a 504 because a statement timed out.
+        * `statement_budget`: Requests answered with a 503 because they ran too many statements.
+    """
+    return query_budget.stats()
+
+
+@router.get("/metrics/prepared", tags=["metrics"])
+async def get_prepared_statement_metrics():
+    """
+    This endpoint reports on the named prepared statements, keyed by name.
+
+    For each statement it returns:
+    * `hits`: Runs on a connection that already had the statement prepared.
+    * `misses`: Runs that had to prepare it first.
+    * `hit_ratio`: `hits` out of all runs.
+    """
+    return prepared_statements.stats()
+
+
+@router.get("/metrics/cold-start", tags=["metrics"])
+async def get_cold_start_metrics():
+    """
+    This endpoint reports how long this instance took to start serving.
+
+    Returns a dictionary with keys:
+    * `serverless`: Whether the serverless profile is on, importing routers on first use.
+    * `import_ms`: Time spent importing the app.
+    * `first_response_ms`: Time from starting the import to starting the first response.
+    * `router_import_ms`: For each router imported on first use, the time it took.
+    """
+    return serverless.stats()
@@ -1,11 +1,15 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Header, Request
 from enum import Enum
 from fastapi.params import Query
 from src import database as db
+from src import login_throttle
+from src import prediction_buffer
+from src import response_cache
 from pydantic import BaseModel, Field
-from typing import List
-from src.api.users import UserJson, authenticate_user
+from typing import List, Optional
+from src.api.users import UserJson, resolve_user
 from datetime import datetime
+import asyncio
 import sqlalchemy
 
 
@@ -17,8 +21,74 @@ class PredictionJson(BaseModel):
 router = APIRouter()
 
 
+PREDICTION_COUNTS = sqlalchemy.text(
+    """
+    SELECT fighter_id, fighter1_id, fighter2_id, COUNT(*) AS ct
+    FROM predictions
+        INNER JOIN fights ON predictions.fight_id = fights.fight_id
+    WHERE predictions.fight_id = (:fight_id)
+    GROUP BY fighter_id, fighter1_id, fighter2_id
+    """
+)
+
+
+FIGHT_NAMES = sqlalchemy.text(
+    """
+    SELECT fighter1_id, fighter2_id, result,
+        fighter_id, CONCAT(first_name, ' ', last_name) AS name,
+        method_of_vic
+    FROM fights
+        INNER JOIN fighters ON fighter1_id = fighter_id OR fighter2_id = fighter_id
+    WHERE fight_id = (:fight_id);
+    """
+)
+
+
+def tally_predictions(rows):
+    """
+    Returns the prediction counts of fighter 1 and fighter 2 from the rows of `PREDICTION_COUNTS`.
+    """
+    count_1 = 0
+    count_2 = 0
+    for row in rows:
+        if row.fighter_id == row.fighter1_id:
+            count_1 = row.ct
+        if row.fighter_id == row.fighter2_id:
+            count_2 = row.ct
+    return count_1, count_2
+
+
+def fight_outcome(rows):
+    """
+    Returns the names of both fighters and the result of the fight from the rows of `FIGHT_NAMES`.
+    """
+    fight_result = None
+    method = None
+    f1_id = None
+
+    for row in rows:
+        if row.fighter_id == row.fighter1_id:
+            name_1 = row.name
+            f1_id = row.fighter1_id
+        if row.fighter_id == row.fighter2_id:
+            name_2 = row.name
+        fight_result = row.result
+        method = row.method_of_vic
+
+    if fight_result is None and method is None:
+        final_result = "Unknown"  # Probably overturned
+    elif fight_result is None:
+        final_result = "Draw"
+    elif fight_result == f1_id:
+        final_result = name_1
+    else:
+        final_result = name_2
+    return name_1, name_2, final_result
+
+
 @router.get("/predictions/count", tags=["predictions"])
-def get_prediction(fight_id: int):
+@response_cache.cached("predictions", "predictions:{fight_id}")
+async def get_prediction(fight_id: int):
     """
     This endpoint takes in a `fight_id` and returns how many predictions each
     fighter got from the fight.
@@ -30,63 +100,18 @@ def get_prediction(fight_id: int):
     * `fighter2_count`: The number of predictions which chose fighter 2 to win the fight.
     * `result`: The result of the fight. Either the name of the fighter who won, "Draw", or "Unknown".
     """
-    predictions = sqlalchemy.text(
-        """
-        SELECT fighter_id, fighter1_id, fighter2_id, COUNT(*) AS ct
-        FROM predictions
-            INNER JOIN fights ON predictions.fight_id = fights.fight_id
-        WHERE predictions.fight_id = (:fight_id)
-        GROUP BY fighter_id, fighter1_id, fighter2_id
-        """
-    )
-
-    names = sqlalchemy.text(
-        """
-        SELECT fighter1_id, fighter2_id, result,
-            fighter_id, CONCAT(first_name, ' ', last_name) AS name,
-            method_of_vic
-        FROM fights
-	        INNER JOIN fighters ON fighter1_id = fighter_id OR fighter2_id = fighter_id
-        WHERE fight_id = (:fight_id);
-        """
-    )
-
-    with db.engine.connect() as conn:
-        result = conn.execute(predictions, [{"fight_id": fight_id}])
+    async with db.connect() as conn:
+        result = await conn.execute(PREDICTION_COUNTS, [{"fight_id": fight_id}])
         count = result.fetchall()
         if count is None:
             raise HTTPException(status_code=404, detail='fight does not exist')
-        count_1 = 0
-        count_2 = 0
-        for row in count:
-            if row.fighter_id == row.fighter1_id:
-                count_1 = row.ct
-            if row.fighter_id == row.fighter2_id:
-                count_2 = row.ct
-        
-        result = conn.execute(names, [{"fight_id": fight_id}])
-        names = result.fetchall()
-        fight_result = None
-        method = None
-        f1_id = None
+        count_1, count_2 = tally_predictions(count)
 
+        result = await conn.execute(FIGHT_NAMES, [{"fight_id": fight_id}])
+        names = result.fetchall()
         for row in names:
-            if row.fighter_id == row.fighter1_id:
-                name_1 = row.name
-                f1_id = row.fighter1_id
-            if row.fighter_id == row.fighter2_id:
-                name_2 = row.name
-            fight_result = row.result
-            method = row.method_of_vic
-        
-        if fight_result is None and method is None:
-            final_result = "Unknown"  # Probably overturned
-        elif fight_result is None:
-            final_result = "Draw"
-        elif fight_result == f1_id:
-            final_result = name_1
-        else:
-            final_result = name_2
+            response_cache.add_tags("fighter:" + str(row.fighter_id))
+        name_1, name_2, final_result = fight_outcome(names)
 
         json = {
             "fighter1": name_1,
@@ -99,12 +124,47 @@ def get_prediction(fight_id: int):
     return json
 
 
+PREDICTION_FIGHT = sqlalchemy.text(
+    """
+    SELECT fight_id, fighter1_id, fighter2_id, event_date
+    FROM fights
+        INNER JOIN events ON fights.event_id = events.event_id
+    WHERE fight_id = (:fight_id) AND (fighter1_id = (:fighter_id)
+                                      OR fighter2_id = (:fighter_id))
+    """
+)
+
+# The checks of PREDICTION_FIGHT and the insert in one round trip. The prediction
+# is only inserted when the event is at least a day after :now.
+ADD_PREDICTION = sqlalchemy.text(
+    """
+    WITH fight AS (
+        SELECT fight_id, event_date
+        FROM fights
+            INNER JOIN events ON fights.event_id = events.event_id
+        WHERE fight_id = (:fight_id) AND (fighter1_id = (:fighter_id)
+                                          OR fighter2_id = (:fighter_id))
+    ), inserted AS (
+        INSERT INTO predictions (fight_id, fighter_id, user_id)
+        SELECT fight_id, CAST(:fighter_id AS integer), CAST(:user_id AS integer)
+        FROM fight
+        WHERE event_date - CAST(:now AS timestamp) >= INTERVAL '1 day'
+        RETURNING prediction_id
+    )
+    SELECT event_date, EXISTS (SELECT 1 FROM inserted) AS inserted
+    FROM fight
+    """
+)
+
+
 @router.post("/predictions/add/", tags=["predictions"])
-def add_prediction(user: UserJson, prediction: PredictionJson):
+async def add_prediction(prediction: PredictionJson, request: Request, user: Optional[UserJson] = None,
+                         authorization: Optional[str] = Header(default=None)):
     """
     This endpoint takes in a user model, requiring their name and password, and
     a prediction model, requiring the `fight_id`, the `fighter_id` and the result
-    they believe will happen.
+    they believe will happen. Instead of the user model, a session token from
+    `/users/login` can be given as `Authorization: Bearer <token>`.
 
     Returns the count for the prediction for the fight.
 
@@ -114,41 +174,54 @@ def add_prediction(user: UserJson, prediction: PredictionJson):
     fight. A user is not allowed to predict a fight will end in a draw.
     Additionally, this endpoint ensures that the prediction is made at most one
     day before the `event_date` of the event the `fight_id` is associated with.
+
+    When buffered ingestion is enabled, the validated prediction is queued and
+    written in a batch with other predictions. The response then also carries a
+    `status` key, either "accepted" or "duplicate" if the user already predicted
+    this fight. If the batch is not committed within
+    `PREDICTION_BUFFER_TIMEOUT_SECONDS`, or fails to be, the endpoint answers 503.
     """
-    result = authenticate_user(user)
+    user_id = await resolve_user(user and user.username, user and user.password, authorization,
+                                 login_throttle.client_ip(request))
 
-    fight_info = sqlalchemy.text(
-        """
-        SELECT fight_id, fighter1_id, fighter2_id, event_date
-        FROM fights
-            INNER JOIN events ON fights.event_id = events.event_id
-        WHERE fight_id = (:fight_id) AND (fighter1_id = (:fighter_id)
-                                          OR fighter2_id = (:fighter_id))
-        """
-    )
+    params = {"fight_id": prediction.fight_id, "fighter_id": prediction.fighter_id,
+              "user_id": user_id, "now": datetime.now()}
 
-    with db.engine.begin() as conn:
-        result = conn.execute(fight_info, [{"fight_id": prediction.fight_id,
-                                            "fighter_id": prediction.fighter_id}]).first()
+    async with db.begin() as conn:
+        if prediction_buffer.enabled():
+            # The buffer inserts later, so only the checks run now.
+            result = (await conn.execute(PREDICTION_FIGHT, [params])).first()
+        else:
+            result = (await conn.execute(ADD_PREDICTION, [params])).first()
         if result is None:
             raise HTTPException(status_code=400,
                                 detail="given bad fight_id or fighter_id")
         
-        if (result.event_date - datetime.now()).days < 1:
+        if (result.event_date - params["now"]).days < 1:
             raise HTTPException(status_code=400,
                                 detail="too late to submit prediction for this fight")
-        
-        # Get user_id
-        result = conn.execute(
-            sqlalchemy.select(db.users.c.user_id)
-            .where(db.users.c.username == user.username)
-        ).first()
-
-        conn.execute(
-            sqlalchemy.insert(db.predictions)
-            .values(fight_id=prediction.fight_id,
-                    fighter_id=prediction.fighter_id,
-                    user_id=result.user_id)
-        )
-    
-    return get_prediction(prediction.fight_id)
\ No newline at end of file
+
+    if not prediction_buffer.enabled():
+        await response_cache.purge("predictions:" + str(prediction.fight_id))
+        return await get_prediction(prediction.fight_id)
+
+    try:
+        future = prediction_buffer.buffer.submit(prediction.fight_id, prediction.fighter_id, user_id)
+    except RuntimeError:
+        raise HTTPException(status_code=503, detail="server is shutting down, try again")
+    try:
+        # Shielded, so timing out leaves the future for the flush to resolve.
+        status = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)),
+                                        prediction_buffer.TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="prediction not confirmed in time, it may still be saved")
+    except sqlalchemy.exc.IntegrityError:
+        # The fight, fighter or user went away after the checks above.
+        raise HTTPException(status_code=400, detail="given bad fight_id, fighter_id or user")
+    except (sqlalchemy.exc.SQLAlchemyError, OSError):
+        raise HTTPException(status_code=503, detail="prediction could not be saved, try again")
+    if status == prediction_buffer.ACCEPTED:
+        await response_cache.purge("predictions:" + str(prediction.fight_id))
+    json = await get_prediction(prediction.fight_id)
+    json["status"] = status
+    return json
@@ -0,0 +1,48 @@
+import sqlalchemy
+from starlette.responses import JSONResponse
+
+from src import query_budget
+from src.api.route_templates import RouteTemplates
+
+
+class QueryBudgetMiddleware:
+    """
+    Applies the route's statement timeout and statement budget from
+    `query_budget` to the SQL run while handling a request. A statement cancelled
+    by the timeout becomes a 504 and going over the statement budget a 503, as
+    long as the response has not started yet. Either is counted for the route.
+    """
+    def __init__(self, app, routes):
+        self.app = app
+        self.route_template = RouteTemplates(routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = False
+
+        async def track_start(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        token = query_budget.start_request(scope)
+        try:
+            await self.app(scope, receive, track_start)
+        except query_budget.StatementBudgetExceeded as e:
+            query_budget.record_violation(self.route_template(scope), "statement_budget")
+            if started:
+                raise
+            await JSONResponse({"detail": str(e)}, status_code=503)(scope, receive, send)
+        except sqlalchemy.exc.DBAPIError as e:
+            if not query_budget.is_timeout(e):
+                raise
+            query_budget.record_violation(self.route_template(scope), "statement_timeout")
+            if started:
+                raise
+            await JSONResponse({"detail": "statement timed out"}, status_code=504)(scope, receive, send)
+        finally:
+            query_budget.end_request(token)
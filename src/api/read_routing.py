@@ -0,0 +1,32 @@
+from src import database as db
+
+READ_METHODS = (b"GET", b"HEAD")
+
+
+class ReadRoutingMiddleware:
+    """
+    Lets GET and HEAD requests read from the replica through `db.connect()`.
+    A client can demand read-your-writes, for example right after posting a
+    prediction, by sending `X-Read-Your-Writes: true`, which keeps the request on
+    the primary. Every other method always uses the primary.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        use_replica = scope["method"].encode() in READ_METHODS
+        if use_replica:
+            for name, value in scope["headers"]:
+                if name == b"x-read-your-writes" and value.lower() in (b"1", b"true", b"yes"):
+                    use_replica = False
+                    break
+
+        token = db.route_reads_to_replica(use_replica)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            db.reset_read_routing(token)
@@ -0,0 +1,27 @@
+class RouteTemplates:
+    """
+    Maps a handled request to the path template of its route, such as
+    "/fighters/{id}", so metrics are grouped per route instead of per URL.
+    Lookups are cached per endpoint.
+    """
+    def __init__(self, routes):
+        self.routes = routes
+        self._templates = {}  # endpoint -> path template
+
+    def __call__(self, scope) -> str:
+        """
+        Only meaningful once the router has run. Unmatched requests (404s) are
+        grouped under "unmatched".
+        """
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        template = self._templates.get(endpoint)
+        if template is None:
+            template = "unmatched"
+            for route in self.routes:
+                if getattr(route, "endpoint", None) is endpoint:
+                    template = route.path
+                    break
+            self._templates[endpoint] = template
+        return template
@@ -1,10 +1,16 @@
+# First, so the import time it reports covers everything else.
+from src.api import serverless
+
 from fastapi import FastAPI
 
-from src.api import fights
-from src.api import fighters
-from src.api import users
-from src.api import events
-from src.api import predictions
+from src.api import compression
+from src.api import http_metrics
+from src.api.cache_middleware import ResponseCacheMiddleware
+from src.api.query_budget_middleware import QueryBudgetMiddleware
+from src.api.read_routing import ReadRoutingMiddleware
+from src.api.sql_timing import SqlTimingMiddleware
+from src import prediction_buffer
+from src import response_cache
 
 
 description = """
@@ -48,8 +54,50 @@ You can:
 * **list all username's matching a string**
 * **authenticate a given username and password**
 * **add a new user to the database**
+* **bulk import users (admin)**
 * **delete an account**
 * **update a username or password**
+
+
+## Lookups
+
+You can:
+* **list the stances, weight classes and victory methods ids stand for**
+* **reload them from the database (admin)**
+
+
+## Health
+
+You can:
+* **check that a worker is alive**
+* **check that a worker is ready for traffic, with its database latency and pool saturation**
+
+
+## Metrics
+
+You can:
+* **scrape per-route request counts and latencies in the Prometheus format**
+* **inspect the buffered prediction ingestion queue**
+* **inspect failed-login throttling**
+* **inspect the database connection pools**
+* **inspect the response cache**
+* **inspect response compression per route**
+* **inspect SQL statement counts and time per route**
+* **inspect statement timeouts and statement budget violations per route**
+* **inspect prepared statement hit rates**
+* **inspect import time and time to first response of this instance**
+
+GET requests read from the read replica when one is configured. Send
+`X-Read-Your-Writes: true` to read from the primary instead.
+
+When the response cache is enabled, cached responses carry `X-Cache: HIT` or
+`X-Cache: MISS`. Writes invalidate the responses they affect.
+
+Responses are compressed with zstd, brotli or gzip according to `Accept-Encoding`.
+Every response reports the SQL statements it ran in a `Server-Timing` header.
+
+Requests whose SQL runs past the route's statement timeout get a 504, and
+requests running more SQL statements than the route allows get a 503.
 """
 tags_metadata = [
     {
@@ -72,6 +120,18 @@ tags_metadata = [
         "name": "users",
         "description": "Access information on users.",
     },
+    {
+        "name": "lookups",
+        "description": "Access the enumerations ids in other resources stand for.",
+    },
+    {
+        "name": "health",
+        "description": "Liveness and readiness probes.",
+    },
+    {
+        "name": "metrics",
+        "description": "Operational metrics for the API.",
+    },
 ]
 
 app = FastAPI(
@@ -80,12 +140,51 @@ app = FastAPI(
     version="0.0.3",
     openapi_tags=tags_metadata,
 )
-app.include_router(fights.router)
-app.include_router(events.router)
-app.include_router(fighters.router)
-app.include_router(users.router)
-app.include_router(predictions.router)
+if response_cache.enabled():
+    app.add_middleware(ResponseCacheMiddleware, routes=app.routes)
+app.add_middleware(SqlTimingMiddleware, routes=app.routes)
+app.add_middleware(QueryBudgetMiddleware, routes=app.routes)
+app.add_middleware(ReadRoutingMiddleware)
+if compression.ENABLED:
+    app.add_middleware(compression.CompressionMiddleware, routes=app.routes)
+if http_metrics.ENABLED:
+    app.add_middleware(http_metrics.HttpMetricsMiddleware, routes=app.routes)
+# Serverless instances import each router on the first request that needs it.
+app.add_middleware(serverless.ColdStartMiddleware, routers=serverless.ROUTERS if serverless.ENABLED else {},
+                   include=app.include_router)
+if not serverless.ENABLED:
+    from src.api import fights
+    from src.api import events
+    from src.api import fighters
+    from src.api import users
+    from src.api import predictions
+    from src.api import lookups
+    from src.api import health
+    from src.api import metrics
+    app.include_router(fights.router)
+    app.include_router(events.router)
+    app.include_router(fighters.router)
+    app.include_router(users.router)
+    app.include_router(predictions.router)
+    app.include_router(lookups.router)
+    app.include_router(health.router)
+    app.include_router(metrics.router)
+
+
+@app.on_event("shutdown")
+def drain_prediction_buffer():
+    prediction_buffer.shutdown()
+
+
+@app.on_event("shutdown")
+def flush_http_metrics():
+    if http_metrics.MULTIPROC_DIR:
+        http_metrics.flush()
+
 
 @app.get("/")
 async def root():
     return {"message": "Welcome to the Ultimate Fighting API. See /docs for more information."}
+
+
+serverless.imported()
@@ -0,0 +1,106 @@
+"""
+The serverless profile, turned on with `SERVERLESS`, and cold start timings.
+
+A serverless instance (such as the function `vercel.json` deploys) is started
+for a handful of requests, so its import time is paid over and over. With the
+profile on, `server.py` does not import the routers. `ColdStartMiddleware`
+imports and includes a router the first time a request's path needs it, so an
+instance only imports the routers it actually serves. `/docs` and
+`/openapi.json` include all of them. The database side of the profile is in
+`src/database.py`: no pooled connections, and asyncpg prepares statements under
+unique names without caching them, which works with transaction-pooling proxies
+such as pgbouncer.
+
+Whether or not the profile is on, the time to import `server.py`, to import
+each router and to send the first response are reported at `/metrics/cold-start`.
+`python -X importtime` or `benchmarks.cold_start` break the import time down by
+module.
+"""
+import importlib
+import time
+
+from src import config
+
+# Imported first thing by `server.py`, so this is when importing the app started.
+_import_started = time.perf_counter()
+
+ENABLED = config.SERVERLESS
+
+# First path segment -> router module, in the order they are included.
+ROUTERS = {
+    "fights": "src.api.fights",
+    "events": "src.api.events",
+    "fighters": "src.api.fighters",
+    "users": "src.api.users",
+    "predictions": "src.api.predictions",
+    "lookups": "src.api.lookups",
+    "healthz": "src.api.health",
+    "readyz": "src.api.health",
+    "metrics": "src.api.metrics",
+}
+# Paths that need every route.
+ALL_ROUTERS = ("docs", "redoc", "openapi.json")
+
+_import_ms = None
+_first_response_ms = None
+_router_import_ms = {}  # router module -> ms
+
+
+def imported():
+    """
+    Called by `server.py` once it has been imported.
+    """
+    global _import_ms
+    _import_ms = (time.perf_counter() - _import_started) * 1000
+
+
+def stats() -> dict:
+    return {
+        "serverless": ENABLED,
+        "import_ms": _import_ms,
+        "first_response_ms": _first_response_ms,
+        "router_import_ms": dict(_router_import_ms),
+    }
+
+
+class ColdStartMiddleware:
+    """
+    Includes the lazily imported `routers`, a dictionary like `ROUTERS`, with
+    `include` when a request first needs them, and records when the first
+    response started.
+    """
+    def __init__(self, app, routers: dict, include):
+        self.app = app
+        self.routers = dict(routers)
+        self.include = include
+
+    def _include(self, segment: str):
+        # Importing and including happen without awaiting, so concurrent
+        # requests on the event loop cannot include a router twice.
+        module_names = list(self.routers.values()) if segment in ALL_ROUTERS else [self.routers.get(segment)]
+        for module_name in module_names:
+            if module_name is None or module_name in _router_import_ms:
+                continue
+            started = time.perf_counter()
+            self.include(importlib.import_module(module_name).router)
+            _router_import_ms[module_name] = (time.perf_counter() - started) * 1000
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if self.routers:
+            self._include(scope["path"].split("/")[1])
+
+        if _first_response_ms is not None:
+            await self.app(scope, receive, send)
+            return
+
+        async def record_first_response(message):
+            global _first_response_ms
+            if message["type"] == "http.response.start" and _first_response_ms is None:
+                _first_response_ms = (time.perf_counter() - _import_started) * 1000
+            await send(message)
+
+        await self.app(scope, receive, record_first_response)
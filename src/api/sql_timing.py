@@ -0,0 +1,33 @@
+from src import sql_metrics
+from src.api.route_templates import RouteTemplates
+
+
+class SqlTimingMiddleware:
+    """
+    Attributes the SQL statements run while handling a request to it, adds a
+    `Server-Timing: db;dur=<ms>;desc="<n> queries"` header to the response and
+    records the totals for the route in `sql_metrics`.
+    """
+    def __init__(self, app, routes):
+        self.app = app
+        self.route_template = RouteTemplates(routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        queries, token = sql_metrics.start_request(scope["method"], scope["path"])
+
+        async def add_header(message):
+            if message["type"] == "http.response.start":
+                timing = 'db;dur=%.3f;desc="%d queries"' % (queries.seconds * 1000, queries.statements)
+                message = dict(message, headers=list(message.get("headers", []))
+                               + [(b"server-timing", timing.encode())])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, add_header)
+        finally:
+            sql_metrics.end_request(token)
+            sql_metrics.record_request(self.route_template(scope), queries)
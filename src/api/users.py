@@ -1,7 +1,21 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Header, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.params import Query
+from src import bulk_import
+from src import config
 from src import database as db
+from src import login_throttle
+from src import passwords
+from src import query_budget
+from src import response_cache
+from src import sessions
+from src.api.responses import FastJSONResponse
 from typing import Optional
 from pydantic import BaseModel, Field
+from datetime import datetime
+from enum import Enum
+import base64
+import hmac
 import sqlalchemy
 
 
@@ -11,37 +25,152 @@ class UserJson(BaseModel):
 
 
 class UserUpdateNameJson(BaseModel):
-    old_username: str
-    password: str
+    old_username: Optional[str] = None
+    password: Optional[str] = None
     new_username: str
 
 
 class UserUpdatePasswordJson(BaseModel):
-    username: str
-    old_password: str
+    username: Optional[str] = None
+    old_password: Optional[str] = None
     new_password: str
 
 router = APIRouter()
 
 
 @router.get("/users/{id}", tags=["users"])
-def get_user(id: int):
+async def get_user(id: int):
     """
     This endpoint takes in a user_id and returns the username of that user.
     If the user_id is not found, returns an error.
     """
     find = (sqlalchemy.select(db.users.c.username)).where(db.users.c.user_id == id)
 
-    with db.engine.connect() as conn:
-        result = conn.execute(find).first()
+    async with db.connect() as conn:
+        result = (await conn.execute(find)).first()
         if result is None:
             raise HTTPException(status_code=400, detail='user does not exist')
 
     return {'username': result[0]}
 
 
+def encode_history_cursor(created_at: datetime, prediction_id: int) -> str:
+    raw = created_at.isoformat() + "|" + str(prediction_id)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_history_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, prediction_id = raw.split("|")
+        return datetime.fromisoformat(created_at), int(prediction_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='invalid cursor')
+
+
+def prediction_outcome(row) -> str:
+    if row.result == row.fighter_id:
+        return "correct"
+    elif row.result is not None or row.method_of_vic is not None:
+        # Losses and draws both count against the pick, users cannot predict a draw.
+        return "incorrect"
+    return "pending"
+
+
+@router.get("/users/{id}/predictions", tags=["users", "predictions"])
+async def get_user_predictions(id: int, cursor: str = "", limit: int = Query(50, ge=1, le=250)):
+    """
+    This endpoint takes in a `user_id` and returns the predictions the user has made,
+    most recent first.
+
+    Returns a dictionary with keys:
+    * `predictions`: A list of predictions.
+    * `next_cursor`: Pass this as the `cursor` query parameter to get the next page.
+      Null when there are no more predictions.
+
+    Each prediction is represented by a dictionary with the following keys:
+    * `fight_id`: The internal id of the fight.
+    * `event`: The name of the event the fight is from.
+    * `event_date`: The date of the event.
+    * `pick_id`: The internal id of the fighter the user picked to win.
+    * `pick`: The name of the fighter the user picked to win.
+    * `opponent_id`: The internal id of the other fighter.
+    * `opponent`: The name of the other fighter.
+    * `outcome`: Either "correct", "incorrect" or "pending".
+    * `created_at`: When the prediction was made.
+
+    If the user_id is not found, returns an error.
+    """
+    history = """
+        SELECT
+            prediction_id,
+            predictions.created_at,
+            predictions.fight_id,
+            predictions.fighter_id,
+            CONCAT(pick.first_name, ' ', pick.last_name) AS pick,
+            opponent.fighter_id AS opponent_id,
+            CONCAT(opponent.first_name, ' ', opponent.last_name) AS opponent,
+            result,
+            method_of_vic,
+            event_name,
+            event_date
+        FROM predictions
+            INNER JOIN fights ON fights.fight_id = predictions.fight_id
+            INNER JOIN fighters AS pick ON pick.fighter_id = predictions.fighter_id
+            INNER JOIN fighters AS opponent ON opponent.fighter_id =
+                CASE WHEN fights.fighter1_id = predictions.fighter_id
+                     THEN fights.fighter2_id ELSE fights.fighter1_id END
+            INNER JOIN events ON events.event_id = fights.event_id
+        WHERE predictions.user_id = (:user_id)
+        """
+    params = {"user_id": id, "limit": limit + 1}
+    if cursor:
+        created_at, prediction_id = decode_history_cursor(cursor)
+        history += """
+            AND (predictions.created_at, prediction_id) < (:created_at, :prediction_id)
+        """
+        params["created_at"] = created_at
+        params["prediction_id"] = prediction_id
+    history += """
+        ORDER BY predictions.created_at DESC, prediction_id DESC
+        LIMIT (:limit)
+        """
+
+    async with db.connect() as conn:
+        user = (await conn.execute(
+            sqlalchemy.select(db.users.c.user_id).where(db.users.c.user_id == id)
+        )).first()
+        if user is None:
+            raise HTTPException(status_code=404, detail='user does not exist')
+
+        rows = (await conn.execute(sqlalchemy.text(history), [params])).fetchall()
+
+    json = []
+    for row in rows[:limit]:
+        json.append(
+            {
+                "fight_id": row.fight_id,
+                "event": row.event_name,
+                "event_date": row.event_date,
+                "pick_id": row.fighter_id,
+                "pick": row.pick.strip(),
+                "opponent_id": row.opponent_id,
+                "opponent": row.opponent.strip(),
+                "outcome": prediction_outcome(row),
+                "created_at": row.created_at,
+            }
+        )
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_history_cursor(last.created_at, last.prediction_id)
+
+    return {"predictions": json, "next_cursor": next_cursor}
+
+
 @router.get("/users", tags=["users"])
-def get_users(name: str = "", limit: int = 50, offset: int = 0):
+async def get_users(name: str = "", limit: int = 50, offset: int = 0):
     """
     This endpoint takes in a username and returns every user_id and username where
     the username matches the name.
@@ -51,8 +180,8 @@ def get_users(name: str = "", limit: int = 50, offset: int = 0):
         limit(limit).\
         offset(offset)
     
-    with db.engine.connect() as conn:
-        result = conn.execute(find).fetchall()
+    async with db.connect() as conn:
+        result = (await conn.execute(find)).fetchall()
         json = []
         for row in result:
             json.append(
@@ -62,51 +191,100 @@ def get_users(name: str = "", limit: int = 50, offset: int = 0):
                 }
             )
     
-    return json
+    return FastJSONResponse(json)
+
+
+async def verify_credentials(username: str, password: str, client_ip: str = "") -> int:
+    """
+    Verifies that the user exists and that the password is correct for that user.
+    Raises an error otherwise, returns the `user_id` on success.
+
+    Repeated failures for the same username or client are locked out with a 429
+    error before the database is touched.
+    """
+    await login_throttle.check(username, client_ip)
+
+    find = (
+        sqlalchemy.select(db.users.c.user_id, db.users.c.password).
+        where(db.users.c.username == username)
+    )
+
+    async with db.connect() as conn:
+        result = (await conn.execute(find)).first()
+        if result is None:
+            await login_throttle.record_failure(username, client_ip)
+            raise HTTPException(status_code=404, detail='user does not exist')
+
+    # Hashing happens on the API's pool, never while holding a connection.
+    if not await passwords.verify_password(password, result.password):
+        await login_throttle.record_failure(username, client_ip)
+        raise HTTPException(status_code=401, detail='invalid password, try again.')
+
+    await login_throttle.record_success(username, client_ip)
+    return result.user_id
+
+
+def session_claims(authorization: str) -> dict:
+    """
+    Takes in an `Authorization: Bearer <token>` header value and returns the
+    claims of the session token, raising an error if it is not valid.
+    """
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail='expected a bearer session token')
+    claims = sessions.verify(token.strip())
+    if claims is None:
+        raise HTTPException(status_code=401, detail='invalid or expired session token')
+    return claims
+
+
+async def resolve_user(username: Optional[str], password: Optional[str],
+                       authorization: Optional[str], client_ip: str = "") -> int:
+    """
+    Returns the `user_id` of the caller. A session token in the `Authorization`
+    header is used when given, otherwise the username and password are verified.
+    """
+    if authorization:
+        return session_claims(authorization)["sub"]
+    if username is None or password is None:
+        raise HTTPException(status_code=401, detail='username and password or a session token required')
+    return await verify_credentials(username, password, client_ip)
 
 
 @router.post("/users/login", tags=["users"])
-def authenticate_user(user: UserJson):
+async def authenticate_user(user: UserJson, request: Request):
     """
     This endpoint takes in a user datatype and verifies that the user exists
     and that the password given is correct for that user.
 
-    If the user does not exist, raises an error.
+    If the user does not exist, raises an error. After too many failed attempts
+    for a username or from a client, further attempts are rejected for a while.
 
-    Upon success returns the `user_id` of the authenticated user.
+    Upon success returns:
+    * `user_id`: The id of the authenticated user.
+    * `token`: A session token. Send it as `Authorization: Bearer <token>` to the
+      prediction and account endpoints instead of the username and password.
+    * `expires_at`: When the token expires, in seconds since the unix epoch.
     """
-    verify = sqlalchemy.text(
-        """
-        SELECT user_id
-        FROM users
-        WHERE username = :username
-            AND password = crypt(:password, password);
-        """
-    )
+    user_id = await verify_credentials(user.username, user.password, login_throttle.client_ip(request))
+    session = sessions.issue(user_id)
 
-    check_exists = sqlalchemy.text(
-        """
-        SELECT username
-        FROM users
-        WHERE username = :username
-        """
-    )
+    return {'user_id': user_id, 'token': session['token'], 'expires_at': session['expires_at']}
 
-    with db.engine.connect() as conn:
-        result = conn.execute(check_exists, [{'username': user.username}]).first()
-        if result is None:
-            raise HTTPException(status_code=404, detail='user does not exist')
 
-        result = conn.execute(verify, [{'username': user.username,
-                                        'password': user.password}]).first()
-        if result is None:
-            raise HTTPException(status_code=401, detail='invalid password, try again.')
-    
-    return {'user_id': result.user_id}
+@router.post("/users/logout", tags=["users"])
+async def logout_user(authorization: str = Header(...)):
+    """
+    This endpoint takes in a session token through the `Authorization` header
+    and revokes it.
+    """
+    sessions.revoke(session_claims(authorization))
+
+    return {'result': 'logout successful'}
 
 
 @router.post("/users", tags=["users"])
-def add_user(user: UserJson):
+async def add_user(user: UserJson):
     """
     This endpoint takes in a user datatype and adds it to the database.
     Usernames are assured to be unique by the endpoint, if a username given
@@ -114,64 +292,121 @@ def add_user(user: UserJson):
 
     On success this endpoint returns the id of the resulting user added to the database.
     """
+    # A taken username makes the insert do nothing instead of needing a lookup first.
     encryption = sqlalchemy.text(
         """
-        INSERT INTO users (username, password) VALUES (
-            :username,
-            crypt(:password, gen_salt('bf'))
-        )
+        INSERT INTO users (username, password) VALUES (:username, :password)
+        ON CONFLICT (username) DO NOTHING
         RETURNING user_id
         """
     )
 
-    check_unique = sqlalchemy.text(
-        """
-        SELECT username
-        FROM users
-        WHERE username = :username
-        """
-    )
+    hashed = await passwords.hash_password(user.password)
 
-    with db.engine.connect() as conn:
-        check = conn.execute(check_unique, [{'username': user.username}])
-        if check.first() is not None:
+    async with db.connect() as conn:
+        result = (await conn.execute(encryption, [{'username': user.username, 'password': hashed}])).first()
+        if result is None:
             raise HTTPException(status_code=409, detail='username already taken')
-        result = conn.execute(encryption, [{'username': user.username, 'password': user.password}])
-        conn.commit()
+        await conn.commit()
     
-    return {'user_id': result.scalar()}
+    return {'user_id': result.user_id}
+
+
+class import_format_options(str, Enum):
+    csv = "csv"
+    jsonl = "jsonl"
+
+
+@router.post("/users/import", tags=["users"])
+@query_budget.limit(timeout_ms=0, max_statements=0)
+async def import_users(request: Request, format: import_format_options = import_format_options.csv,
+                       batch_size: int = Query(1000, ge=1, le=10000),
+                       x_admin_token: Optional[str] = Header(default=None)):
+    """
+    This admin endpoint takes in a CSV (with `username` and `password` columns) or
+    JSONL request body of users and adds them all to the database. Passwords are
+    hashed on a process pool and users are inserted in batches of `batch_size`.
+    A malformed row is answered with a 400 naming it, and nothing is imported.
+
+    Requires the `X-Admin-Token` header to match the server's `ADMIN_TOKEN`.
+
+    Returns a dictionary with keys:
+    * `inserted`: The number of users added.
+    * `duplicates`: The number of usernames that were already taken or repeated.
+    * `duplicate_usernames`: The duplicate usernames (up to the first 1000).
+    * `seconds`: How long the import took.
+    * `users_per_second`: The import throughput.
+    """
+    admin_token = config.get_str("ADMIN_TOKEN")
+    if not admin_token or not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), admin_token.encode()):
+        raise HTTPException(status_code=403, detail='admin token required')
+
+    body = await request.body()
+    try:
+        text = body.decode("utf-8")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail='body is not UTF-8')
+    try:
+        return await run_in_threadpool(bulk_import.import_text, text, format.value, batch_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @router.post("/users/delete", tags=["users"])
-def delete_user(user: UserJson):
+async def delete_user(request: Request, user: Optional[UserJson] = None,
+                      authorization: Optional[str] = Header(default=None)):
     """
-    This endpoint takes in a user datatype, verifies that the user exists, authenticates
-    the user, then deletes all known predictions associated with the user and
-    finally the user itself.
+    This endpoint takes in a user datatype or a session token, verifies that the user
+    exists, authenticates the user, then deletes all known predictions associated
+    with the user and finally the user itself.
 
     Throws an error when the user does not exist or fails authentication.
     """
-    result = authenticate_user(user)  # will raise errors if user doesnt exist/password is wrong
-    
+    # will raise errors if user doesnt exist/password is wrong
+    user_id = await resolve_user(user and user.username, user and user.password, authorization,
+                                 login_throttle.client_ip(request))
+
     delete = (
         sqlalchemy.delete(db.users).
-        where(db.users.c.user_id == result['user_id'])
+        where(db.users.c.user_id == user_id)
     )
 
-    with db.engine.begin() as conn:
-        result = conn.execute(delete)
-    
-        if result.rowcount > 0:
-            return {'result': 'delete successful'}
-        else:
-            conn.rollback()
+    async with db.begin() as conn:
+        result = await conn.execute(delete)
+
+        if result.rowcount == 0:
+            await conn.rollback()
             raise HTTPException(status_code=500, detail='delete went wrong, action rolled back')
+        sessions.revoke_user(user_id)
+
+    # The user's predictions went with them, so any prediction count may have changed.
+    await response_cache.purge("predictions")
+    return {'result': 'delete successful'}
+
+
+# Renames the user unless the name is taken, in one round trip.
+RENAME_USER = sqlalchemy.text(
+    """
+    WITH taken AS (
+        SELECT user_id FROM users WHERE username = (:username)
+    ), updated AS (
+        UPDATE users SET username = (:username)
+        WHERE user_id = (:user_id) AND NOT EXISTS (SELECT 1 FROM taken)
+        RETURNING user_id
+    )
+    SELECT
+        EXISTS (SELECT 1 FROM taken) AS taken,
+        (SELECT COUNT(*) FROM updated) AS updated
+    """
+)
 
 
 @router.put("/users/update/name", tags=["users"])
-def update_username(user: UserUpdateNameJson):
+async def update_username(user: UserUpdateNameJson, request: Request,
+                          authorization: Optional[str] = Header(default=None)):
     """
-    This endpoint takes in a `username` and `password` and a new desired username.
+    This endpoint takes in a `username` and `password`, or a session token, and
+    a new desired username.
 
     After authenticating the user, checks whether or not the
     desired username is available.
@@ -181,58 +416,69 @@ def update_username(user: UserUpdateNameJson):
 
     Returns success upon a successful update, errors otherwise.
     """
-    user_model = UserJson(username=user.old_username, password=user.password)
-    auth_result = authenticate_user(user_model)  # will raise errors if user doesnt exist/password is wrong
+    # will raise errors if user doesnt exist/password is wrong
+    user_id = await resolve_user(user.old_username, user.password, authorization,
+                                 login_throttle.client_ip(request))
 
-    with db.engine.begin() as conn:
-        result = conn.execute(
-            sqlalchemy.select(db.users.c.user_id).
-            where(db.users.c.username == user.new_username)
-        ).fetchall()
-        if result:
+    async with db.begin() as conn:
+        result = (await conn.execute(RENAME_USER, [{'user_id': user_id, 'username': user.new_username}])).one()
+        if result.taken:
             raise HTTPException(status_code=409, detail='name already in use')
 
-        result = conn.execute(
-            sqlalchemy.update(db.users).
-            where(db.users.c.user_id == auth_result['user_id']).
-            values(username=user.new_username)
-        )
-
-        if result.rowcount > 0:
+        if result.updated > 0:
             return {'result': 'update successful'}
         else:
-            conn.rollback()
+            await conn.rollback()
             raise HTTPException(status_code=500, detail='update went wrong, action rolled back')
 
 
 @router.put("/users/update/password", tags=["users"])
-def update_password(user: UserUpdatePasswordJson):
+async def update_password(user: UserUpdatePasswordJson, request: Request,
+                          authorization: Optional[str] = Header(default=None)):
     """
-    This endpoint takes in a `username` and `password` and a new desired password.
+    This endpoint takes in a `username` and `old_password`, or a session token
+    and `old_password`, and a new desired password. The old password is always
+    required, so a leaked session token cannot take over the account.
 
-    If the user is authenticated, then the password will be changed.
+    If the user is authenticated, then the password will be changed and every
+    session token issued to the user is revoked.
 
     Returns success upon a successful update.
     Errors if the user doesn't exist or authentication fails.
     """
-    user_model = UserJson(username=user.username, password=user.old_password)
-    auth_result = authenticate_user(user_model)  # will raise errors if user doesnt exist/password is wrong
+    if user.old_password is None:
+        raise HTTPException(status_code=401, detail='old_password is required to change the password')
+    client_ip = login_throttle.client_ip(request)
+
+    # will raise errors if user doesnt exist/password is wrong
+    if authorization:
+        user_id = session_claims(authorization)["sub"]
+        async with db.connect() as conn:
+            username = (await conn.execute(
+                sqlalchemy.select(db.users.c.username).where(db.users.c.user_id == user_id)
+            )).scalar_one_or_none()
+        if username is None:
+            raise HTTPException(status_code=404, detail='user does not exist')
+        await verify_credentials(username, user.old_password, client_ip)
+    else:
+        user_id = await resolve_user(user.username, user.old_password, None, client_ip)
 
     update = sqlalchemy.text(
         """
-        UPDATE users SET password = crypt(:password, gen_salt('bf'))
+        UPDATE users SET password = (:password)
         WHERE users.user_id = (:user_id)
         """
     ).bindparams(
-        sqlalchemy.bindparam('user_id', auth_result['user_id']),
-        sqlalchemy.bindparam('password', user.new_password),
+        sqlalchemy.bindparam('user_id', user_id),
+        sqlalchemy.bindparam('password', await passwords.hash_password(user.new_password)),
     )
 
-    with db.engine.begin() as conn:
-        result = conn.execute(update)
+    async with db.begin() as conn:
+        result = await conn.execute(update)
 
         if result.rowcount > 0:
+            sessions.revoke_user(user_id)
             return {'result': 'update successful'}
         else:
-            conn.rollback()
-            raise HTTPException(status_code=500, detail='update went wrong, action rolled back')
\ No newline at end of file
+            await conn.rollback()
+            raise HTTPException(status_code=500, detail='update went wrong, action rolled back')
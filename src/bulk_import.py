@@ -0,0 +1,154 @@
+"""
+Bulk user import.
+
+Reads users from a CSV (with `username` and `password` columns) or JSONL
+stream, hashes the passwords on a process pool across every core, and inserts
+them in batches with `INSERT ... ON CONFLICT (username) DO NOTHING`. Usernames
+that already exist are reported as duplicates and never hashed. Every row is
+read and checked before the first insert, so a malformed row imports nothing.
+
+Usage:
+    python -m src.bulk_import users.csv
+    python -m src.bulk_import --format jsonl --batch-size 2000 - < users.jsonl
+"""
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+
+from src import database as db
+from src import passwords
+
+# Duplicates beyond this many are counted but not listed.
+MAX_REPORTED_DUPLICATES = 1000
+
+
+def read_users(stream, format: str = "csv"):
+    """
+    Yields `{"username": ..., "password": ...}` dictionaries from a text stream.
+    """
+    if format == "csv":
+        rows = csv.DictReader(stream, skipinitialspace=True)
+    elif format == "jsonl":
+        rows = (json.loads(line) for line in stream if line.strip())
+    else:
+        raise ValueError("format must be csv or jsonl")
+
+    for number, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            raise ValueError(f"row {number} is not a JSON object")
+        username = row.get("username")
+        password = row.get("password")
+        if not username or not password:
+            raise ValueError(f"row {number} is missing a username or password")
+        # JSONL values can be numbers, lists or objects.
+        if not isinstance(username, str) or not isinstance(password, str):
+            raise ValueError(f"row {number} has a username or password that is not a string")
+        yield {"username": username, "password": password}
+
+
+def _batches(users, batch_size: int):
+    batch = []
+    for user in users:
+        batch.append(user)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_users(users, batch_size: int = 1000, workers: int = None) -> dict:
+    """
+    Imports an iterable of users and returns a report with keys:
+    * `inserted`: The number of users added.
+    * `duplicates`: The number of usernames that were already taken or repeated.
+    * `duplicate_usernames`: The first duplicate usernames found.
+    * `seconds`: Wall clock time of the import.
+    * `users_per_second`: Throughput over the whole import.
+    """
+    # Raises on a malformed row before anything is inserted.
+    users = list(users)
+    report = {"inserted": 0, "duplicates": 0, "duplicate_usernames": []}
+
+    def duplicate(username):
+        report["duplicates"] += 1
+        if len(report["duplicate_usernames"]) < MAX_REPORTED_DUPLICATES:
+            report["duplicate_usernames"].append(username)
+
+    started = time.perf_counter()
+    # Spawned rather than forked: the API calls this from a process with running
+    # threads, whose locks a forked child could inherit held.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for batch in _batches(users, batch_size):
+            unique = {}
+            for user in batch:
+                if user["username"] in unique:
+                    duplicate(user["username"])
+                else:
+                    unique[user["username"]] = user["password"]
+
+            with db.engine.connect() as conn:
+                taken = conn.execute(
+                    sqlalchemy.select(db.users.c.username)
+                    .where(db.users.c.username.in_(list(unique)))
+                ).scalars().all()
+            for username in taken:
+                duplicate(username)
+                del unique[username]
+            if not unique:
+                continue
+
+            hashes = passwords.hash_many(unique.values(), executor)
+            with db.engine.begin() as conn:
+                inserted = conn.execute(
+                    insert(db.users)
+                    .values([{"username": username, "password": hashed}
+                             for username, hashed in zip(unique, hashes)])
+                    .on_conflict_do_nothing(index_elements=["username"])
+                    .returning(db.users.c.username)
+                ).scalars().all()
+
+            report["inserted"] += len(inserted)
+            # Someone may have taken a name between the check and the insert.
+            for username in set(unique) - set(inserted):
+                duplicate(username)
+
+    report["seconds"] = time.perf_counter() - started
+    total = report["inserted"] + report["duplicates"]
+    report["users_per_second"] = total / report["seconds"] if report["seconds"] > 0 else 0.0
+    return report
+
+
+def import_text(text: str, format: str = "csv", batch_size: int = 1000, workers: int = None) -> dict:
+    return import_users(read_users(io.StringIO(text), format), batch_size, workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import users from a CSV or JSONL file.")
+    parser.add_argument("path", help="file to import, or - for stdin")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default=None,
+                        help="defaults to the file extension, or csv")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=None, help="hashing processes, defaults to every core")
+    args = parser.parse_args()
+
+    format = args.format or ("jsonl" if args.path.endswith((".jsonl", ".ndjson")) else "csv")
+    if args.path == "-":
+        report = import_users(read_users(sys.stdin, format), args.batch_size, args.workers)
+    else:
+        with open(args.path, mode="r", encoding="utf-8", newline="") as f:
+            report = import_users(read_users(f, format), args.batch_size, args.workers)
+
+    print(f"inserted: {report['inserted']}")
+    print(f"duplicates: {report['duplicates']}")
+    for username in report["duplicate_usernames"]:
+        print(f"  {username}")
+    print(f"{report['users_per_second']:.0f} users/s over {report['seconds']:.2f}s")
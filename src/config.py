@@ -0,0 +1,36 @@
+import os
+import dotenv
+
+# Settings are read from the environment (or `.env`) the same way the database
+# credentials are. Helpers here only parse, they never hardcode deployment values.
+dotenv.load_dotenv()
+
+
+def get_str(name: str, default: str = "") -> str:
+    return os.environ.get(name, default)
+
+
+def get_bool(name: str, default: bool = False) -> bool:
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return int(value)
+
+
+def get_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return float(value)
+
+
+# The serverless profile, see `src/api/serverless.py`. Read here so the database
+# layer can tell without importing the API.
+SERVERLESS = get_bool("SERVERLESS")
@@ -1,7 +1,17 @@
+import contextlib
+import contextvars
 import os
+import time
+import uuid
 import sqlalchemy
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
 import dotenv
+from src import config
+from src import pool_metrics
+from src import query_budget
+from src import sql_metrics
 
 # DO NOT CHANGE THIS TO BE HARDCODED. ONLY PULL FROM ENVIRONMENT VARIABLES.
 def database_connection_url():
@@ -13,8 +23,246 @@ def database_connection_url():
     DB_NAME: str = os.environ.get("POSTGRES_DB")
     return f"postgresql://{DB_USER}:{DB_PASSWD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
 
+# Routers run on the async engine (asyncpg) unless DB_ASYNC is turned off, in which
+# case every statement is run on the sync engine in the threadpool instead.
+ASYNC = config.get_bool("DB_ASYNC", True)
+
+# Pool settings apply to both engines. Pools hold connections bound to one event loop,
+# so anything that creates a fresh loop per request (such as TestClient outside of a
+# `with` block) must set DB_NULL_POOL.
+POOL_SIZE = config.get_int("DB_POOL_SIZE", 5)
+MAX_OVERFLOW = config.get_int("DB_MAX_OVERFLOW", 10)
+POOL_TIMEOUT = config.get_float("DB_POOL_TIMEOUT", 30)
+POOL_RECYCLE = config.get_int("DB_POOL_RECYCLE", -1)
+POOL_PRE_PING = config.get_bool("DB_POOL_PRE_PING")
+
+# Serverless instances (see `src/api/serverless.py`) are short-lived and may run
+# many at once, so by default they keep no idle connections.
+NULL_POOL = config.get_bool("DB_NULL_POOL", config.SERVERLESS)
+
+
+def pool_options(poolclass) -> dict:
+    if NULL_POOL:
+        return {"poolclass": NullPool}
+    return {
+        "poolclass": poolclass,
+        "pool_size": POOL_SIZE,
+        "max_overflow": MAX_OVERFLOW,
+        "pool_timeout": POOL_TIMEOUT,
+        "pool_recycle": POOL_RECYCLE,
+        "pool_pre_ping": POOL_PRE_PING,
+    }
+
+
+# Optional read replica. Only the host has to be given, the rest defaults to the
+# primary's settings.
+def read_database_connection_url():
+    dotenv.load_dotenv()
+    DB_SERVER: str = os.environ.get("POSTGRES_READ_SERVER")
+    if not DB_SERVER:
+        return None
+    DB_USER: str = os.environ.get("POSTGRES_READ_USER", os.environ.get("POSTGRES_USER"))
+    DB_PASSWD = os.environ.get("POSTGRES_READ_PASSWORD", os.environ.get("POSTGRES_PASSWORD"))
+    DB_PORT: str = os.environ.get("POSTGRES_READ_PORT", os.environ.get("POSTGRES_PORT"))
+    DB_NAME: str = os.environ.get("POSTGRES_READ_DB", os.environ.get("POSTGRES_DB"))
+    return f"postgresql://{DB_USER}:{DB_PASSWD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
+
+
+def _async_url(url: str) -> str:
+    return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+def async_connect_args() -> dict:
+    """
+    Serverless instances connect through a transaction-pooling proxy such as
+    pgbouncer, which may run each transaction on a different server connection
+    and hand the same one to many clients. asyncpg then must not reuse prepared
+    statements, and the ones it prepares need names unique across clients.
+    """
+    if not config.SERVERLESS:
+        return {}
+    import asyncpg
+
+    class UniquelyNamedConnection(asyncpg.Connection):
+        # asyncpg numbers statements __asyncpg_stmt_1__, __asyncpg_stmt_2__, ...
+        # per connection, which collide between clients sharing a server
+        # connection. SQLAlchemy 2.0.7 has no prepared_statement_name_func yet.
+        def _get_unique_id(self, prefix):
+            return "__asyncpg_%s_%s__" % (prefix, uuid.uuid4())
+
+    return {
+        "statement_cache_size": 0,
+        "prepared_statement_cache_size": 0,
+        "connection_class": UniquelyNamedConnection,
+    }
+
+
 # Create a new DB engine based on our connection string
-engine = create_engine(database_connection_url())
+engine = create_engine(database_connection_url(), **pool_options(pool_metrics.InstrumentedQueuePool))
+pool_metrics.instrument(engine, "sync")
+sql_metrics.instrument(engine)
+query_budget.instrument(engine)
+
+async_engine = None
+if ASYNC:
+    from sqlalchemy.ext.asyncio import create_async_engine
+    async_engine = create_async_engine(
+        _async_url(database_connection_url()),
+        connect_args=async_connect_args(),
+        **pool_options(pool_metrics.InstrumentedAsyncQueuePool)
+    )
+    pool_metrics.instrument(async_engine.sync_engine, "async")
+    sql_metrics.instrument(async_engine.sync_engine)
+    query_budget.instrument(async_engine.sync_engine)
+
+read_engine = None
+read_async_engine = None
+if read_database_connection_url():
+    read_engine = create_engine(read_database_connection_url(),
+                                **pool_options(pool_metrics.InstrumentedQueuePool))
+    pool_metrics.instrument(read_engine, "read_sync")
+    sql_metrics.instrument(read_engine)
+    query_budget.instrument(read_engine)
+    if ASYNC:
+        read_async_engine = create_async_engine(
+            _async_url(read_database_connection_url()),
+            connect_args=async_connect_args(),
+            **pool_options(pool_metrics.InstrumentedAsyncQueuePool)
+        )
+        pool_metrics.instrument(read_async_engine.sync_engine, "read_async")
+        sql_metrics.instrument(read_async_engine.sync_engine)
+        query_budget.instrument(read_async_engine.sync_engine)
+
+# After the replica fails to connect, reads stay on the primary for this long.
+READ_RETRY_SECONDS = config.get_float("DB_READ_RETRY_SECONDS", 30)
+_replica_down_until = 0.0
+replica_fallbacks = 0
+
+# Set per request by the read routing middleware, see `src/api/read_routing.py`.
+_read_from_replica = contextvars.ContextVar("read_from_replica", default=False)
+
+
+def after_fork():
+    """
+    Called in a worker process right after it is forked from one that already
+    created the engines. Drops the pooled connections inherited from the parent
+    without closing them, since the parent still owns them.
+    """
+    for sync_engine in (engine, read_engine,
+                        async_engine and async_engine.sync_engine,
+                        read_async_engine and read_async_engine.sync_engine):
+        if sync_engine is not None:
+            sync_engine.dispose(close=False)
+
+
+def route_reads_to_replica(enabled: bool):
+    """
+    Sets whether `connect()` may use the read replica in the current context.
+    Returns a token for `reset_read_routing`.
+    """
+    return _read_from_replica.set(enabled)
+
+
+def reset_read_routing(token):
+    _read_from_replica.reset(token)
+
+
+class ThreadedConnection:
+    """
+    Wraps a sync `Connection` in the same awaitable interface as `AsyncConnection`,
+    running each call in the threadpool. Used when DB_ASYNC is off.
+    """
+    def __init__(self, sync_connection):
+        self.sync_connection = sync_connection
+
+    async def execute(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_connection.execute, *args, **kwargs)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_connection.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_connection.rollback)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_in_threadpool(fn, self.sync_connection, *args, **kwargs)
+
+
+@contextlib.asynccontextmanager
+async def _threaded(factory):
+    # Both creating the context (engine.connect) and entering it (engine.begin) can
+    # block on the network, so neither happens on the event loop.
+    def enter():
+        context = factory()
+        return context, context.__enter__()
+
+    context, conn = await run_in_threadpool(enter)
+    try:
+        yield ThreadedConnection(conn)
+    except BaseException as e:
+        await run_in_threadpool(context.__exit__, type(e), e, e.__traceback__)
+        raise
+    else:
+        await run_in_threadpool(context.__exit__, None, None, None)
+
+
+def _connect_primary():
+    if ASYNC:
+        return async_engine.connect()
+    return _threaded(engine.connect)
+
+
+@contextlib.asynccontextmanager
+async def _connect_replica():
+    global _replica_down_until, replica_fallbacks
+    conn = None
+    try:
+        if ASYNC:
+            conn = read_async_engine.connect()
+            await conn.start()
+        else:
+            conn = await run_in_threadpool(read_engine.connect)
+    except (sqlalchemy.exc.DBAPIError, OSError):
+        conn = None
+        _replica_down_until = time.monotonic() + READ_RETRY_SECONDS
+        replica_fallbacks += 1
+
+    if conn is None:
+        async with _connect_primary() as primary:
+            yield primary
+    elif ASYNC:
+        try:
+            yield conn
+        finally:
+            await conn.close()
+    else:
+        async with _threaded(lambda: conn) as threaded:
+            yield threaded
+
+
+def connect():
+    """
+    `async with db.connect() as conn:` gives a connection whose `execute`,
+    `commit` and `rollback` are awaited. Results come back fully buffered.
+
+    Inside read-only requests this connects to the read replica when one is
+    configured, falling back to the primary if the replica is unreachable.
+    """
+    if (read_engine is not None and _read_from_replica.get()
+            and time.monotonic() >= _replica_down_until):
+        return _connect_replica()
+    return _connect_primary()
+
+
+def begin():
+    """
+    Like `connect()`, but runs the block in a transaction on the primary that
+    commits on exit and rolls back on error.
+    """
+    if ASYNC:
+        return async_engine.begin()
+    return _threaded(engine.begin)
+
 
 convention = {
     "ix": "ix_%(column_0_label)s",
@@ -25,14 +273,123 @@ convention = {
 }
 
 metadata_obj = sqlalchemy.MetaData(naming_convention=convention)
-fighters = sqlalchemy.Table("fighters", metadata_obj, autoload_with=engine)
-fights = sqlalchemy.Table("fights", metadata_obj, autoload_with=engine)
-events = sqlalchemy.Table("events", metadata_obj, autoload_with=engine)
-fighter_stats = sqlalchemy.Table("fighter_stats", metadata_obj, autoload_with=engine)
-events = sqlalchemy.Table("events", metadata_obj, autoload_with=engine)
-stances = sqlalchemy.Table("stances", metadata_obj, autoload_with=engine)
-victory_methods = sqlalchemy.Table("victory_methods", metadata_obj, autoload_with=engine)
-weight_classes = sqlalchemy.Table("weight_classes", metadata_obj, autoload_with=engine)
-venue = sqlalchemy.Table("venue", metadata_obj, autoload_with=engine)
-predictions = sqlalchemy.Table("predictions", metadata_obj, autoload_with=engine)
-users = sqlalchemy.Table("users", metadata_obj, autoload_with=engine)
+
+# Tables are declared here to match the Alembic migrations rather than reflected, so
+# importing this module does not need the database. `python -m src.database` checks
+# the live schema against these declarations.
+stances = sqlalchemy.Table(
+    "stances", metadata_obj,
+    sqlalchemy.Column("id", sqlalchemy.Integer, sqlalchemy.Identity(), primary_key=True, nullable=False),
+    sqlalchemy.Column("stance", sqlalchemy.Text, nullable=False),
+)
+victory_methods = sqlalchemy.Table(
+    "victory_methods", metadata_obj,
+    sqlalchemy.Column("id", sqlalchemy.Integer, sqlalchemy.Identity(), primary_key=True, nullable=False),
+    sqlalchemy.Column("method", sqlalchemy.Text),
+)
+weight_classes = sqlalchemy.Table(
+    "weight_classes", metadata_obj,
+    sqlalchemy.Column("id", sqlalchemy.Integer, sqlalchemy.Identity(), primary_key=True, nullable=False),
+    sqlalchemy.Column("class", sqlalchemy.Text),
+)
+fighters = sqlalchemy.Table(
+    "fighters", metadata_obj,
+    sqlalchemy.Column("fighter_id", sqlalchemy.Integer, sqlalchemy.Identity(), primary_key=True, nullable=False),
+    sqlalchemy.Column("first_name", sqlalchemy.Text),
+    sqlalchemy.Column("last_name", sqlalchemy.Text),
+    sqlalchemy.Column("height", sqlalchemy.Integer),
+    sqlalchemy.Column("reach", sqlalchemy.Integer),
+    sqlalchemy.Column("stance_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("stances.id")),
+)
+fighter_stats = sqlalchemy.Table(
+    "fighter_stats", metadata_obj,
+    sqlalchemy.Column("stats_id", sqlalchemy.BigInteger, sqlalchemy.Identity(), primary_key=True, nullable=False),
+    sqlalchemy.Column("kd", sqlalchemy.Integer, server_default="0"),
+    sqlalchemy.Column("strikes", sqlalchemy.Integer, server_default="0"),
+    sqlalchemy.Column("td", sqlalchemy.Integer, server_default="0"),
+    sqlalchemy.Column("sub", sqlalchemy.Integer, server_default="0"),
+    sqlalchemy.Column("fighter_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("fighters.fighter_id"), nullable=False),
+)
+venue = sqlalchemy.Table(
+    "venue", metadata_obj,
+    sqlalchemy.Column("venue_id", sqlalchemy.Integer, sqlalchemy.Identity(), primary_key=True, nullable=False),
+    sqlalchemy.Column("venue_name", sqlalchemy.Text, unique=True),
+)
+events = sqlalchemy.Table(
+    "events", metadata_obj,
+    sqlalchemy.Column("event_id", sqlalchemy.Integer, sqlalchemy.Identity(), primary_key=True, nullable=False),
+    sqlalchemy.Column("event_name", sqlalchemy.Text, server_default=""),
+    sqlalchemy.Column("event_date", sqlalchemy.DateTime),
+    sqlalchemy.Column("venue_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("venue.venue_id")),
+    sqlalchemy.Column("attendance", sqlalchemy.Integer),
+)
+fights = sqlalchemy.Table(
+    "fights", metadata_obj,
+    sqlalchemy.Column("fight_id", sqlalchemy.BigInteger, sqlalchemy.Identity(), primary_key=True, nullable=False),
+    sqlalchemy.Column("event_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("events.event_id")),
+    sqlalchemy.Column("result", sqlalchemy.Integer),
+    sqlalchemy.Column("fighter1_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("fighters.fighter_id"), nullable=False),
+    sqlalchemy.Column("fighter2_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("fighters.fighter_id"), nullable=False),
+    sqlalchemy.Column("weight_class", sqlalchemy.Integer, sqlalchemy.ForeignKey("weight_classes.id"), nullable=False),
+    sqlalchemy.Column("method_of_vic", sqlalchemy.Integer, sqlalchemy.ForeignKey("victory_methods.id")),
+    sqlalchemy.Column("round_num", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("round_time", sqlalchemy.Text),
+    sqlalchemy.Column("stats1_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("fighter_stats.stats_id"), nullable=False),
+    sqlalchemy.Column("stats2_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("fighter_stats.stats_id"), nullable=False),
+)
+users = sqlalchemy.Table(
+    "users", metadata_obj,
+    sqlalchemy.Column("user_id", sqlalchemy.Integer, sqlalchemy.Identity(), primary_key=True, nullable=False),
+    sqlalchemy.Column("username", sqlalchemy.Text, nullable=False, unique=True),
+    sqlalchemy.Column("password", sqlalchemy.Text, nullable=False),
+)
+predictions = sqlalchemy.Table(
+    "predictions", metadata_obj,
+    sqlalchemy.Column("prediction_id", sqlalchemy.Integer, sqlalchemy.Identity(), primary_key=True, nullable=False),
+    sqlalchemy.Column("fight_id", sqlalchemy.BigInteger, sqlalchemy.ForeignKey("fights.fight_id"), nullable=False),
+    sqlalchemy.Column("fighter_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("fighters.fighter_id"), nullable=False),
+    sqlalchemy.Column("user_id", sqlalchemy.Integer,
+                      sqlalchemy.ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False),
+    sqlalchemy.Column("created_at", sqlalchemy.TIMESTAMP, nullable=False, server_default=sqlalchemy.func.now()),
+    sqlalchemy.UniqueConstraint("fight_id", "user_id"),
+)
+
+
+def schema_drift(conn) -> list:
+    """
+    Compares the declared tables with the live database through `conn` and
+    returns a list of differences. An empty list means no drift.
+    """
+    inspector = sqlalchemy.inspect(conn)
+    dialect = conn.dialect
+    existing = set(inspector.get_table_names())
+    drift = []
+    for table in metadata_obj.sorted_tables:
+        if table.name not in existing:
+            drift.append(f"{table.name}: table missing from database")
+            continue
+        live = {column["name"]: column for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in live:
+                drift.append(f"{table.name}.{column.name}: column missing from database")
+                continue
+            declared_type = column.type.compile(dialect=dialect)
+            live_type = live[column.name]["type"].compile(dialect=dialect)
+            if declared_type != live_type:
+                drift.append(f"{table.name}.{column.name}: declared {declared_type}, database has {live_type}")
+            if column.nullable != live[column.name]["nullable"]:
+                drift.append(f"{table.name}.{column.name}: declared nullable={column.nullable}, "
+                             f"database has nullable={live[column.name]['nullable']}")
+        for name in live.keys() - table.columns.keys():
+            drift.append(f"{table.name}.{name}: column not declared in src/database.py")
+    return drift
+
+
+if __name__ == "__main__":
+    with engine.connect() as conn:
+        differences = schema_drift(conn)
+    for difference in differences:
+        print(difference)
+    if differences:
+        raise SystemExit(1)
+    print("schema matches src/database.py")
@@ -0,0 +1,253 @@
+"""
+Failed-login throttling.
+
+Every password check costs a bcrypt verification, so repeated bad passwords
+are limited per username and per client IP with a sliding window. Once a key
+has `LOGIN_THROTTLE_MAX_FAILURES_*` failures inside the last
+`LOGIN_THROTTLE_WINDOW_SECONDS`, it is locked out for
+`LOGIN_THROTTLE_LOCKOUT_SECONDS`, doubling with every further lockout up to
+`LOGIN_THROTTLE_LOCKOUT_MAX_SECONDS`. Locked out requests are rejected before
+any user lookup or hashing happens.
+
+By default the counters live in process memory. With
+`LOGIN_THROTTLE_BACKEND=postgres` they are kept in the `login_failures` and
+`login_lockouts` tables instead so every worker shares them.
+"""
+import threading
+import time
+from collections import deque
+
+import sqlalchemy
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from src import config
+
+WINDOW_SECONDS = config.get_float("LOGIN_THROTTLE_WINDOW_SECONDS", 300)
+MAX_FAILURES_USER = config.get_int("LOGIN_THROTTLE_MAX_FAILURES_USER", 5)
+MAX_FAILURES_IP = config.get_int("LOGIN_THROTTLE_MAX_FAILURES_IP", 20)
+LOCKOUT_SECONDS = config.get_float("LOGIN_THROTTLE_LOCKOUT_SECONDS", 30)
+LOCKOUT_MAX_SECONDS = config.get_float("LOGIN_THROTTLE_LOCKOUT_MAX_SECONDS", 3600)
+TRUST_FORWARDED = config.get_bool("LOGIN_THROTTLE_TRUST_FORWARDED")
+
+
+class MemoryBackend:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures = {}  # key -> deque of failure times
+        self._lockouts = {}  # key -> [locked_until, number of lockouts]
+
+    def locked_until(self, key: str) -> float:
+        with self._lock:
+            lockout = self._lockouts.get(key)
+            return lockout[0] if lockout else 0.0
+
+    def add_failure(self, key: str, now: float) -> int:
+        with self._lock:
+            failures = self._failures.setdefault(key, deque())
+            failures.append(now)
+            while failures and failures[0] <= now - WINDOW_SECONDS:
+                failures.popleft()
+            return len(failures)
+
+    def lock(self, key: str, now: float) -> float:
+        with self._lock:
+            lockout = self._lockouts.setdefault(key, [0.0, 0])
+            lockout[1] += 1
+            lockout[0] = now + min(LOCKOUT_SECONDS * 2 ** (lockout[1] - 1), LOCKOUT_MAX_SECONDS)
+            self._failures.pop(key, None)
+            return lockout[0]
+
+    def clear(self, key: str):
+        with self._lock:
+            self._failures.pop(key, None)
+            self._lockouts.pop(key, None)
+
+    def prune(self, now: float):
+        with self._lock:
+            for key in [k for k, v in self._failures.items() if not v or v[-1] <= now - WINDOW_SECONDS]:
+                del self._failures[key]
+            # Lockout history is kept until it has been quiet for the longest lockout,
+            # so a returning attacker keeps escalating.
+            for key in [k for k, v in self._lockouts.items() if v[0] <= now - LOCKOUT_MAX_SECONDS]:
+                del self._lockouts[key]
+
+    def tracked_keys(self) -> int:
+        return len(self._failures) + len(self._lockouts)
+
+
+class PostgresBackend:
+    def __init__(self):
+        # Imported here so the in-memory mode does not need the database module.
+        from src import database as db
+        self.db = db
+
+    def locked_until(self, key: str) -> float:
+        with self.db.engine.connect() as conn:
+            result = conn.execute(
+                sqlalchemy.text("SELECT locked_until FROM login_lockouts WHERE key = :key"),
+                [{"key": key}]
+            ).first()
+        return result.locked_until if result else 0.0
+
+    def add_failure(self, key: str, now: float) -> int:
+        with self.db.engine.begin() as conn:
+            conn.execute(
+                sqlalchemy.text("DELETE FROM login_failures WHERE key = :key AND failed_at <= :cutoff"),
+                [{"key": key, "cutoff": now - WINDOW_SECONDS}]
+            )
+            conn.execute(
+                sqlalchemy.text("INSERT INTO login_failures (key, failed_at) VALUES (:key, :now)"),
+                [{"key": key, "now": now}]
+            )
+            return conn.execute(
+                sqlalchemy.text("SELECT COUNT(*) FROM login_failures WHERE key = :key"),
+                [{"key": key}]
+            ).scalar()
+
+    def lock(self, key: str, now: float) -> float:
+        with self.db.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("DELETE FROM login_failures WHERE key = :key"), [{"key": key}])
+            return conn.execute(
+                sqlalchemy.text(
+                    """
+                    INSERT INTO login_lockouts (key, locked_until, lockouts)
+                    VALUES (:key, CAST(:now AS DOUBLE PRECISION) + CAST(:base AS DOUBLE PRECISION), 1)
+                    ON CONFLICT (key) DO UPDATE SET
+                        lockouts = login_lockouts.lockouts + 1,
+                        locked_until = CAST(:now AS DOUBLE PRECISION)
+                            + LEAST(CAST(:base AS DOUBLE PRECISION) * POWER(2, login_lockouts.lockouts),
+                                    CAST(:max AS DOUBLE PRECISION))
+                    RETURNING locked_until
+                    """
+                ),
+                [{"key": key, "now": now, "base": LOCKOUT_SECONDS, "max": LOCKOUT_MAX_SECONDS}]
+            ).scalar()
+
+    def clear(self, key: str):
+        with self.db.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("DELETE FROM login_failures WHERE key = :key"), [{"key": key}])
+            conn.execute(sqlalchemy.text("DELETE FROM login_lockouts WHERE key = :key"), [{"key": key}])
+
+    def prune(self, now: float):
+        with self.db.engine.begin() as conn:
+            conn.execute(
+                sqlalchemy.text("DELETE FROM login_failures WHERE failed_at <= :cutoff"),
+                [{"cutoff": now - WINDOW_SECONDS}]
+            )
+            conn.execute(
+                sqlalchemy.text("DELETE FROM login_lockouts WHERE locked_until <= :cutoff"),
+                [{"cutoff": now - LOCKOUT_MAX_SECONDS}]
+            )
+
+    def tracked_keys(self) -> int:
+        with self.db.engine.connect() as conn:
+            return conn.execute(
+                sqlalchemy.text(
+                    """
+                    SELECT (SELECT COUNT(DISTINCT key) FROM login_failures)
+                        + (SELECT COUNT(*) FROM login_lockouts)
+                    """
+                )
+            ).scalar()
+
+
+if config.get_str("LOGIN_THROTTLE_BACKEND", "memory") == "postgres":
+    backend = PostgresBackend()
+else:
+    backend = MemoryBackend()
+
+_counters_lock = threading.Lock()
+_counters = {
+    "checks": 0,
+    "rejected": 0,
+    "failures": 0,
+    "lockouts": 0,
+}
+_last_prune = 0.0
+
+
+def _count(name: str):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def _keys(username: str, client_ip: str):
+    keys = [("user:" + username, MAX_FAILURES_USER)]
+    if client_ip:
+        keys.append(("ip:" + client_ip, MAX_FAILURES_IP))
+    return keys
+
+
+def client_ip(request) -> str:
+    """
+    Returns the address of the client making `request`. `X-Forwarded-For` is only
+    trusted when the API runs behind a proxy that sets it.
+    """
+    if TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else ""
+
+
+async def _call(fn, *args):
+    # The postgres backend blocks on the sync engine, keep it off the event loop.
+    if isinstance(backend, MemoryBackend):
+        return fn(*args)
+    return await run_in_threadpool(fn, *args)
+
+
+async def check(username: str, client_ip: str):
+    await _call(_check, username, client_ip)
+
+
+async def record_failure(username: str, client_ip: str):
+    await _call(_record_failure, username, client_ip)
+
+
+async def record_success(username: str, client_ip: str):
+    await _call(_record_success, username, client_ip)
+
+
+def _check(username: str, client_ip: str):
+    """
+    Raises a 429 error if the username or client is locked out.
+    """
+    global _last_prune
+    now = time.time()
+    _count("checks")
+    if now - _last_prune > WINDOW_SECONDS:
+        _last_prune = now
+        backend.prune(now)
+
+    retry_after = 0.0
+    for key, _ in _keys(username, client_ip):
+        retry_after = max(retry_after, backend.locked_until(key) - now)
+    if retry_after > 0:
+        _count("rejected")
+        raise HTTPException(status_code=429,
+                            detail='too many failed login attempts, try again later',
+                            headers={"Retry-After": str(int(retry_after) + 1)})
+
+
+def _record_failure(username: str, client_ip: str):
+    now = time.time()
+    _count("failures")
+    for key, limit in _keys(username, client_ip):
+        if backend.add_failure(key, now) >= limit:
+            backend.lock(key, now)
+            _count("lockouts")
+
+
+def _record_success(username: str, client_ip: str):
+    # Only the account is cleared, a shared IP may still be guessing at others.
+    backend.clear("user:" + username)
+
+
+def stats() -> dict:
+    with _counters_lock:
+        counters = dict(_counters)
+    counters["backend"] = "postgres" if isinstance(backend, PostgresBackend) else "memory"
+    counters["tracked_keys"] = backend.tracked_keys()
+    return counters
@@ -0,0 +1,154 @@
+"""
+The enumeration tables `stances`, `weight_classes` and `victory_methods`.
+
+They hold a couple dozen rows that practically never change, so queries select
+the ids and leave the joins out, and endpoints decode the ids and validate the
+ids given to writes against the maps here. The tables are loaded into read-only
+maps at startup (or on first use) and reloaded after `LOOKUP_TTL_SECONDS` or by
+`POST /lookups/refresh`. A reload swaps in a whole new set of maps, so a request
+never sees a half updated one. Requests that find the maps expired wait for a
+single reload, and if it fails they keep being served the old maps.
+"""
+import asyncio
+import re
+import time
+from types import MappingProxyType
+
+import sqlalchemy
+
+from src import config
+from src import database as db
+from src import query_budget
+
+# Zero keeps the tables loaded until they are refreshed by hand.
+TTL_SECONDS = config.get_float("LOOKUP_TTL_SECONDS", 3600)
+# After a failed reload the old maps are served this long before the next try.
+RETRY_SECONDS = 30
+
+
+def _like_regex(pattern: str):
+    """
+    Compiles an ILIKE pattern, with `%`, `_` and `\\` escapes, to a regex.
+    """
+    parts = []
+    chars = iter(pattern)
+    for char in chars:
+        if char == "\\":
+            parts.append(re.escape(next(chars, "\\")))
+        elif char == "%":
+            parts.append(".*")
+        elif char == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(char))
+    return re.compile("".join(parts), re.IGNORECASE | re.DOTALL)
+
+
+class Lookup:
+    """
+    The id -> name map of one enumeration table.
+    """
+    def __init__(self, names: dict):
+        self.names = MappingProxyType(dict(names))
+
+    def name(self, id):
+        """
+        The name of `id`, or None for a null or unknown id.
+        """
+        return self.names.get(id)
+
+    def __contains__(self, id) -> bool:
+        return id in self.names
+
+    def ids_matching(self, pattern: str) -> list:
+        """
+        The ids whose name matches the ILIKE `pattern`. Like in SQL, a null name
+        matches nothing.
+        """
+        regex = _like_regex(pattern)
+        return [id for id, name in self.names.items() if name is not None and regex.fullmatch(name)]
+
+
+class Lookups:
+    def __init__(self, stances: dict, weight_classes: dict, victory_methods: dict):
+        self.stances = Lookup(stances)
+        self.weight_classes = Lookup(weight_classes)
+        self.victory_methods = Lookup(victory_methods)
+        self.loaded_at = time.monotonic()
+
+    def to_json(self) -> dict:
+        return {
+            "stances": dict(self.stances.names),
+            "weight_classes": dict(self.weight_classes.names),
+            "victory_methods": dict(self.victory_methods.names),
+        }
+
+
+# All three tables in one statement.
+LOOKUP_ROWS = sqlalchemy.union_all(
+    sqlalchemy.select(sqlalchemy.literal("stances").label("lookup"), db.stances.c.id,
+                      db.stances.c.stance.label("name")),
+    sqlalchemy.select(sqlalchemy.literal("weight_classes").label("lookup"), db.weight_classes.c.id,
+                      db.weight_classes.c["class"].label("name")),
+    sqlalchemy.select(sqlalchemy.literal("victory_methods").label("lookup"), db.victory_methods.c.id,
+                      db.victory_methods.c.method.label("name")),
+)
+
+_current = None
+_retry_at = 0.0
+_refresh_lock = None
+
+
+def load(conn) -> Lookups:
+    """
+    Reads the tables through a sync connection.
+    """
+    tables = {"stances": {}, "weight_classes": {}, "victory_methods": {}}
+    for row in conn.execute(LOOKUP_ROWS):
+        tables[row.lookup][row.id] = row.name
+    return Lookups(**tables)
+
+
+async def refresh() -> Lookups:
+    """
+    Reloads the tables from the database and swaps them in.
+    """
+    global _current
+    # Loading on first use happens inside whichever request came first, which
+    # should not pay for it out of its own statement budget.
+    with query_budget.exempt():
+        async with db.connect() as conn:
+            _current = await conn.run_sync(load)
+    return _current
+
+
+def _expired() -> bool:
+    if _current is None:
+        return True
+    now = time.monotonic()
+    return 0 < TTL_SECONDS < now - _current.loaded_at and now >= _retry_at
+
+
+async def get() -> Lookups:
+    """
+    The loaded tables, loading them first if they are not loaded yet or older
+    than `LOOKUP_TTL_SECONDS`. If reloading expired tables fails, they are
+    returned as they are.
+    """
+    global _refresh_lock, _retry_at
+    if not _expired():
+        return _current
+
+    if _refresh_lock is None:
+        _refresh_lock = asyncio.Lock()
+    async with _refresh_lock:
+        # Another request may have reloaded them while this one waited.
+        if not _expired():
+            return _current
+        try:
+            return await refresh()
+        except (sqlalchemy.exc.DBAPIError, OSError):
+            if _current is None:
+                raise
+            _retry_at = time.monotonic() + RETRY_SECONDS
+            return _current
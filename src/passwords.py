@@ -0,0 +1,83 @@
+"""
+Password hashing in the API tier.
+
+Hashes are bcrypt, compatible with the `crypt(..., gen_salt('bf'))` hashes
+pgcrypto produced before, so existing `$2a$` hashes keep verifying. The work runs
+on a bounded thread pool (bcrypt releases the GIL while hashing), which keeps a
+burst of logins from using more than `PASSWORD_HASH_WORKERS` cores per worker.
+Once `PASSWORD_HASH_MAX_PENDING` hashes are queued, further requests get a 503.
+The database only stores and returns hashes.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import bcrypt
+from fastapi import HTTPException
+
+from src import config
+
+ROUNDS = config.get_int("PASSWORD_HASH_ROUNDS", 6)  # pgcrypto's gen_salt('bf') default
+WORKERS = config.get_int("PASSWORD_HASH_WORKERS", os.cpu_count() or 1)
+MAX_PENDING = config.get_int("PASSWORD_HASH_MAX_PENDING", WORKERS * 8)
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="password-hash")
+_pending = threading.BoundedSemaphore(MAX_PENDING)
+
+
+def _secret(password: str) -> bytes:
+    # bcrypt only uses the first 72 bytes. pgcrypto truncated longer passwords
+    # silently, while bcrypt >= 5 raises instead, so truncate the same way to
+    # keep hashing them and verifying the hashes pgcrypto made of them.
+    return password.encode()[:72]
+
+
+def _hash(password: str, rounds: int) -> str:
+    # "2a" keeps the hashes readable by pgcrypto as well.
+    salt = bcrypt.gensalt(rounds=rounds, prefix=b"2a")
+    return bcrypt.hashpw(_secret(password), salt).decode()
+
+
+def _verify(password: str, hashed: str) -> bool:
+    try:
+        return bcrypt.checkpw(_secret(password), hashed.encode())
+    except ValueError:
+        # Not a bcrypt hash at all.
+        return False
+
+
+async def _run(fn, *args):
+    # Beyond MAX_PENDING queued hashes the worker is saturated; shed the request
+    # instead of letting latency grow without bound.
+    if not _pending.acquire(blocking=False):
+        raise HTTPException(status_code=503, detail='server busy, try again shortly')
+    try:
+        return await asyncio.wrap_future(_executor.submit(fn, *args))
+    finally:
+        _pending.release()
+
+
+async def hash_password(password: str, rounds: int = None) -> str:
+    """
+    Returns a bcrypt hash of `password`, computed on the hashing pool.
+    """
+    return await _run(_hash, password, rounds or ROUNDS)
+
+
+async def verify_password(password: str, hashed: str) -> bool:
+    """
+    Checks `password` against a stored bcrypt hash on the hashing pool.
+    """
+    return await _run(_verify, password, hashed)
+
+
+def hash_many(passwords, executor: ProcessPoolExecutor, rounds: int = None) -> list:
+    """
+    Hashes a batch of passwords on a process pool spanning every core. Meant for
+    bulk imports, where the request-sized thread pool is not enough.
+    """
+    passwords = list(passwords)
+    rounds = rounds or ROUNDS
+    chunksize = max(len(passwords) // ((os.cpu_count() or 1) * 4), 1)
+    return list(executor.map(_hash, passwords, [rounds] * len(passwords), chunksize=chunksize))
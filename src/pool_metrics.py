@@ -0,0 +1,125 @@
+"""
+Connection pool metrics.
+
+The engines in `src/database.py` use the instrumented pools below, which time
+how long each checkout waits for a connection and count checkout timeouts.
+Pool events add checkout, checkin, connect and invalidation counts. Reported
+at `/metrics/pool`.
+"""
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Upper bounds, in seconds, of the checkout wait histogram buckets.
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class PoolStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.pool = None
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.wait_counts = [0] * len(WAIT_BUCKETS)
+        self.wait_sum = 0.0
+        self.wait_count = 0
+
+    def record_wait(self, seconds: float):
+        with self.lock:
+            self.wait_sum += seconds
+            self.wait_count += 1
+            for i, bound in enumerate(WAIT_BUCKETS):
+                if seconds <= bound:
+                    self.wait_counts[i] += 1
+                    break
+
+    def count(self, name: str):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self) -> dict:
+        pool = self.pool
+        with self.lock:
+            cumulative = 0
+            histogram = {}
+            for bound, count in zip(WAIT_BUCKETS, self.wait_counts):
+                cumulative += count
+                histogram["+Inf" if bound == float("inf") else str(bound)] = cumulative
+            json = {
+                "pool": type(pool).__name__ if pool is not None else None,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "checkout_timeouts": self.timeouts,
+                "wait_seconds_sum": self.wait_sum,
+                "wait_seconds_count": self.wait_count,
+                "wait_seconds_buckets": histogram,
+            }
+        if isinstance(pool, QueuePool):
+            json["size"] = pool.size()
+            json["checked_out"] = pool.checkedout()
+            json["checked_in"] = pool.checkedin()
+            json["overflow"] = max(pool.overflow(), 0)
+            json["timeout"] = pool.timeout()
+        return json
+
+
+class _InstrumentedMixin:
+    _stats = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            if self._stats is not None:
+                self._stats.count("timeouts")
+            raise
+        if self._stats is not None:
+            self._stats.record_wait(time.perf_counter() - started)
+        return conn
+
+    def recreate(self):
+        pool = super().recreate()
+        pool._stats = self._stats
+        if self._stats is not None:
+            self._stats.pool = pool
+        return pool
+
+
+class InstrumentedQueuePool(_InstrumentedMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(_InstrumentedMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+stats = {}
+
+
+def instrument(engine, name: str):
+    """
+    Starts collecting metrics for `engine`'s pool under `name`. Pass the
+    `sync_engine` of an async engine.
+    """
+    pool_stats = PoolStats(name)
+    pool_stats.pool = engine.pool
+    engine.pool._stats = pool_stats
+    stats[name] = pool_stats
+
+    event.listen(engine, "checkout", lambda *args: pool_stats.count("checkouts"))
+    event.listen(engine, "checkin", lambda *args: pool_stats.count("checkins"))
+    event.listen(engine, "connect", lambda *args: pool_stats.count("connects"))
+    event.listen(engine, "invalidate", lambda *args: pool_stats.count("invalidations"))
+
+
+def snapshot() -> dict:
+    return {name: pool_stats.snapshot() for name, pool_stats in stats.items()}
@@ -10,8 +10,10 @@ import sqlalchemy
 import os
 import dotenv
 import random
+from concurrent.futures import ThreadPoolExecutor
 from faker import Faker
 import numpy as np
+import bcrypt
 
 def database_connection_url():
     dotenv.load_dotenv()
@@ -187,10 +189,19 @@ with engine.begin() as conn:
         CONSTRAINT fk_predictions_fighter_id_fighters FOREIGN KEY(fighter_id) REFERENCES fighters (fighter_id),
         CONSTRAINT fk_predictions_user_id_users FOREIGN KEY(user_id) REFERENCES users (user_id) ON DELETE CASCADE
     );
+
+    CREATE INDEX ix_predictions_user_id_created_at
+        ON predictions (user_id, created_at DESC, prediction_id DESC);
     """))
     print("TABLES CREATED")
     
 fake = Faker()
+# Set FAKE_DATA_SEED to generate the same dataset every run, e.g. for benchmarks.
+seed = os.environ.get("FAKE_DATA_SEED")
+if seed:
+    random.seed(int(seed))
+    np.random.seed(int(seed))
+    Faker.seed(int(seed))
 # 1 million total fake rows
 num_venues = 600
 num_events = 2500
@@ -200,7 +211,7 @@ num_fighters = 80000
 num_users = 20000
 num_predictions = 300000
 
-height_distribution = np.random.default_rng().normal(70, 10, num_fighters)
+height_distribution = np.random.default_rng(int(seed) if seed else None).normal(70, 10, num_fighters)
 stance_sample_distirbution = np.random.choice([1, 2, 3], num_fighters, p=[0.803, 0.174, 0.023])
 weight_class_sample_distribution = np.random.choice([1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14],
                                                     num_fights,
@@ -347,10 +358,20 @@ with engine.begin() as conn:
             "username": fake.unique.user_name(),
             "password": fake.sentence(),
         })
-    
+
+    # Hash here rather than with pgcrypto so the database isn't doing 20k bcrypts.
+    # bcrypt releases the GIL, so threads use every core.
+    def hash_password(password):
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=6, prefix=b"2a")).decode()
+
+    with ThreadPoolExecutor() as executor:
+        hashes = executor.map(hash_password, [user["password"] for user in users], chunksize=256)
+        for user, hashed in zip(users, hashes):
+            user["password"] = hashed
+
     conn.execute(sqlalchemy.text("""
     INSERT INTO users (username, password)
-    VALUES (:username, crypt(:password, gen_salt('bf')));
+    VALUES (:username, :password);
     """), users)
     print("USERS CREATED")
     users = None
@@ -0,0 +1,223 @@
+"""
+Write-behind buffer for prediction ingestion.
+
+When `PREDICTION_BUFFER_ENABLED` is set, `add_prediction` hands validated
+predictions to this buffer instead of committing its own transaction. A
+background thread flushes the queue every `PREDICTION_BUFFER_FLUSH_MS`
+milliseconds, or as soon as `PREDICTION_BUFFER_MAX_ROWS` rows are waiting,
+using a single multi-row `INSERT ... ON CONFLICT (fight_id, user_id) DO NOTHING`.
+
+Each submission returns a future that resolves to "accepted" or "duplicate"
+once the batch it belongs to has been committed. A row the database rejects
+(a constraint or data error) is found by splitting its batch in halves, so only
+its own future raises. `add_prediction` waits for it
+for at most `PREDICTION_BUFFER_TIMEOUT_SECONDS`. Once the buffer is shut down it
+refuses new predictions and is never restarted.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+
+from src import config
+from src import database as db
+
+ACCEPTED = "accepted"
+DUPLICATE = "duplicate"
+
+
+class PredictionBuffer:
+    def __init__(self, flush_ms: int = 50, max_rows: int = 500):
+        self.flush_interval = flush_ms / 1000
+        self.max_rows = max_rows
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._started_at = None
+
+        self._rows_accepted = 0
+        self._rows_duplicate = 0
+        self._rows_failed = 0
+        self._batches = 0
+        self._flush_seconds_total = 0.0
+        self._flush_seconds_max = 0.0
+        self._flush_seconds_last = 0.0
+
+    def _start(self):
+        # Called with the lock held.
+        if self._thread is not None:
+            return
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(
+            target=self._run, name="prediction-buffer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, fight_id: int, fighter_id: int, user_id: int) -> Future:
+        """
+        Queues a validated prediction. The returned future resolves to
+        `ACCEPTED` or `DUPLICATE`, or raises if the batch failed to insert.
+        """
+        future = Future()
+        # Under the lock, nothing is queued after shutdown's sentinel.
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("prediction buffer is shut down")
+            self._start()
+            self._queue.put(({"fight_id": fight_id,
+                              "fighter_id": fighter_id,
+                              "user_id": user_id}, future))
+        return future
+
+    def shutdown(self, timeout: float = 10.0):
+        """
+        Stops accepting predictions and flushes everything still queued.
+        """
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+            self._thread = None
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self) -> dict:
+        rows = self._rows_accepted + self._rows_duplicate
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0.0
+        return {
+            "enabled": True,
+            "flush_ms": int(self.flush_interval * 1000),
+            "max_rows": self.max_rows,
+            "queue_depth": self._queue.qsize(),
+            "batches": self._batches,
+            "rows_accepted": self._rows_accepted,
+            "rows_duplicate": self._rows_duplicate,
+            "rows_failed": self._rows_failed,
+            "rows_per_second": rows / elapsed if elapsed > 0 else 0.0,
+            "flush_latency_ms_last": self._flush_seconds_last * 1000,
+            "flush_latency_ms_avg": (self._flush_seconds_total / self._batches * 1000
+                                     if self._batches else 0.0),
+            "flush_latency_ms_max": self._flush_seconds_max * 1000,
+        }
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self.max_rows:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if stopping:
+                # Drain whatever arrived before the shutdown sentinel.
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        batch.append(item)
+            for start in range(0, len(batch), self.max_rows):
+                self._flush(batch[start:start + self.max_rows])
+
+    def _fail(self, batch, e: Exception):
+        self._rows_failed += len(batch)
+        for _, future in batch:
+            future.set_exception(e)
+
+    def _insert(self, rows) -> set:
+        """
+        Inserts `rows` in one statement, returning the (fight_id, user_id) of
+        those that were not already there.
+        """
+        stmt = (
+            insert(db.predictions)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=["fight_id", "user_id"])
+            .returning(db.predictions.c.fight_id, db.predictions.c.user_id)
+        )
+        with db.engine.begin() as conn:
+            return {(row.fight_id, row.user_id) for row in conn.execute(stmt)}
+
+    def _flush(self, batch):
+        if not batch:
+            return
+
+        # The same user can only have one prediction per fight, so later
+        # copies inside a batch are duplicates of the first one.
+        unique = {}
+        for values, future in batch:
+            unique.setdefault((values["fight_id"], values["user_id"]), values)
+
+        started = time.perf_counter()
+        try:
+            inserted = self._insert(list(unique.values()))
+        except (sqlalchemy.exc.IntegrityError, sqlalchemy.exc.DataError) as e:
+            if len(batch) == 1:
+                self._fail(batch, e)
+                return
+            # A bad row, such as one whose user was deleted after validation,
+            # fails the whole statement. Halve the batch until only it fails.
+            middle = len(batch) // 2
+            self._flush(batch[:middle])
+            self._flush(batch[middle:])
+            return
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        elapsed = time.perf_counter() - started
+
+        self._batches += 1
+        self._flush_seconds_last = elapsed
+        self._flush_seconds_total += elapsed
+        self._flush_seconds_max = max(self._flush_seconds_max, elapsed)
+
+        for values, future in batch:
+            key = (values["fight_id"], values["user_id"])
+            if key in inserted:
+                inserted.discard(key)
+                self._rows_accepted += 1
+                future.set_result(ACCEPTED)
+            else:
+                self._rows_duplicate += 1
+                future.set_result(DUPLICATE)
+
+
+# How long add_prediction waits for the batch of its prediction to commit.
+TIMEOUT_SECONDS = config.get_float("PREDICTION_BUFFER_TIMEOUT_SECONDS", 10)
+
+buffer = None
+if config.get_bool("PREDICTION_BUFFER_ENABLED"):
+    buffer = PredictionBuffer(
+        flush_ms=config.get_int("PREDICTION_BUFFER_FLUSH_MS", 50),
+        max_rows=config.get_int("PREDICTION_BUFFER_MAX_ROWS", 500),
+    )
+
+
+def enabled() -> bool:
+    return buffer is not None
+
+
+def shutdown():
+    if buffer is not None:
+        buffer.shutdown()
+
+
+def stats() -> dict:
+    if buffer is None:
+        return {"enabled": False}
+    return buffer.stats()
@@ -0,0 +1,94 @@
+"""
+Named server-side prepared statements for the hot `text()` queries.
+
+A `PreparedQuery` is declared once at import time with a name and its SQL, and
+run with `await query.execute(conn, params)`, which returns the fetched rows.
+Postgres then parses each query once per connection and, after a few runs,
+reuses a generic plan instead of planning it on every call.
+
+On asyncpg (the default) SQLAlchemy already prepares every statement on the
+server the first time a connection runs its SQL, so all that is needed is SQL
+that stays the same between calls. On psycopg2 (DB_ASYNC off), which would
+otherwise send the whole query every time, `PREPARE name AS ...` runs once per
+connection and `EXECUTE name(...)` after that.
+
+The names a connection has prepared are kept in its `info`, which SQLAlchemy
+empties when the connection is replaced. A run on a connection that already had
+the query prepared is a hit. Hits and misses per query are reported at
+`/metrics/prepared`.
+
+The serverless profile (`SERVERLESS`) runs the plain SQL instead: a named
+statement outlives its transaction, which transaction-pooling proxies do not
+allow, and without a pool it would never be reused anyway.
+"""
+import re
+import threading
+
+from src import config
+
+SERVER_SIDE = not config.SERVERLESS
+
+# Same as SQLAlchemy's pattern for `:name` binds in text(), which skips `::` casts.
+_binds = re.compile(r"(?<![:\w\\]):(\w+)(?!:)")
+
+_stats_lock = threading.Lock()
+_stats = {}  # name -> [hits, misses]
+
+
+class PreparedQuery:
+    def __init__(self, name: str, statement):
+        self.name = name
+        self.statement = statement
+        # Postgres numbers parameters, so each distinct bind becomes $1, $2, ...
+        # in order of first appearance.
+        self.params = []
+
+        def number(match):
+            if match.group(1) not in self.params:
+                self.params.append(match.group(1))
+            return "$%d" % (self.params.index(match.group(1)) + 1)
+
+        self._prepare_sql = "PREPARE %s AS %s" % (name, _binds.sub(number, statement.text))
+        self._execute_sql = "EXECUTE %s(%s)" % (name, ", ".join("%%(%s)s" % param for param in self.params))
+        with _stats_lock:
+            _stats.setdefault(name, [0, 0])
+
+    async def execute(self, conn, params: dict) -> list:
+        """
+        Runs the query on a connection from `db.connect()` or `db.begin()`.
+        """
+        return await conn.run_sync(self._run, params)
+
+    def _run(self, conn, params: dict) -> list:
+        if not SERVER_SIDE:
+            return conn.execute(self.statement, params).fetchall()
+        prepared = conn.info.setdefault("prepared_statements", set())
+        hit = self.name in prepared
+        if conn.dialect.driver == "asyncpg":
+            result = conn.execute(self.statement, params)
+        else:
+            if not hit:
+                # On the DBAPI cursor, so it does not count as one of the
+                # request's statements.
+                cursor = conn.connection.cursor()
+                try:
+                    cursor.execute(self._prepare_sql)
+                finally:
+                    cursor.close()
+            result = conn.exec_driver_sql(self._execute_sql, {param: params[param] for param in self.params})
+        prepared.add(self.name)
+        with _stats_lock:
+            _stats[self.name][0 if hit else 1] += 1
+        return result.fetchall()
+
+
+def stats() -> dict:
+    with _stats_lock:
+        return {
+            name: {
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+            }
+            for name, (hits, misses) in sorted(_stats.items())
+        }
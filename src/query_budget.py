@@ -0,0 +1,150 @@
+"""
+Per-route statement timeouts and statement budgets.
+
+Every transaction a request opens starts with `SET LOCAL statement_timeout`, so
+Postgres cancels a runaway statement and its connection goes back to the pool
+instead of being held for as long as the query runs. A request may also run at
+most a fixed number of statements.
+
+Both limits default to `DB_STATEMENT_TIMEOUT_MS` and `DB_MAX_STATEMENTS`, and a
+route can change them with `@query_budget.limit(...)`. Zero means no limit.
+
+The middleware in `src/api/query_budget_middleware.py` answers a cancelled
+statement with a 504 and a request over its statement budget with a 503.
+Violations per route are reported at `/metrics/query-budget`.
+"""
+import contextlib
+import contextvars
+import threading
+
+from sqlalchemy import event
+
+from src import config
+
+STATEMENT_TIMEOUT_MS = config.get_int("DB_STATEMENT_TIMEOUT_MS", 10000)
+MAX_STATEMENTS = config.get_int("DB_MAX_STATEMENTS", 100)
+
+# SQLSTATE of a statement cancelled by statement_timeout.
+QUERY_CANCELED = "57014"
+
+
+class StatementBudgetExceeded(Exception):
+    pass
+
+
+def limit(timeout_ms: int = None, max_statements: int = None):
+    """
+    Overrides the statement timeout and statement budget of an endpoint. Limits
+    left as None keep the defaults.
+    """
+    def decorate(endpoint):
+        endpoint.query_budget = (timeout_ms, max_statements)
+        return endpoint
+    return decorate
+
+
+class RequestBudget:
+    def __init__(self, scope):
+        # The router fills in scope["endpoint"] before the endpoint runs any SQL.
+        self.scope = scope
+        self.statements = 0
+        self._limits = None
+
+    def limits(self):
+        """
+        Returns (timeout_ms, max_statements) of the request's route.
+        """
+        if self._limits is None:
+            timeout_ms, max_statements = getattr(self.scope.get("endpoint"), "query_budget", (None, None))
+            self._limits = (STATEMENT_TIMEOUT_MS if timeout_ms is None else timeout_ms,
+                            MAX_STATEMENTS if max_statements is None else max_statements)
+        return self._limits
+
+
+_current = contextvars.ContextVar("query_budget", default=None)
+
+
+def start_request(scope):
+    """
+    Applies the budget of the request in `scope` to statements run in the
+    current context. Returns a token for `end_request`.
+    """
+    return _current.set(RequestBudget(scope))
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+@contextlib.contextmanager
+def exempt():
+    """
+    Runs the block without the current request's timeout and statement budget.
+    """
+    token = _current.set(None)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def is_timeout(error) -> bool:
+    """
+    Whether a DBAPIError is a statement cancelled by statement_timeout.
+    """
+    return getattr(error.orig, "pgcode", None) == QUERY_CANCELED
+
+
+_violations_lock = threading.Lock()
+_violations = {}  # route template -> {"statement_timeout": count, "statement_budget": count}
+
+
+def record_violation(route: str, kind: str):
+    with _violations_lock:
+        route_violations = _violations.setdefault(route, {"statement_timeout": 0, "statement_budget": 0})
+        route_violations[kind] += 1
+
+
+def stats() -> dict:
+    with _violations_lock:
+        routes = {route: dict(route_violations) for route, route_violations in sorted(_violations.items())}
+    return {
+        "statement_timeout_ms": STATEMENT_TIMEOUT_MS,
+        "max_statements": MAX_STATEMENTS,
+        "routes": routes,
+    }
+
+
+def _begin(conn):
+    budget = _current.get()
+    if budget is None:
+        return
+    timeout_ms = budget.limits()[0]
+    if timeout_ms <= 0:
+        return
+    # Straight on the DBAPI cursor, since executing through `conn` would begin
+    # another transaction. The driver starts the transaction with this statement.
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("SET LOCAL statement_timeout = %d" % timeout_ms)
+    finally:
+        cursor.close()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    budget = _current.get()
+    if budget is None:
+        return
+    budget.statements += 1
+    max_statements = budget.limits()[1]
+    if 0 < max_statements < budget.statements:
+        raise StatementBudgetExceeded("request ran more than %d SQL statements" % max_statements)
+
+
+def instrument(engine):
+    """
+    Applies the current request's budget to statements run on `engine`. Pass
+    the `sync_engine` of an async engine.
+    """
+    event.listen(engine, "begin", _begin)
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
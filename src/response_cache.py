@@ -0,0 +1,333 @@
+"""
+Tag-invalidated response cache for GET endpoints.
+
+A route opts in with `@response_cache.cached("fighter:{id}", ...)`. Tags are
+formatted with the route's path and query parameters, and an endpoint can add
+tags that only its data reveals (e.g. the fighters in a fight) with `add_tags`.
+Write endpoints call `purge` with the tags they touched once their transaction
+has committed, which drops every cached response carrying one of them. Entries
+also expire after `RESPONSE_CACHE_TTL_SECONDS` as a backstop.
+
+Every purge also bumps the backend's generation. A response computed while a
+purge happened may hold data from before the write, so the middleware does not
+store it. The sqlite backend keeps the generation in the file, so this covers
+purges made by other workers too.
+
+With a read replica, a request right after a write can still read the data from
+before it, and storing that response would serve it for the whole TTL. The
+backends remember when each tag was last purged, and the middleware does not
+store a response read from the replica if one of its tags was purged within
+`RESPONSE_CACHE_REPLICA_LAG_SECONDS`.
+
+The "memory" backend is an LRU per process, so a purge only reaches the worker
+that made the write. With several workers use the "sqlite" backend, a file
+shared by every worker on the host.
+
+The middleware itself lives in `src/api/cache_middleware.py`.
+"""
+import contextvars
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi.concurrency import run_in_threadpool
+
+from src import config
+
+ENABLED = config.get_bool("RESPONSE_CACHE_ENABLED")
+BACKEND = config.get_str("RESPONSE_CACHE_BACKEND", "memory")
+MAX_ENTRIES = config.get_int("RESPONSE_CACHE_MAX_ENTRIES", 1024)
+TTL_SECONDS = config.get_float("RESPONSE_CACHE_TTL_SECONDS", 60)
+SQLITE_PATH = config.get_str("RESPONSE_CACHE_SQLITE_PATH", "response_cache.sqlite3")
+# How far behind the primary the read replica may be.
+REPLICA_LAG_SECONDS = config.get_float("RESPONSE_CACHE_REPLICA_LAG_SECONDS", 5)
+
+
+class Entry:
+    def __init__(self, status: int, headers: list, body: bytes, tags, expires_at: float):
+        self.status = status
+        self.headers = headers  # ASGI style [name, value] byte pairs
+        self.body = body
+        self.tags = set(tags)
+        self.expires_at = expires_at
+
+
+class MemoryBackend:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> Entry, least recently used first
+        self._keys_by_tag = {}  # tag -> set of keys
+        self._purged_at = {}  # tag -> time of its last purge, within REPLICA_LAG_SECONDS
+        self._generation = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: Entry):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            for tag in entry.tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def purge(self, tags) -> int:
+        now = time.time()
+        with self._lock:
+            self._generation += 1
+            for tag in [t for t, purged_at in self._purged_at.items() if purged_at <= now - REPLICA_LAG_SECONDS]:
+                del self._purged_at[tag]
+            for tag in tags:
+                self._purged_at[tag] = now
+            keys = set()
+            for tag in tags:
+                keys |= self._keys_by_tag.get(tag, set())
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        for tag in entry.tags:
+            keys = self._keys_by_tag.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_tag[tag]
+
+    def generation(self) -> int:
+        return self._generation
+
+    def purged_since(self, tags, since: float) -> bool:
+        with self._lock:
+            return any(self._purged_at.get(tag, 0.0) > since for tag in tags)
+
+    def size(self) -> int:
+        return len(self._entries)
+
+
+class SqliteBackend:
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                status INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                expires_at REAL NOT NULL,
+                stored_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entry_tags (tag TEXT NOT NULL, key TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_entry_tags_tag ON entry_tags (tag)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_entry_tags_key ON entry_tags (key)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO generation VALUES (0, 0)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS purges (tag TEXT PRIMARY KEY, purged_at REAL NOT NULL)")
+        self.evictions = 0
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, headers, body, expires_at FROM entries WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        if row is None:
+            return None
+        headers = [[name.encode("latin-1"), value.encode("latin-1")] for name, value in json.loads(row[1])]
+        return Entry(row[0], headers, row[2], (), row[3])
+
+    def put(self, key: str, entry: Entry):
+        headers = json.dumps([[name.decode("latin-1"), value.decode("latin-1")]
+                              for name, value in entry.headers])
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM entry_tags WHERE key = ?", (key,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, entry.status, headers, entry.body, entry.expires_at, time.time())
+                )
+                self._conn.executemany("INSERT INTO entry_tags VALUES (?, ?)",
+                                       [(tag, key) for tag in entry.tags])
+                # Shared between workers, so evict the oldest entries rather than
+                # paying for a write on every hit to track recency.
+                excess = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    self._conn.execute(
+                        """
+                        DELETE FROM entry_tags WHERE key IN
+                            (SELECT key FROM entries ORDER BY stored_at LIMIT ?)
+                        """,
+                        (excess,)
+                    )
+                    self._conn.execute(
+                        "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY stored_at LIMIT ?)",
+                        (excess,)
+                    )
+                    self.evictions += excess
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def purge(self, tags) -> int:
+        tags = list(tags)
+        marks = ", ".join("?" * len(tags))
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                purged = self._conn.execute(
+                    f"DELETE FROM entries WHERE key IN (SELECT key FROM entry_tags WHERE tag IN ({marks}))",
+                    tags
+                ).rowcount
+                self._conn.execute(
+                    f"DELETE FROM entry_tags WHERE key IN (SELECT key FROM entry_tags WHERE tag IN ({marks}))",
+                    tags
+                )
+                self._conn.execute("UPDATE generation SET value = value + 1 WHERE id = 0")
+                self._conn.execute("DELETE FROM purges WHERE purged_at <= ?", (now - REPLICA_LAG_SECONDS,))
+                self._conn.executemany("INSERT OR REPLACE INTO purges VALUES (?, ?)", [(tag, now) for tag in tags])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return purged
+
+    def generation(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT value FROM generation WHERE id = 0").fetchone()[0]
+
+    def purged_since(self, tags, since: float) -> bool:
+        tags = list(tags)
+        if not tags:
+            return False
+        marks = ", ".join("?" * len(tags))
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT 1 FROM purges WHERE purged_at > ? AND tag IN ({marks}) LIMIT 1",
+                [since] + tags
+            ).fetchone() is not None
+
+    def size(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+backend = None
+if ENABLED:
+    if BACKEND == "sqlite":
+        backend = SqliteBackend(SQLITE_PATH, MAX_ENTRIES)
+    else:
+        backend = MemoryBackend(MAX_ENTRIES)
+
+
+def after_fork():
+    """
+    Called in a worker process right after it is forked. A SQLite connection
+    must not be shared with the parent process, so the worker opens its own.
+    """
+    global backend
+    if isinstance(backend, SqliteBackend):
+        backend = SqliteBackend(SQLITE_PATH, MAX_ENTRIES)
+
+
+_counters_lock = threading.Lock()
+_counters = {
+    "hits": 0,
+    "misses": 0,
+    "collapsed": 0,
+    "stores": 0,
+    "purges": 0,
+    "purged_entries": 0,
+}
+
+# Set by the middleware for requests to cached routes, see `add_tags`.
+_request_tags = contextvars.ContextVar("response_cache_tags", default=None)
+
+
+def enabled() -> bool:
+    return backend is not None
+
+
+def count(name: str, amount: int = 1):
+    with _counters_lock:
+        _counters[name] += amount
+
+
+def cached(*tags: str):
+    """
+    Marks a GET endpoint as cacheable. Each tag is a format string filled in
+    from the request's path and query parameters, e.g. "fight:{fight_id}".
+    """
+    def decorate(endpoint):
+        endpoint.cache_tags = tags
+        return endpoint
+    return decorate
+
+
+def add_tags(*tags: str):
+    """
+    Tags the response of the current request with tags only known from its data.
+    Does nothing outside of a cached request.
+    """
+    request_tags = _request_tags.get()
+    if request_tags is not None:
+        request_tags.update(tags)
+
+
+async def purge(*tags: str):
+    """
+    Drops every cached response carrying one of `tags`. Call it after the
+    write's transaction has committed.
+    """
+    if backend is None or not tags:
+        return
+    purged = await _call(backend.purge, tags)
+    count("purges")
+    count("purged_entries", purged)
+
+
+async def _call(fn, *args):
+    # The sqlite backend does file IO, keep it off the event loop.
+    if isinstance(backend, MemoryBackend):
+        return fn(*args)
+    return await run_in_threadpool(fn, *args)
+
+
+def stats() -> dict:
+    if backend is None:
+        return {"enabled": False}
+    with _counters_lock:
+        json = dict(_counters)
+    lookups = json["hits"] + json["misses"]
+    json["enabled"] = True
+    json["backend"] = BACKEND if BACKEND == "sqlite" else "memory"
+    json["hit_ratio"] = json["hits"] / lookups if lookups else 0.0
+    json["entries"] = backend.size()
+    json["evictions"] = backend.evictions
+    return json
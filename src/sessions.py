@@ -0,0 +1,103 @@
+"""
+Signed, expiring session tokens.
+
+`POST /users/login` verifies the password once and hands back a token. Later
+requests present it as `Authorization: Bearer <token>` so the password hash does
+not have to be checked again for every prediction or account change.
+
+Tokens are `<payload>.<signature>`, both urlsafe base64, where the payload is a
+small JSON document and the signature is an HMAC-SHA256 over it using
+`SESSION_SECRET`. Revocations are kept in memory, per process, so with several
+workers a logged out or revoked token is still accepted by the other workers
+until it expires.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+
+from src import config
+
+# Without a configured secret every process signs with its own random key, which
+# only works for single-worker deployments. Set SESSION_SECRET in production.
+SECRET = config.get_str("SESSION_SECRET").encode() or secrets.token_bytes(32)
+TTL_SECONDS = config.get_int("SESSION_TTL_SECONDS", 3600)
+
+_lock = threading.Lock()
+_revoked_tokens = {}  # jti -> expiry, forgotten once the token would have expired anyway
+_revoked_users = {}  # user_id -> tokens issued before this time are invalid
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(SECRET, payload.encode(), hashlib.sha256).digest())
+
+
+def issue(user_id: int) -> dict:
+    """
+    Creates a new session token for `user_id`.
+    Returns a dictionary with the `token` and its `expires_at` unix time.
+    """
+    now = time.time()
+    claims = {
+        "sub": user_id,
+        "iat": now,
+        "exp": int(now) + TTL_SECONDS,
+        "jti": secrets.token_hex(8),
+    }
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return {"token": payload + "." + _sign(payload), "expires_at": claims["exp"]}
+
+
+def verify(token: str):
+    """
+    Returns the claims of a valid token, or None if the token is malformed,
+    tampered with, expired or revoked.
+    """
+    payload, _, signature = token.partition(".")
+    if not payload or not hmac.compare_digest(signature.encode(), _sign(payload).encode()):
+        return None
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+
+    if claims["exp"] <= time.time():
+        return None
+    with _lock:
+        if claims["jti"] in _revoked_tokens:
+            return None
+        if claims["iat"] < _revoked_users.get(claims["sub"], 0):
+            return None
+    return claims
+
+
+def revoke(claims: dict):
+    """
+    Revokes a single token, given its verified claims.
+    """
+    now = time.time()
+    with _lock:
+        for jti, exp in list(_revoked_tokens.items()):
+            if exp <= now:
+                del _revoked_tokens[jti]
+        _revoked_tokens[claims["jti"]] = claims["exp"]
+
+
+def revoke_user(user_id: int):
+    """
+    Revokes every token issued to `user_id` so far, used when the password
+    changes or the account is deleted.
+    """
+    with _lock:
+        _revoked_users[user_id] = time.time()
@@ -0,0 +1,159 @@
+"""
+SQL statement metrics.
+
+Cursor execution events on every engine in `src/database.py` count the
+statements each request runs and the time spent in them. The request being
+served is found through a context variable set by the middleware in
+`src/api/sql_timing.py`, which also reports the totals in a `Server-Timing`
+header. Totals per route template are reported at `/metrics/sql`.
+
+Statements slower than `SLOW_QUERY_MS` are logged as JSON to the
+`src.slow_queries` logger, with literals stripped from the SQL and only the
+types of the bind parameters, never their values.
+"""
+import contextvars
+import json
+import logging
+import re
+import threading
+import time
+
+from sqlalchemy import event
+
+from src import config
+
+SLOW_QUERY_MS = config.get_float("SLOW_QUERY_MS", 200)
+
+slow_query_log = logging.getLogger("src.slow_queries")
+
+
+class RequestQueries:
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.statements = 0
+        self.seconds = 0.0
+
+
+_current = contextvars.ContextVar("sql_request", default=None)
+
+
+def start_request(method: str, path: str):
+    """
+    Starts attributing statements in the current context to a new request.
+    Returns its `RequestQueries` and a token for `end_request`.
+    """
+    queries = RequestQueries(method, path)
+    return queries, _current.set(queries)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+class RouteStats:
+    def __init__(self):
+        self.requests = 0
+        self.statements = 0
+        self.statements_max = 0
+        self.seconds = 0.0
+
+
+_stats_lock = threading.Lock()
+_stats = {}  # route template -> RouteStats
+_slow_queries = 0
+
+
+def record_request(route: str, queries: RequestQueries):
+    with _stats_lock:
+        route_stats = _stats.setdefault(route, RouteStats())
+        route_stats.requests += 1
+        route_stats.statements += queries.statements
+        route_stats.statements_max = max(route_stats.statements_max, queries.statements)
+        route_stats.seconds += queries.seconds
+
+
+def stats() -> dict:
+    with _stats_lock:
+        routes = {
+            route: {
+                "requests": route_stats.requests,
+                "statements": route_stats.statements,
+                "statements_per_request": route_stats.statements / route_stats.requests,
+                "statements_max": route_stats.statements_max,
+                "db_ms_total": route_stats.seconds * 1000,
+                "db_ms_per_request": route_stats.seconds * 1000 / route_stats.requests,
+            }
+            for route, route_stats in sorted(_stats.items())
+        }
+        return {"slow_query_ms": SLOW_QUERY_MS, "slow_queries": _slow_queries, "routes": routes}
+
+
+_literals = re.compile(r"'(?:[^']|'')*'|(?<![\w$.])\d+(?:\.\d+)?\b")
+_whitespace = re.compile(r"\s+")
+
+
+def normalize(statement: str) -> str:
+    """
+    Collapses whitespace and replaces string and number literals with `?`, so the
+    same query with different values logs the same way.
+    """
+    return _whitespace.sub(" ", _literals.sub("?", statement)).strip()
+
+
+def _shape(parameters):
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+def parameter_shape(parameters, executemany: bool):
+    """
+    Describes the bind parameters by type only, e.g. `{"id": "int"}`.
+    """
+    if executemany:
+        return {"rows": len(parameters), "row": _shape(parameters[0]) if parameters else None}
+    return _shape(parameters)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    global _slow_queries
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    queries = _current.get()
+    if queries is not None:
+        queries.statements += 1
+        queries.seconds += elapsed
+
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        with _stats_lock:
+            _slow_queries += 1
+        slow_query_log.warning(json.dumps({
+            "event": "slow_query",
+            "ms": round(elapsed * 1000, 3),
+            "method": queries.method if queries else None,
+            "path": queries.path if queries else None,
+            "sql": normalize(statement),
+            "params": parameter_shape(parameters, executemany),
+        }))
+
+
+def _handle_error(exception_context):
+    started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+def instrument(engine):
+    """
+    Starts timing the statements run on `engine`. Pass the `sync_engine` of an
+    async engine.
+    """
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
@@ -0,0 +1,12 @@
+import os
+
+import dotenv
+
+# TestClient runs each request on a fresh event loop, and asyncpg connections
+# cannot be shared between loops, so the tests don't pool them.
+os.environ.setdefault("DB_NULL_POOL", "true")
+
+# Exercise the read routing without a second server: the replica is the primary.
+dotenv.load_dotenv()
+if os.environ.get("POSTGRES_SERVER"):
+    os.environ.setdefault("POSTGRES_READ_SERVER", os.environ["POSTGRES_SERVER"])
@@ -62,6 +62,13 @@ def test_list_fighter_02():
     with open("test/fighters/list_2.json", encoding="utf-8") as f:
         assert response.json() == json.load(f)
 
+
+def test_list_fighter_gzip():
+    response = client.get("/fighters/?limit=250", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert len(response.json()) == 250
+
 def test_add_fighter_01():
     response = client.post(
         "/fighters/",
@@ -1,5 +1,7 @@
 from fastapi.testclient import TestClient
 from src.api.server import app
+from src import database as db
+import sqlalchemy
 import json
 import pytest
 
@@ -7,4 +9,76 @@ client = TestClient(app)
 
 """
 TODO: New tests to correspond with the new schema (and actually huamn friendly endpoints)
-"""
\ No newline at end of file
+"""
+
+def fight_json(event_id, fighter1_id, fighter2_id):
+    return {
+        "fight": {
+            "event_id": event_id,
+            "fighter1_id": fighter1_id,
+            "fighter2_id": fighter2_id,
+            "round_num": 3,
+            "round_time": "5:00",
+            "result": fighter1_id,
+            "method_of_vic": 2,
+            "weight_class": 4,
+        },
+        "stats1": {"kd": 1, "strikes": 50, "td": 2, "sub": 0, "fighter_id": fighter1_id},
+        "stats2": {"kd": 0, "strikes": 30, "td": 0, "sub": 1, "fighter_id": fighter2_id},
+    }
+
+
+def existing_ids():
+    with db.engine.connect() as conn:
+        event_id = conn.execute(sqlalchemy.select(sqlalchemy.func.min(db.events.c.event_id))).scalar_one()
+        fighter_ids = conn.execute(
+            sqlalchemy.select(db.fighters.c.fighter_id).order_by(db.fighters.c.fighter_id).limit(2)
+        ).scalars().all()
+        missing_event_id = conn.execute(sqlalchemy.select(sqlalchemy.func.max(db.events.c.event_id))).scalar_one() + 1
+        missing_fighter_id = conn.execute(
+            sqlalchemy.select(sqlalchemy.func.max(db.fighters.c.fighter_id))
+        ).scalar_one() + 1
+    return event_id, fighter_ids, missing_event_id, missing_fighter_id
+
+
+def row_counts():
+    with db.engine.connect() as conn:
+        return (
+            conn.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(db.fights)).scalar_one(),
+            conn.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(db.fighter_stats)).scalar_one(),
+        )
+
+
+def test_post_fight_404():
+    event_id, (fighter1_id, fighter2_id), missing_event_id, missing_fighter_id = existing_ids()
+    counts = row_counts()
+
+    response = client.post("/fights", json=fight_json(missing_event_id, fighter1_id, fighter2_id))
+    assert response.status_code == 404
+    assert response.json()["detail"] == "event not found"
+
+    response = client.post("/fights", json=fight_json(event_id, fighter1_id, missing_fighter_id))
+    assert response.status_code == 404
+    assert response.json()["detail"] == "a given fighter_id was not found"
+
+    # Neither the fight nor the fighter_stats were inserted
+    assert row_counts() == counts
+
+
+def test_post_fight_01():
+    event_id, (fighter1_id, fighter2_id), _, _ = existing_ids()
+
+    response = client.post("/fights", json=fight_json(event_id, fighter1_id, fighter2_id))
+    assert response.status_code == 200
+    fight_id = response.json()["fight_id"]
+
+    with db.engine.begin() as conn:
+        fight = conn.execute(sqlalchemy.select(db.fights).where(db.fights.c.fight_id == fight_id)).one()
+        assert (fight.event_id, fight.fighter1_id, fight.fighter2_id) == (event_id, fighter1_id, fighter2_id)
+        assert fight.result == fighter1_id
+
+        conn.execute(sqlalchemy.delete(db.fights).where(db.fights.c.fight_id == fight_id))
+        conn.execute(
+            sqlalchemy.delete(db.fighter_stats)
+            .where(db.fighter_stats.c.stats_id.in_([fight.stats1_id, fight.stats2_id]))
+        )
@@ -0,0 +1,38 @@
+from fastapi.testclient import TestClient
+
+from src.api import health
+from src.api.server import app
+
+client = TestClient(app)
+
+
+def test_healthz_01():
+    response = client.get("/healthz")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
+
+
+def test_readyz_01():
+    response = client.get("/readyz")
+    assert response.status_code == 200
+    json = response.json()
+    assert json["ready"] is True
+    assert json["reasons"] == []
+    assert json["database_ms"] >= 0
+
+
+def test_readyz_02(monkeypatch):
+    monkeypatch.setattr(health, "MAX_DB_LATENCY_MS", 0)
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["ready"] is False
+
+
+def test_readyz_draining_01(monkeypatch):
+    monkeypatch.setattr(health, "_shutting_down", False)
+    assert health.start_draining() is True
+    assert health.start_draining() is False
+
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert "shutting down" in response.json()["reasons"]
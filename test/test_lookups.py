@@ -0,0 +1,76 @@
+import asyncio
+
+import sqlalchemy
+from fastapi.testclient import TestClient
+
+from src import lookups
+from src.api.server import app
+
+client = TestClient(app)
+
+
+def test_get_lookups_01():
+    response = client.get("/lookups")
+    assert response.status_code == 200
+    tables = response.json()
+    assert tables["stances"]["2"] == "Southpaw"
+    assert tables["weight_classes"]["4"] == "Lightweight"
+    assert tables["victory_methods"]["2"] == "KO/TKO"
+
+
+def test_refresh_lookups_01():
+    response = client.post("/lookups/refresh")
+    assert response.status_code == 403
+
+
+def test_post_fight_unknown_weight_class_01():
+    response = client.post("/fights", json={
+        "fight": {"event_id": 1, "fighter1_id": 1, "fighter2_id": 2, "round_num": 1, "round_time": "1:00",
+                  "result": 1, "method_of_vic": 2, "weight_class": 99},
+        "stats1": {"fighter_id": 1},
+        "stats2": {"fighter_id": 2},
+    })
+    assert response.status_code == 400
+
+
+def stale_tables(monkeypatch):
+    tables = lookups.Lookups({2: "Southpaw"}, {4: "Lightweight"}, {2: "KO/TKO"})
+    tables.loaded_at -= 2
+    monkeypatch.setattr(lookups, "_current", tables)
+    monkeypatch.setattr(lookups, "TTL_SECONDS", 1)
+    monkeypatch.setattr(lookups, "_retry_at", 0.0)
+    monkeypatch.setattr(lookups, "_refresh_lock", None)
+    return tables
+
+
+def test_lookups_single_refresh_01(monkeypatch):
+    stale_tables(monkeypatch)
+    refreshed = lookups.Lookups({}, {}, {})
+    calls = []
+
+    async def refresh():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        monkeypatch.setattr(lookups, "_current", refreshed)
+        return refreshed
+
+    async def get_many():
+        return await asyncio.gather(*(lookups.get() for _ in range(10)))
+
+    monkeypatch.setattr(lookups, "refresh", refresh)
+    assert asyncio.run(get_many()) == [refreshed] * 10
+    assert len(calls) == 1
+
+
+def test_lookups_stale_on_failure_01(monkeypatch):
+    tables = stale_tables(monkeypatch)
+
+    async def refresh():
+        raise sqlalchemy.exc.OperationalError("SELECT", {}, OSError("database is down"))
+
+    monkeypatch.setattr(lookups, "refresh", refresh)
+    assert asyncio.run(lookups.get()) is tables
+
+    response = client.get("/lookups")
+    assert response.status_code == 200
+    assert response.json()["stances"] == {"2": "Southpaw"}
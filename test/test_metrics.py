@@ -0,0 +1,62 @@
+from fastapi.testclient import TestClient
+
+from src import query_budget
+from src.api.server import app
+
+client = TestClient(app)
+
+
+def test_http_metrics_01():
+    response = client.get("/fighters/1")
+    assert response.status_code == 200
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'http_requests_total{method="GET",route="/fighters/{id}",status="200"}' in response.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/fighters/{id}"}' in response.text
+
+
+def test_sql_metrics_01():
+    response = client.get("/fighters/1")
+    assert response.status_code == 200
+    assert response.headers["server-timing"].startswith("db;dur=")
+    assert response.headers["server-timing"].endswith('desc="1 queries"')
+
+    response = client.get("/metrics/sql")
+    assert response.status_code == 200
+    assert response.json()["routes"]["/fighters/{id}"]["statements_max"] >= 1
+
+
+def test_query_budget_01(monkeypatch):
+    # get_prediction runs two statements.
+    monkeypatch.setattr(query_budget, "MAX_STATEMENTS", 1)
+    response = client.get("/predictions/count?fight_id=1")
+    assert response.status_code == 503
+
+    response = client.get("/metrics/query-budget")
+    assert response.status_code == 200
+    assert response.json()["routes"]["/predictions/count"]["statement_budget"] >= 1
+
+
+def test_prepared_statements_01():
+    for _ in range(2):
+        response = client.get("/fighters/?sort=reach&order=descending")
+        assert response.status_code == 200
+
+    response = client.get("/metrics/prepared")
+    assert response.status_code == 200
+    stats = response.json()["list_fighters_reach_desc"]
+    assert stats["hits"] + stats["misses"] >= 2
+
+
+def test_cold_start_01():
+    response = client.get("/")
+    assert response.status_code == 200
+
+    response = client.get("/metrics/cold-start")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["serverless"] is False
+    assert stats["import_ms"] > 0
+    assert stats["first_response_ms"] is not None
@@ -0,0 +1,170 @@
+from fastapi.testclient import TestClient
+
+from src.api.server import app
+from src.api import predictions
+from src import database as db
+from src import prediction_buffer
+from datetime import datetime
+import sqlalchemy
+import pytest
+
+client = TestClient(app)
+
+
+def test_add_prediction_400():
+    # A fight of an event that has already happened
+    with db.engine.connect() as conn:
+        fight = conn.execute(
+            sqlalchemy.select(db.fights.c.fight_id, db.fights.c.fighter1_id)
+            .join(db.events, db.fights.c.event_id == db.events.c.event_id)
+            .where(db.events.c.event_date < sqlalchemy.func.now())
+            .limit(1)
+        ).one()
+
+    response = client.post(
+        "/users/",
+        headers={"Content-Type": "application/json"},
+        json={
+            "username": "test_user_prediction",
+            "password": "test_password"
+        }
+    )
+    assert response.status_code == 200
+    user_id = response.json()["user_id"]
+
+    response = client.post(
+        "/predictions/add/",
+        headers={"Content-Type": "application/json"},
+        json={
+            "prediction": {"fight_id": fight.fight_id, "fighter_id": fight.fighter1_id},
+            "user": {"username": "test_user_prediction", "password": "test_password"},
+        }
+    )
+    assert response.status_code == 400
+    assert response.json()["detail"] == "too late to submit prediction for this fight"
+
+    with db.engine.begin() as conn:
+        count = conn.execute(
+            sqlalchemy.select(sqlalchemy.func.count())
+            .select_from(db.predictions)
+            .where(db.predictions.c.user_id == user_id)
+        ).scalar_one()
+        assert count == 0
+
+        conn.execute(
+            sqlalchemy.delete(
+                db.users,
+            )
+            .where(db.users.c.user_id == user_id)
+        )
+
+
+class long_ago(datetime):
+    # Every fight is then far enough in the future to predict.
+    @classmethod
+    def now(cls):
+        return datetime(2000, 1, 1)
+
+
+def buffered_user(username):
+    response = client.post(
+        "/users/",
+        headers={"Content-Type": "application/json"},
+        json={
+            "username": username,
+            "password": "test_password"
+        }
+    )
+    assert response.status_code == 200
+    return response.json()["user_id"]
+
+
+def any_fight():
+    with db.engine.connect() as conn:
+        return conn.execute(
+            sqlalchemy.select(db.fights.c.fight_id, db.fights.c.fighter1_id).limit(1)
+        ).one()
+
+
+def delete_user(user_id):
+    # Their predictions go with them.
+    with db.engine.begin() as conn:
+        conn.execute(
+            sqlalchemy.delete(
+                db.users,
+            )
+            .where(db.users.c.user_id == user_id)
+        )
+
+
+def test_prediction_buffer_01():
+    # Accepted, then a duplicate within the same batch and one of a committed row
+    user_id = buffered_user("test_user_buffer")
+    fight = any_fight()
+    try:
+        buffer = prediction_buffer.PredictionBuffer(flush_ms=60000)
+        first = buffer.submit(fight.fight_id, fight.fighter1_id, user_id)
+        second = buffer.submit(fight.fight_id, fight.fighter1_id, user_id)
+        assert not first.done()
+        # Shutting down flushes what is still queued
+        buffer.shutdown()
+        assert first.result(0) == prediction_buffer.ACCEPTED
+        assert second.result(0) == prediction_buffer.DUPLICATE
+
+        with pytest.raises(RuntimeError):
+            buffer.submit(fight.fight_id, fight.fighter1_id, user_id)
+
+        buffer = prediction_buffer.PredictionBuffer(flush_ms=1)
+        third = buffer.submit(fight.fight_id, fight.fighter1_id, user_id)
+        assert third.result(10) == prediction_buffer.DUPLICATE
+        buffer.shutdown()
+        assert buffer.stats()["rows_duplicate"] == 1
+    finally:
+        delete_user(user_id)
+
+
+def test_prediction_buffer_02():
+    # A bad row only fails its own prediction
+    user_id = buffered_user("test_user_buffer_bad_row")
+    fight = any_fight()
+    try:
+        buffer = prediction_buffer.PredictionBuffer(flush_ms=60000)
+        good = buffer.submit(fight.fight_id, fight.fighter1_id, user_id)
+        bad = buffer.submit(fight.fight_id, fight.fighter1_id, user_id + 1000000)
+        buffer.shutdown()
+        assert good.result(0) == prediction_buffer.ACCEPTED
+        assert isinstance(bad.exception(0), sqlalchemy.exc.IntegrityError)
+    finally:
+        delete_user(user_id)
+
+
+def test_add_prediction_buffered_01(monkeypatch):
+    user_id = buffered_user("test_user_buffer_endpoint")
+    fight = any_fight()
+    monkeypatch.setattr(predictions, "datetime", long_ago)
+    body = {
+        "prediction": {"fight_id": fight.fight_id, "fighter_id": fight.fighter1_id},
+        "user": {"username": "test_user_buffer_endpoint", "password": "test_password"},
+    }
+    try:
+        # As if PREDICTION_BUFFER_ENABLED were set, with a flush that never comes in time
+        buffer = prediction_buffer.PredictionBuffer(flush_ms=60000)
+        monkeypatch.setattr(prediction_buffer, "buffer", buffer)
+        monkeypatch.setattr(prediction_buffer, "TIMEOUT_SECONDS", 0.05)
+        response = client.post("/predictions/add/", json=body)
+        assert response.status_code == 503
+        buffer.shutdown()
+
+        response = client.post("/predictions/add/", json=body)
+        assert response.status_code == 503
+
+        buffer = prediction_buffer.PredictionBuffer(flush_ms=1)
+        monkeypatch.setattr(prediction_buffer, "buffer", buffer)
+        monkeypatch.setattr(prediction_buffer, "TIMEOUT_SECONDS", 10)
+        response = client.post("/predictions/add/", json=body)
+        assert response.status_code == 200
+        # The timed out prediction was still saved when the first buffer shut down
+        assert response.json()["status"] == prediction_buffer.DUPLICATE
+        buffer.shutdown()
+    finally:
+        delete_user(user_id)
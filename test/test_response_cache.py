@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from src import database as db
+from src import response_cache
+from src.api import http_metrics
+from src.api.cache_middleware import ResponseCacheMiddleware
+
+
+def make_entry(*tags):
+    return response_cache.Entry(200, [[b"content-type", b"application/json"]], b"{}", tags,
+                                time.time() + 60)
+
+
+def test_response_cache_memory_01():
+    backend = response_cache.MemoryBackend(max_entries=2)
+    backend.put("/fighters/1?", make_entry("fighter:1"))
+    backend.put("/fights/1?", make_entry("fight:1", "fighter:1", "fighter:2"))
+    backend.put("/fights/2?", make_entry("fight:2", "fighter:3"))
+
+    # The least recently used entry is evicted
+    assert backend.get("/fighters/1?") is None
+    assert backend.evictions == 1
+
+    assert backend.purge(["fighter:2"]) == 1
+    assert backend.get("/fights/1?") is None
+    assert backend.get("/fights/2?").body == b"{}"
+
+
+def test_response_cache_sqlite_01(tmp_path):
+    backend = response_cache.SqliteBackend(str(tmp_path / "cache.sqlite3"), max_entries=10)
+    backend.put("/fights/1?", make_entry("fight:1", "fighter:1"))
+    backend.put("/fights/2?", make_entry("fight:2", "fighter:3"))
+
+    entry = backend.get("/fights/1?")
+    assert entry.status == 200
+    assert entry.headers == [[b"content-type", b"application/json"]]
+
+    assert backend.purge(["fighter:1"]) == 1
+    assert backend.get("/fights/1?") is None
+    assert backend.size() == 1
+
+
+def test_response_cache_hit_route_01(monkeypatch):
+    monkeypatch.setattr(response_cache, "backend", response_cache.MemoryBackend(max_entries=10))
+
+    app = FastAPI()
+
+    @app.get("/cached/{item_id}")
+    @response_cache.cached("item:{item_id}")
+    async def get_cached_item(item_id: int):
+        return {"item_id": item_id}
+
+    app.add_middleware(ResponseCacheMiddleware, routes=app.routes)
+    app.add_middleware(http_metrics.HttpMetricsMiddleware, routes=app.routes)
+    client = TestClient(app)
+
+    assert client.get("/cached/1").headers["x-cache"] == "MISS"
+    assert client.get("/cached/1").headers["x-cache"] == "HIT"
+    assert 'http_requests_total{method="GET",route="/cached/{item_id}",status="200"} 2' in http_metrics.render()
+
+
+def test_response_cache_normalized_tags_01(monkeypatch):
+    monkeypatch.setattr(response_cache, "backend", response_cache.MemoryBackend(max_entries=10))
+
+    app = FastAPI()
+
+    @app.get("/cached/{item_id}")
+    @response_cache.cached("item:{item_id}")
+    async def get_cached_item(item_id: int):
+        return {"item_id": item_id}
+
+    app.add_middleware(ResponseCacheMiddleware, routes=app.routes)
+    client = TestClient(app)
+
+    assert client.get("/cached/05").headers["x-cache"] == "MISS"
+    assert client.get("/cached/05").headers["x-cache"] == "HIT"
+    asyncio.run(response_cache.purge("item:5"))
+    assert client.get("/cached/05").headers["x-cache"] == "MISS"
+
+
+def test_response_cache_sqlite_generation_01(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    worker1 = response_cache.SqliteBackend(path, max_entries=10)
+    worker2 = response_cache.SqliteBackend(path, max_entries=10)
+
+    generation = worker1.generation()
+    worker2.purge(["fighter:1"])
+    assert worker1.generation() == generation + 1
+
+
+def test_response_cache_purged_since_01(tmp_path):
+    for backend in (response_cache.MemoryBackend(max_entries=10),
+                    response_cache.SqliteBackend(str(tmp_path / "cache.sqlite3"), max_entries=10)):
+        before = time.time() - 1
+        backend.purge(["fighter:1"])
+        assert backend.purged_since(["fighter:1", "fight:1"], before)
+        assert not backend.purged_since(["fight:1"], before)
+        assert not backend.purged_since(["fighter:1"], time.time() + 1)
+
+
+def test_response_cache_replica_lag_01(monkeypatch):
+    monkeypatch.setattr(response_cache, "backend", response_cache.MemoryBackend(max_entries=10))
+    # Any engine will do, the endpoint never connects.
+    monkeypatch.setattr(db, "read_engine", db.engine)
+
+    app = FastAPI()
+
+    @app.get("/cached/{item_id}")
+    @response_cache.cached("item:{item_id}")
+    async def get_cached_item(item_id: int):
+        return {"item_id": item_id}
+
+    app.add_middleware(ResponseCacheMiddleware, routes=app.routes)
+    client = TestClient(app)
+
+    # Right after a write the replica may lag, so the response is not stored
+    asyncio.run(response_cache.purge("item:1"))
+    assert client.get("/cached/1").headers["x-cache"] == "MISS"
+    assert client.get("/cached/1").headers["x-cache"] == "MISS"
+
+    # Unless it was read from the primary
+    headers = {"X-Read-Your-Writes": "true"}
+    assert client.get("/cached/1", headers=headers).headers["x-cache"] == "MISS"
+    assert client.get("/cached/1").headers["x-cache"] == "HIT"
+
+    # Other items were not purged
+    assert client.get("/cached/2").headers["x-cache"] == "MISS"
+    assert client.get("/cached/2").headers["x-cache"] == "HIT"
@@ -0,0 +1,17 @@
+import json
+from datetime import date, datetime
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from src.api.responses import FastJSONResponse
+
+
+def test_fast_json_response_01():
+    content = [{"fight_id": 1, "fighter1": "José Aldo", "event_date": date(2023, 4, 8),
+                "created_at": datetime(2023, 4, 8, 12, 30, 5, 123000), "attendance": None}]
+    fast = FastJSONResponse(content)
+    default = JSONResponse(jsonable_encoder(content))
+
+    assert fast.media_type == "application/json"
+    assert json.loads(fast.body) == json.loads(default.body)
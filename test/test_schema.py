@@ -0,0 +1,7 @@
+from src import database as db
+
+
+def test_schema_drift():
+    # The statically declared tables must match the migrated database
+    with db.engine.connect() as conn:
+        assert db.schema_drift(conn) == []
@@ -2,6 +2,8 @@ from fastapi.testclient import TestClient
 
 from src.api.server import app
 from src import database as db
+from src import login_throttle
+from src import passwords
 import sqlalchemy
 import json
 import pytest
@@ -75,4 +77,296 @@ def test_user_01():
                 SELECT setval(pg_get_serial_sequence('users', 'user_id'), max(user_id))
                 FROM users"""
             )
-        )
\ No newline at end of file
+        )
+
+def test_user_predictions_01():
+    # A new user has no prediction history
+    response = client.post(
+        "/users/",
+        headers={"Content-Type": "application/json"},
+        json={
+            "username": "test_user_history",
+            "password": "test_password"
+        }
+    )
+    assert response.status_code == 200
+    user_id = response.json()["user_id"]
+
+    response = client.get("/users/" + str(user_id) + "/predictions")
+    assert response.status_code == 200
+    assert response.json() == {"predictions": [], "next_cursor": None}
+
+    response = client.get("/users/" + str(user_id) + "/predictions?cursor=notacursor")
+    assert response.status_code == 400
+
+    with db.engine.begin() as conn:
+        conn.execute(
+            sqlalchemy.delete(
+                db.users,
+            )
+            .where(db.users.c.user_id == user_id)
+        )
+
+    response = client.get("/users/" + str(user_id) + "/predictions")
+    assert response.status_code == 404
+
+    # Ensure the identity key is after the max id
+    with db.engine.connect() as conn:
+        result = conn.execute(
+            sqlalchemy.text(
+                """
+                SELECT setval(pg_get_serial_sequence('users', 'user_id'), max(user_id))
+                FROM users"""
+            )
+        )
+
+
+def test_user_session_01():
+    # Login issues a token that stands in for the password until logout
+    response = client.post(
+        "/users/",
+        headers={"Content-Type": "application/json"},
+        json={
+            "username": "test_user_session",
+            "password": "test_password"
+        }
+    )
+    assert response.status_code == 200
+    user_id = response.json()["user_id"]
+
+    response = client.post(
+        "/users/login",
+        headers={"Content-Type": "application/json"},
+        json={
+            "username": "test_user_session",
+            "password": "test_password"
+        }
+    )
+    assert response.status_code == 200
+    assert response.json()["user_id"] == user_id
+    token = response.json()["token"]
+
+    response = client.put(
+        "/users/update/name",
+        headers={"Content-Type": "application/json",
+                 "Authorization": "Bearer " + token},
+        json={"new_username": "test_user_session_renamed"}
+    )
+    assert response.status_code == 200
+
+    response = client.get("/users/" + str(user_id))
+    assert response.json()["username"] == "test_user_session_renamed"
+
+    response = client.post("/users/logout", headers={"Authorization": "Bearer " + token})
+    assert response.status_code == 200
+
+    response = client.post("/users/delete", headers={"Authorization": "Bearer " + token})
+    assert response.status_code == 401
+
+    response = client.post("/users/delete", headers={"Authorization": "Bearer " + token + "x"})
+    assert response.status_code == 401
+
+    response = client.post("/users/delete", headers={"Authorization": "Bearer " + token + "é"})
+    assert response.status_code == 401
+
+    response = client.post(
+        "/users/delete",
+        headers={"Content-Type": "application/json"},
+        json={
+            "username": "test_user_session_renamed",
+            "password": "test_password"
+        }
+    )
+    assert response.status_code == 200
+
+    # Ensure the identity key is after the max id
+    with db.engine.connect() as conn:
+        result = conn.execute(
+            sqlalchemy.text(
+                """
+                SELECT setval(pg_get_serial_sequence('users', 'user_id'), max(user_id))
+                FROM users"""
+            )
+        )
+
+
+def test_update_username_409():
+    user_ids = []
+    for username in ("test_user_rename_a", "test_user_rename_b"):
+        response = client.post(
+            "/users/",
+            headers={"Content-Type": "application/json"},
+            json={
+                "username": username,
+                "password": "test_password"
+            }
+        )
+        assert response.status_code == 200
+        user_ids.append(response.json()["user_id"])
+
+    response = client.put(
+        "/users/update/name",
+        headers={"Content-Type": "application/json"},
+        json={
+            "old_username": "test_user_rename_a",
+            "password": "test_password",
+            "new_username": "test_user_rename_b"
+        }
+    )
+    assert response.status_code == 409
+
+    response = client.get("/users/" + str(user_ids[0]))
+    assert response.json()["username"] == "test_user_rename_a"
+
+    with db.engine.begin() as conn:
+        conn.execute(
+            sqlalchemy.delete(
+                db.users,
+            )
+            .where(db.users.c.user_id.in_(user_ids))
+        )
+
+
+def test_update_password_01():
+    response = client.post(
+        "/users/",
+        headers={"Content-Type": "application/json"},
+        json={
+            "username": "test_user_password",
+            "password": "test_password"
+        }
+    )
+    assert response.status_code == 200
+    user_id = response.json()["user_id"]
+
+    response = client.post(
+        "/users/login",
+        headers={"Content-Type": "application/json"},
+        json={
+            "username": "test_user_password",
+            "password": "test_password"
+        }
+    )
+    token = response.json()["token"]
+    headers = {"Content-Type": "application/json", "Authorization": "Bearer " + token}
+
+    # A session token alone cannot change the password
+    response = client.put("/users/update/password", headers=headers, json={"new_password": "new_password"})
+    assert response.status_code == 401
+
+    response = client.put(
+        "/users/update/password",
+        headers=headers,
+        json={"old_password": "wrong_password", "new_password": "new_password"}
+    )
+    assert response.status_code == 401
+
+    response = client.put(
+        "/users/update/password",
+        headers=headers,
+        json={"old_password": "test_password", "new_password": "new_password"}
+    )
+    assert response.status_code == 200
+
+    # Changing the password revoked the token
+    response = client.put(
+        "/users/update/password",
+        headers=headers,
+        json={"old_password": "new_password", "new_password": "test_password"}
+    )
+    assert response.status_code == 401
+
+    with db.engine.begin() as conn:
+        conn.execute(
+            sqlalchemy.delete(
+                db.users,
+            )
+            .where(db.users.c.user_id == user_id)
+        )
+
+
+def test_login_throttle_01(monkeypatch):
+    monkeypatch.setattr(login_throttle, "backend", login_throttle.MemoryBackend())
+    monkeypatch.setattr(login_throttle, "MAX_FAILURES_USER", 3)
+    monkeypatch.setattr(login_throttle, "MAX_FAILURES_IP", 100)
+
+    response = client.post(
+        "/users/",
+        headers={"Content-Type": "application/json"},
+        json={
+            "username": "test_user_throttle",
+            "password": "test_password"
+        }
+    )
+    assert response.status_code == 200
+    user_id = response.json()["user_id"]
+
+    def login(password):
+        return client.post(
+            "/users/login",
+            headers={"Content-Type": "application/json"},
+            json={
+                "username": "test_user_throttle",
+                "password": password
+            }
+        )
+
+    # A successful login clears the failures before it
+    for _ in range(2):
+        assert login("wrong_password").status_code == 401
+    assert login("test_password").status_code == 200
+    for _ in range(2):
+        assert login("wrong_password").status_code == 401
+    assert login("test_password").status_code == 200
+
+    for _ in range(3):
+        assert login("wrong_password").status_code == 401
+    # Locked out, even with the right password
+    response = login("test_password")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+
+    with db.engine.begin() as conn:
+        conn.execute(
+            sqlalchemy.delete(
+                db.users,
+            )
+            .where(db.users.c.user_id == user_id)
+        )
+
+
+def test_password_long_01():
+    # Like pgcrypto, only the first 72 bytes count
+    password = "x" * 72 + "long tail"
+    hashed = passwords._hash(password, 4)
+    assert passwords._verify(password, hashed)
+    assert passwords._verify("x" * 72, hashed)
+    assert not passwords._verify("x" * 71, hashed)
+
+
+def test_import_users_malformed_01(monkeypatch):
+    monkeypatch.setenv("ADMIN_TOKEN", "test_admin_token")
+
+    response = client.post("/users/import?format=jsonl", headers={"X-Admin-Token": "tést"}, data=b"")
+    assert response.status_code == 403
+
+    headers = {"X-Admin-Token": "test_admin_token"}
+    response = client.post("/users/import?format=jsonl", headers=headers, data=b"\xff\xfe")
+    assert response.status_code == 400
+
+    # The malformed last row is found before the first row is inserted
+    body = '{"username": "test_user_import", "password": "test_password"}\n[1, 2]\n'
+    response = client.post("/users/import?format=jsonl&batch_size=1", headers=headers, data=body.encode())
+    assert response.status_code == 400
+    assert "row 2" in response.json()["detail"]
+
+    body = '{"username": "test_user_import", "password": "test_password"}\n{"username": "a", "password": 123}\n'
+    response = client.post("/users/import?format=jsonl", headers=headers, data=body.encode())
+    assert response.status_code == 400
+    assert "row 2" in response.json()["detail"]
+
+    with db.engine.connect() as conn:
+        count = conn.execute(
+            sqlalchemy.text("SELECT count(*) FROM users WHERE username = 'test_user_import'")
+        ).scalar_one()
+    assert count == 0